@@ -0,0 +1,131 @@
+import os
+import json
+import shutil
+import hashlib
+from pathlib import Path
+from collections import defaultdict
+
+from . import common, config
+
+
+def get_cache_root():
+    return Path(config.GTFS_ETL_ROOT_ARCHIVES_FOLDER, config.ARCHIVE_CACHE_FOLDER)
+
+
+def get_cache_key(s3_key, etag, size):
+    return hashlib.sha256('{}\n{}\n{}'.format(s3_key, etag, size).encode()).hexdigest()
+
+
+def get_remote_etag_size(url):
+    import requests
+    res = requests.head(url, timeout=60)
+    res.raise_for_status()
+    # S3 always returns an ETag, Last-Modified is a fallback for other servers
+    etag = res.headers.get('ETag') or res.headers.get('Last-Modified') or ''
+    return etag.strip('"'), int(res.headers['Content-Length'])
+
+
+def get_file_sha256(path):
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def is_entry_valid(entry_path, size):
+    """Returns True if the entry's data file has the expected size and the sha256 recorded when it was downloaded,
+    so that a cached file which was corrupted (or partially written) is never served"""
+    data_path = os.path.join(entry_path, 'data')
+    metadata_path = os.path.join(entry_path, 'metadata.json')
+    if not os.path.exists(data_path) or os.path.getsize(data_path) != size or not os.path.exists(metadata_path):
+        return False
+    try:
+        with open(metadata_path) as f:
+            sha256 = json.load(f).get('sha256')
+    except ValueError:
+        return False
+    return sha256 is not None and sha256 == get_file_sha256(data_path)
+
+
+def link_or_copy(source_path, target_path):
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    if os.path.exists(target_path):
+        os.unlink(target_path)
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.copyfile(source_path, target_path)
+
+
+def iterate_entries():
+    """Yields (entry path, data file size, last access time) of all cache entries"""
+    cache_root = get_cache_root()
+    if cache_root.exists():
+        for prefix in os.scandir(cache_root):
+            if prefix.is_dir():
+                for entry in os.scandir(prefix.path):
+                    if entry.is_dir():
+                        data_path = os.path.join(entry.path, 'data')
+                        if os.path.exists(data_path):
+                            stat = os.stat(data_path)
+                            yield entry.path, stat.st_size, stat.st_mtime
+
+
+def evict(max_bytes=None, silent=False):
+    """Deletes least recently used entries until the total size of the cache is at most max_bytes"""
+    if max_bytes is None:
+        max_bytes = config.GTFS_ETL_ARCHIVE_CACHE_MAX_BYTES
+    stats = defaultdict(int)
+    with common.file_lock(os.path.join(get_cache_root(), '.lock')):
+        entries = sorted(iterate_entries(), key=lambda entry: entry[2])
+        total_bytes = sum(size for _, size, _ in entries)
+        stats['archive cache total bytes'] = total_bytes
+        for entry_path, size, _ in entries:
+            if total_bytes <= max_bytes:
+                break
+            if not silent:
+                print("Evicting archive cache entry: {}".format(entry_path))
+            shutil.rmtree(entry_path, ignore_errors=True)
+            # safe while holding the exclusive root lock, entry locks are only taken under the shared root lock
+            if os.path.exists(entry_path + '.lock'):
+                os.unlink(entry_path + '.lock')
+            total_bytes -= size
+            stats['archive cache evicted entries'] += 1
+            stats['archive cache evicted bytes'] += size
+    return stats
+
+
+def download(url, s3_key, target_path, silent=False, refresh=False):
+    """Downloads the url to target_path using the local archive cache.
+    Cache entries are keyed by the S3 key and the remote ETag / size, so a changed object is never served from the cache.
+    Cached files are verified against the sha256 recorded when they were downloaded, invalid entries are downloaded again.
+    If refresh is set, the cache entry is downloaded again (e.g. after the cached file failed to extract).
+    Returns True if the file was served from the cache."""
+    if not config.GTFS_ETL_ARCHIVE_CACHE_MAX_BYTES:
+        common.http_stream_download(target_path, url=url)
+        return False
+    etag, size = get_remote_etag_size(url)
+    cache_key = get_cache_key(s3_key, etag, size)
+    entry_path = os.path.join(get_cache_root(), cache_key[:2], cache_key)
+    data_path = os.path.join(entry_path, 'data')
+    # shared lock on the cache root prevents eviction while the entry is used,
+    # the exclusive entry lock prevents concurrent downloads of the same entry
+    with common.file_lock(os.path.join(get_cache_root(), '.lock'), shared=True):
+        with common.file_lock(entry_path + '.lock'):
+            is_hit = not refresh and is_entry_valid(entry_path, size)
+            if is_hit:
+                if not silent:
+                    print("Using cached archive file for {}: {}".format(url, data_path))
+            else:
+                if not refresh and os.path.exists(data_path) and not silent:
+                    print("Cached archive file is invalid, downloading again: {}".format(data_path))
+                common.http_stream_download(data_path, url=url)
+                with common.safe_open_write(os.path.join(entry_path, 'metadata.json'), 'w') as f:
+                    json.dump({'url': url, 's3_key': s3_key, 'etag': etag, 'size': size, 'sha256': get_file_sha256(data_path)}, f)
+            # mtime is used as the last access time for LRU eviction
+            os.utime(data_path)
+            link_or_copy(data_path, target_path)
+    if not is_hit:
+        evict(silent=silent)
+    return is_hit
@@ -0,0 +1,145 @@
+import datetime
+from pathlib import Path
+from functools import cached_property
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.compute as pc
+
+from . import partridge_helper, resources
+
+
+# explicit types of the columns which are not strings, all other columns are read as strings (like partridge)
+# times are read as strings and converted to float seconds, to match partridge's parsing
+TABLE_COLUMN_TYPES = {
+    'agency': {},
+    'routes': {'route_type': pa.int64()},
+    'trips': {'direction_id': pa.int64()},
+    'stops': {'stop_lat': pa.float64(), 'stop_lon': pa.float64(), 'location_type': pa.int64()},
+    'stop_times': {
+        'stop_sequence': pa.int64(),
+        'pickup_type': pa.float64(),
+        'drop_off_type': pa.float64(),
+        'shape_dist_traveled': pa.float64(),
+    },
+}
+TIME_COLUMNS = {'stop_times': ['arrival_time', 'departure_time']}
+
+# the typed reader profile of stop_times.txt (see partridge_helper.STOP_TIMES_READ_DTYPES),
+# string columns are dictionary encoded so that they are converted to categories
+STOP_TIMES_READ_TYPES = {
+    'trip_id': pa.dictionary(pa.int32(), pa.string()),
+    'arrival_time': pa.dictionary(pa.int32(), pa.string()),
+    'departure_time': pa.dictionary(pa.int32(), pa.string()),
+    'stop_id': pa.int32(),
+    'stop_sequence': pa.int32(),
+    'pickup_type': pa.float32(),
+    'drop_off_type': pa.float32(),
+    'shape_dist_traveled': pa.float32(),
+}
+
+READ_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def get_read_options():
+    pa.set_cpu_count(resources.get_tuning()['parser_threads'])
+    return pa_csv.ReadOptions(use_threads=True, block_size=READ_BLOCK_SIZE)
+
+
+def read_csv_table(file_path: Path, column_types, include_columns=None) -> pa.Table:
+    """Reads the csv file with pyarrow's multithreaded reader, columns without explicit type are read as strings"""
+    with open(file_path, encoding='utf-8-sig') as f:
+        header = f.readline().strip().split(',')
+    if include_columns is not None:
+        header = [column for column in header if column in include_columns]
+    return pa_csv.read_csv(
+        file_path,
+        read_options=get_read_options(),
+        convert_options=pa_csv.ConvertOptions(
+            column_types={column: column_types.get(column, pa.string()) for column in header},
+            include_columns=header,
+            strings_can_be_null=True,
+        ),
+    )
+
+
+def read_stop_times_typed(source) -> pd.DataFrame:
+    """Reads stop_times csv (a path or a file-like object, e.g. the prefiltered lines) with pyarrow's multithreaded
+    reader to the typed reader profile, times are categories which are converted to seconds by the caller"""
+    table = pa_csv.read_csv(
+        source,
+        read_options=get_read_options(),
+        convert_options=pa_csv.ConvertOptions(
+            column_types=STOP_TIMES_READ_TYPES,
+            include_columns=list(STOP_TIMES_READ_TYPES),
+        ),
+    )
+    return table.to_pandas(split_blocks=True)
+
+
+def filter_is_in(table: pa.Table, column, values) -> pa.Table:
+    if not isinstance(values, pa.Array):
+        values = pa.array(values, type=table.schema.field(column).type)
+    return table.filter(pc.is_in(table[column], value_set=values))
+
+
+class ArrowFeed:
+    """Alternative to a partridge feed filtered for a date, with the same table attributes used by the loaders.
+    Tables are parsed lazily with pyarrow, the date's service ids / trips filters are applied with Arrow compute
+    kernels and dependant tables are pruned like partridge does (routes of the trips, agencies of the routes,
+    stop times of the trips and stops of the stop times)."""
+
+    def __init__(self, gtfs_path: Path, date: datetime.date):
+        self.gtfs_path = Path(gtfs_path)
+        self.date = date
+
+    def read_table(self, name, include_columns=None) -> pa.Table:
+        return read_csv_table(Path(self.gtfs_path, f'{name}.txt'), TABLE_COLUMN_TYPES[name], include_columns)
+
+    def to_pandas(self, name, table: pa.Table):
+        # split_blocks avoids consolidating the numeric columns to a single block, so they are not copied
+        df = table.to_pandas(split_blocks=True)
+        for column in TIME_COLUMNS.get(name, []):
+            if column in df.columns:
+                df[column] = partridge_helper.parse_time_seconds(df[column])
+        return df
+
+    @cached_property
+    def trips_table(self) -> pa.Table:
+        service_ids = partridge_helper.get_service_ids_for_date(self.gtfs_path, self.date)
+        return filter_is_in(self.read_table('trips'), 'service_id', list(service_ids))
+
+    @cached_property
+    def routes_table(self) -> pa.Table:
+        return filter_is_in(self.read_table('routes'), 'route_id', pc.unique(self.trips_table['route_id']))
+
+    @cached_property
+    def stop_times_table(self) -> pa.Table:
+        return filter_is_in(self.read_table('stop_times'), 'trip_id', pc.unique(self.trips_table['trip_id']))
+
+    @cached_property
+    def trips(self):
+        return self.to_pandas('trips', self.trips_table)
+
+    @cached_property
+    def routes(self):
+        return self.to_pandas('routes', self.routes_table)
+
+    @cached_property
+    def agency(self):
+        table = filter_is_in(self.read_table('agency'), 'agency_id', pc.unique(self.routes_table['agency_id']))
+        return self.to_pandas('agency', table)
+
+    @cached_property
+    def stops(self):
+        if 'stop_times_table' in self.__dict__:
+            stop_times = self.stop_times_table
+        else:
+            # only the columns needed for pruning the stops are read
+            stop_times = filter_is_in(self.read_table('stop_times', ['trip_id', 'stop_id']), 'trip_id', pc.unique(self.trips_table['trip_id']))
+        return self.to_pandas('stops', filter_is_in(self.read_table('stops'), 'stop_id', pc.unique(stop_times['stop_id'])))
+
+    @cached_property
+    def stop_times(self):
+        return self.to_pandas('stop_times', self.stop_times_table)
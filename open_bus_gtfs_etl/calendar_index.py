@@ -0,0 +1,127 @@
+import os
+import json
+import hashlib
+import datetime
+from pathlib import Path
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from . import common
+
+
+CALENDAR_INDEX_FILE_NAME = '.calendar_index.json'
+FEED_HASH_FILE_NAMES = ['calendar.txt', 'calendar_dates.txt', 'trips.txt']
+WEEKDAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+
+
+def get_feed_files_key(gtfs_path: str):
+    """Returns the size and modification time of the feed files which the feed hash is based on"""
+    key = []
+    for file_name in FEED_HASH_FILE_NAMES:
+        try:
+            stat = os.stat(Path(gtfs_path, file_name))
+        except FileNotFoundError:
+            key.append((file_name, None, None))
+        else:
+            key.append((file_name, stat.st_size, stat.st_mtime_ns))
+    return tuple(key)
+
+
+def get_feed_hash(gtfs_path: Path):
+    """Returns sha256 of the feed files which the calendar index is based on, the hash is calculated once
+    per feed directory and calculated again only if the size / modification time of the files changed"""
+    gtfs_path = os.path.abspath(gtfs_path)
+    return calculate_feed_hash(gtfs_path, get_feed_files_key(gtfs_path))
+
+
+@lru_cache(maxsize=8)
+def calculate_feed_hash(gtfs_path: str, files_key: tuple):
+    feed_hash = hashlib.sha256()
+    for file_name in FEED_HASH_FILE_NAMES:
+        file_path = Path(gtfs_path, file_name)
+        feed_hash.update(file_name.encode())
+        if file_path.exists():
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                    feed_hash.update(chunk)
+    return feed_hash.hexdigest()
+
+
+def get_active_service_dates(gtfs_path: Path) -> pd.DataFrame:
+    """Returns dataframe of (date, service_id) for all the dates in the feed's validity window"""
+    calendar = pd.read_csv(Path(gtfs_path, 'calendar.txt'), dtype={'service_id': str})
+    calendar['date'] = [
+        pd.date_range(pd.to_datetime(str(start_date), format='%Y%m%d'), pd.to_datetime(str(end_date), format='%Y%m%d'))
+        for start_date, end_date in zip(calendar['start_date'], calendar['end_date'])
+    ]
+    calendar = calendar.explode('date').dropna(subset=['date']).reset_index(drop=True)
+    calendar['date'] = pd.to_datetime(calendar['date'])
+    is_active = calendar[WEEKDAYS].to_numpy()[np.arange(len(calendar)), calendar['date'].dt.weekday.to_numpy()] == 1
+    service_dates = calendar.loc[is_active, ['date', 'service_id']]
+    calendar_dates_path = Path(gtfs_path, 'calendar_dates.txt')
+    if calendar_dates_path.exists():
+        calendar_dates = pd.read_csv(calendar_dates_path, dtype={'service_id': str})
+        calendar_dates['date'] = pd.to_datetime(calendar_dates['date'].astype(str), format='%Y%m%d')
+        added = calendar_dates.loc[calendar_dates['exception_type'] == 1, ['date', 'service_id']]
+        removed = calendar_dates.loc[calendar_dates['exception_type'] == 2, ['date', 'service_id']]
+        service_dates = pd.concat([service_dates, added]).drop_duplicates()
+        service_dates = service_dates.merge(removed, on=['date', 'service_id'], how='left', indicator=True)
+        service_dates = service_dates.loc[service_dates['_merge'] == 'left_only', ['date', 'service_id']]
+    return service_dates
+
+
+def build_index(gtfs_path: Path, feed_hash):
+    service_dates = get_active_service_dates(gtfs_path)
+    trip_counts = pd.read_csv(Path(gtfs_path, 'trips.txt'), usecols=['service_id'], dtype=str)['service_id'].value_counts()
+    service_dates['num_trips'] = service_dates['service_id'].map(trip_counts).fillna(0).astype(int)
+    service_dates['date'] = service_dates['date'].dt.strftime('%Y-%m-%d')
+    by_date = service_dates.groupby('date')
+    return {
+        'feed_hash': feed_hash,
+        'service_ids_by_date': {date: sorted(service_ids) for date, service_ids in by_date['service_id']},
+        'trip_counts_by_date': {date: int(num_trips) for date, num_trips in by_date['num_trips'].sum().items()},
+    }
+
+
+@lru_cache(maxsize=8)
+def load_index(gtfs_path: str, feed_hash):
+    index_path = Path(gtfs_path, CALENDAR_INDEX_FILE_NAME)
+    if index_path.exists():
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get('feed_hash') == feed_hash:
+            return index
+    index = build_index(Path(gtfs_path), feed_hash)
+    with common.safe_open_write(index_path, 'w') as f:
+        json.dump(index, f)
+    return index
+
+
+def get_index(gtfs_path: Path):
+    """Returns the feed's calendar index, it is stored in the extracted feed directory and rebuilt if the feed changed"""
+    gtfs_path = os.path.abspath(gtfs_path)
+    return load_index(gtfs_path, get_feed_hash(gtfs_path))
+
+
+def get_date_key(date: datetime.date):
+    return common.parse_date_str(date).strftime('%Y-%m-%d')
+
+
+def get_service_ids(gtfs_path: Path, date: datetime.date) -> set:
+    return set(get_index(gtfs_path)['service_ids_by_date'].get(get_date_key(date), []))
+
+
+def get_trip_count(gtfs_path: Path, date: datetime.date) -> int:
+    return get_index(gtfs_path)['trip_counts_by_date'].get(get_date_key(date), 0)
+
+
+def get_dates(gtfs_path: Path) -> list:
+    """Returns all the dates which have active services in the feed"""
+    return [datetime.datetime.strptime(date, '%Y-%m-%d').date() for date in sorted(get_index(gtfs_path)['service_ids_by_date'])]
+
+
+def warn_if_no_trips(gtfs_path: Path, date: datetime.date):
+    if get_trip_count(gtfs_path, date) == 0:
+        print("WARNING! the feed at {} has no trips for date {}".format(gtfs_path, get_date_key(date)))
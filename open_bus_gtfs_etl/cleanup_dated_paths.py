@@ -1,32 +1,65 @@
+import os
 import shutil
 import datetime
 from pathlib import Path
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
-from . import config, common
+from . import config, common, archive_cache
+
+
+DEFAULT_DELETE_WORKERS = 4
+
+
+def get_path_size(path):
+    """Returns number of bytes which deleting the path frees - total size of all files under the given path,
+    without following symlinks. Files with other hard links (e.g. linked from the archive cache) are not counted."""
+    total = 0
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                stat = os.lstat(os.path.join(dirpath, filename))
+            except FileNotFoundError:
+                continue
+            if stat.st_nlink == 1:
+                total += stat.st_size
+    return total
 
 
 def delete_dated_path(date, silent=False):
+    """Deletes the dated path and returns number of bytes freed"""
     if not silent:
         print("Delete: {}".format(date))
-    shutil.rmtree(common.get_dated_path(date))
+    path = common.get_dated_path(date)
+    size = get_path_size(path)
+    shutil.rmtree(path)
+    return size
+
+
+def iterate_scandir_int_names(path, num_digits):
+    try:
+        entries = list(os.scandir(path))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if len(entry.name) == num_digits and entry.name.isdigit() and entry.is_dir(follow_symlinks=False):
+            yield entry.path, int(entry.name)
 
 
 def iterate_dated_path_dates():
+    """Yields the dates of all dated paths, only scanning the YYYY/MM/DD directory levels"""
     root_folder = Path(config.GTFS_ETL_ROOT_ARCHIVES_FOLDER, config.GTFS_ARCHIVE_FOLDER)
-    for path in root_folder.rglob('**'):
-        parts = str(path.relative_to(root_folder)).split('/')
-        if len(parts) == 3:
-            try:
-                year, month, day = map(int, parts)
-            except Exception:
-                pass
-            else:
-                yield datetime.date(year, month, day)
+    for year_path, year in iterate_scandir_int_names(root_folder, 4):
+        for month_path, month in iterate_scandir_int_names(year_path, 2):
+            for _, day in iterate_scandir_int_names(month_path, 2):
+                try:
+                    yield datetime.date(year, month, day)
+                except ValueError:
+                    pass
 
 
-def main(num_days_keep, num_weeklies_keep, silent=False):
-    stats = defaultdict(int)
+def get_plan(num_days_keep, num_weeklies_keep, stats):
+    """Returns list of (date, reason) tuples of the dated paths to delete"""
     weekly_dates = []
     delete_dates = []
     for date in iterate_dated_path_dates():
@@ -34,11 +67,9 @@ def main(num_days_keep, num_weeklies_keep, silent=False):
             stats['Keep dates within number of last days to keep'] += 1
         elif date + datetime.timedelta(days=num_weeklies_keep * 7) <= datetime.date.today():
             stats['Delete dates older then number of weeklies to keep'] += 1
-            delete_dates.append(date)
+            delete_dates.append((date, 'older then number of weeklies to keep'))
         else:
             weekly_dates.append(date)
-    for date in delete_dates:
-        delete_dated_path(date, silent=silent)
     last_date = None
     for date in sorted(weekly_dates):
         if last_date is None or last_date + datetime.timedelta(days=7) <= date:
@@ -46,6 +77,27 @@ def main(num_days_keep, num_weeklies_keep, silent=False):
             last_date = date
         else:
             stats['Delete dates not kept in weeklies'] += 1
-            delete_dated_path(date, silent=silent)
-    if not silent:
+            delete_dates.append((date, 'not kept in weeklies'))
+    return sorted(delete_dates)
+
+
+def main(num_days_keep, num_weeklies_keep, silent=False, dry_run=False, delete_workers=None):
+    if not delete_workers:
+        delete_workers = DEFAULT_DELETE_WORKERS
+    stats = defaultdict(int)
+    delete_plan = get_plan(num_days_keep, num_weeklies_keep, stats)
+    if dry_run:
+        for date, reason in delete_plan:
+            path = common.get_dated_path(date)
+            size = get_path_size(path)
+            stats['Bytes to free'] += size
+            print("Would delete ({}): {} ({} bytes)".format(reason, path, size))
+    else:
+        with ThreadPoolExecutor(max_workers=int(delete_workers)) as executor:
+            for size in executor.map(lambda date: delete_dated_path(date, silent=silent), [date for date, _ in delete_plan]):
+                stats['Bytes freed'] += size
+        for k, v in archive_cache.evict(silent=silent).items():
+            stats[k] += v
+    if not silent or dry_run:
         print(dict(stats))
+    return stats
@@ -1,19 +1,5 @@
 import click
 
-from . import (
-    download_extract_upload as download_extract_api,
-    load_stops_to_db as load_stops_to_db_api,
-    load_routes_to_db as load_routes_to_db_api,
-    load_trips_to_db as load_trips_to_db_api,
-    load_stop_times_to_db as load_stop_times_to_db_api,
-    cleanup_dated_paths as cleanup_dated_paths_api,
-    cleanup_workdir as cleanup_workdir_api,
-    idempotent_process as idempotent_process_api,
-    idempotent_download_upload as idempotent_download_upload_api,
-    update_gtfs_data_db as update_gtfs_data_db_api,
-    reprocess_data as reprocess_data_api,
-)
-
 
 @click.group()
 def main():
@@ -34,13 +20,15 @@ def main():
 def download_extract(**kwargs):
     """Downloads the daily gtfs data, store in a directory structure: gtfs_data/YEAR/MONTH/DAY
     and extract to dated workdir"""
-    download_extract_api.main(**kwargs)
+    from . import download_extract_upload as download_extract_upload_api
+    download_extract_upload_api.main(**kwargs)
 
 
 @main.command()
 @click.option('--date', type=str, help="Date string (%Y-%m-%d) to analyze. If not provided uses current date")
 def load_stops_to_db(**kwargs):
     """Must run after extract command - loads the gtfs stops to DB from workdir"""
+    from . import load_stops_to_db as load_stops_to_db_api
     load_stops_to_db_api.main(**kwargs)
 
 
@@ -48,6 +36,7 @@ def load_stops_to_db(**kwargs):
 @click.option('--date', type=str, help="Date string (%Y-%m-%d) to analyze. If not provided uses current date")
 def load_routes_to_db(**kwargs):
     """Must run after extract command - loads the gtfs routes to DB from workdir"""
+    from . import load_routes_to_db as load_routes_to_db_api
     load_routes_to_db_api.main(**kwargs)
 
 
@@ -56,6 +45,7 @@ def load_routes_to_db(**kwargs):
 def load_trips_to_db(**kwargs):
     """Must run after load-routes-to-db -
     loads the gtfs trips to DB from workdir and combines with routes in DB"""
+    from . import load_trips_to_db as load_trips_to_db_api
     load_trips_to_db_api.main(**kwargs)
 
 
@@ -63,17 +53,88 @@ def load_trips_to_db(**kwargs):
 @click.option('--date', type=str, help="Date string (%Y-%m-%d) to analyze. If not provided uses current date")
 @click.option('--limit', type=int, help="Limit the number of rows to process (for debugging)")
 @click.option('--debug', is_flag=True, help="Output debugging details (should be used with limit to prevent flood of logs)")
+@click.option('--resume', is_flag=True, help="Skip routes which were completed by a previous interrupted run (according to the date's checkpoint)")
+@click.option('--use-index', is_flag=True, help="Read the stop times of the date's trips using the stop_times index (default: GTFS_ETL_STOP_TIMES_INDEX)")
 def load_stop_times_to_db(**kwargs):
     """Must run after load-trips-to-db and load-stops-to-db -
     loads the gtfs stop_times to DB and combines with rides and stops in DB"""
+    from . import load_stop_times_to_db as load_stop_times_to_db_api
     load_stop_times_to_db_api.main(**kwargs)
 
 
+@main.command()
+@click.option('--date', type=str, help="Date string (%Y-%m-%d) to analyze. If not provided uses current date")
+@click.option('--dataset', type=click.Choice(['trip_id_to_date', 'cluster_to_line', 'tariff']), multiple=True,
+              help="Dataset to load, can be specified multiple times. If not provided loads all datasets")
+def load_mot_datasets_to_db(date, dataset):
+    """Must run after extract command - loads the additional MOT datasets (TripIdToDate, ClusterToLine, Tariff) to DB"""
+    from . import load_mot_datasets_to_db as load_mot_datasets_to_db_api
+    for dataset_name in (dataset or load_mot_datasets_to_db_api.MOT_DATASETS):
+        load_mot_datasets_to_db_api.main(date, dataset_name)
+
+
+@main.command()
+@click.option('--date', type=str, help="Date string (%Y-%m-%d) to analyze. If not provided uses current date")
+def load_atomic_to_db(**kwargs):
+    """Must run after extract command - loads all the gtfs data for the date to staging tables
+    and publishes it to the DB in a single transaction"""
+    from . import load_atomic_to_db as load_atomic_to_db_api
+    load_atomic_to_db_api.main(**kwargs)
+
+
+@main.command()
+@click.option('--date', type=str, help="Date string (%Y-%m-%d) of the extracted feed. If not provided uses current date")
+@click.option('--trip-id', 'trip_ids', multiple=True, help="Print the stop times of the trip, can be specified multiple times")
+@click.option('--route-id', 'route_ids', multiple=True, help="Print the stop times of the route's trips, can be specified multiple times")
+def stop_times_index(**kwargs):
+    """Must run after extract command - builds the byte offsets index of stop_times.txt by trip_id (if needed)
+    and prints the stop times of the given trips / routes"""
+    from . import stop_times_index as stop_times_index_api
+    stop_times_index_api.main(**kwargs)
+
+
+LOADERS = ['stops', 'routes', 'trips', 'stop_times', 'trip_id_to_date', 'cluster_to_line', 'tariff']
+
+
+@main.command()
+@click.option('--date', type=str, help="Date string (%Y-%m-%d) to analyze. If not provided uses current date")
+@click.option('--loader', 'loaders', type=click.Choice(LOADERS), multiple=True,
+              help="Loader to run, can be specified multiple times. If not provided runs all loaders")
+@click.option('--max-workers', type=int, help="Max number of loaders to run concurrently, defaults to the resources tuning")
+@click.option('--resume', is_flag=True, help="Resume the stop times of a previous interrupted run")
+def run_loaders(**kwargs):
+    """Must run after extract command - runs the loaders, independent loaders run concurrently"""
+    from . import loaders_dag as loaders_dag_api
+    loaders_dag_api.main(**kwargs)
+
+
+@main.command()
+@click.option('--loader', 'loaders', type=click.Choice(LOADERS), multiple=True,
+              help="Loader to include, can be specified multiple times. If not provided includes all loaders")
+@click.option('--airflow', is_flag=True, help="Print the graph as dags.yaml tasks")
+def loaders_graph(**kwargs):
+    """Prints the dependencies graph of the loaders as json"""
+    from . import loaders_dag as loaders_dag_api
+    loaders_dag_api.print_graph(**kwargs)
+
+
+@main.command()
+@click.option('--date', type=str, help="Date string (%Y-%m-%d) to export. If not provided uses current date")
+@click.option('--upload', is_flag=True, help="Upload the parquet files to S3 under the date's gtfs_archive path")
+def export_parquet(**kwargs):
+    """Must run after extract command - exports the date's stops, routes, rides and ride stops to parquet files"""
+    from . import export_parquet as export_parquet_api
+    export_parquet_api.main(**kwargs)
+
+
 @main.command()
 @click.option('--num-days-keep', default=5, help='keeps a directory per day for this many last days')
 @click.option('--num-weeklies-keep', default=4, help='keeps a single directory per week for this many weeks')
+@click.option('--dry-run', is_flag=True, help="Print the directories which would be deleted without deleting them")
+@click.option('--delete-workers', type=int, help="Number of directories to delete in parallel, defaults to 4")
 def cleanup_dated_paths(**kwargs):
     """Delete old directories from the dated paths"""
+    from . import cleanup_dated_paths as cleanup_dated_paths_api
     cleanup_dated_paths_api.main(**kwargs)
 
 
@@ -81,18 +142,29 @@ def cleanup_dated_paths(**kwargs):
 @click.option('--date', type=str, help="Date string (%Y-%m-%d) to cleanup. If not provided uses current date")
 def cleanup_workdir(**kwargs):
     """Deletes the dated workdir after all work was done"""
+    from . import cleanup_workdir as cleanup_workdir_api
     cleanup_workdir_api.main(**kwargs)
 
 
 @main.command()
 @click.option('--last-days')
 @click.option('--only-date')
+@click.option('--atomic', is_flag=True, help="Load each date to staging tables and publish it in a single transaction")
+@click.option('--prefetch-dates', type=int,
+              help="Number of dates to download and extract in background while the current date is loaded to DB, "
+                   "relevant only when iterating over last days")
+@click.option('--worker', is_flag=True,
+              help="Run as a process queue worker, multiple workers can run concurrently, relevant only when iterating over last days")
+@click.option('--max-dates', type=int, help="Max number of dates to process in worker mode")
+@click.option('--resume', is_flag=True, help="Resume the stop times of dates which were interrupted in a previous run")
 def idempotent_process(**kwargs):
+    from . import idempotent_process as idempotent_process_api
     idempotent_process_api.main(**kwargs)
 
 
 @main.command()
 def idempotent_download_upload():
+    from . import idempotent_download_upload as idempotent_download_upload_api
     idempotent_download_upload_api.main()
 
 
@@ -103,11 +175,26 @@ def idempotent_download_upload():
 @click.option('--only-date')
 def update_gtfs_data_db(**kwargs):
     """Update the gtfs data in the DB from the S3 bucket / the GTFS db tables"""
+    from . import update_gtfs_data_db as update_gtfs_data_db_api
     update_gtfs_data_db_api.main(**kwargs)
 
 
 @main.command()
 @click.argument("DATES", nargs=-1)
-def reprocess_data(dates):
-    """Reprocess data for given dates"""
-    reprocess_data_api.main(dates)
+@click.option('--dry-run', is_flag=True, help="Only collect and print the number of rows to purge")
+@click.option('--batch-size', default=5000, help="Number of ids to delete / update in each transaction")
+def reprocess_data(dates, **kwargs):
+    """Delete all GTFS data of given dates from DB and mark them for reprocessing"""
+    from . import reprocess_data as reprocess_data_api
+    reprocess_data_api.main(dates, **kwargs)
+
+
+@main.command()
+@click.option('--command', multiple=True, help="Command to benchmark, can be specified multiple times. If not provided benchmarks all commands")
+@click.option('--repeats', default=3, help="Number of times to start each command, the median is reported")
+@click.option('--top', default=5, help="Number of slowest top level imports to show for each command")
+@click.option('--max-seconds', type=float, help="Fail if the startup of any command takes longer than this")
+def startup_benchmark(**kwargs):
+    """Measures the cold start latency of the cli commands using python -X importtime"""
+    from . import startup_benchmark as startup_benchmark_api
+    startup_benchmark_api.main(**kwargs)
@@ -1,13 +1,13 @@
 import os
+import fcntl
+import signal
 import shutil
+import threading
 import tempfile
 import datetime
 from pathlib import Path
 from contextlib import contextmanager
 
-import psutil
-import requests
-
 from . import config
 
 
@@ -20,7 +20,21 @@ def safe_open_write(filename, *args, **kwargs):
         shutil.move(temp_filename, filename)
 
 
+@contextmanager
+def file_lock(lock_path, shared=False):
+    """Holds an exclusive (or shared) lock on the lock file while the block runs, so that it's synchronized
+    between threads and processes on the same host"""
+    os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+    with open(lock_path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
 def http_stream_download(filename, **requests_kwargs):
+    import requests
     with requests.get(stream=True, **requests_kwargs) as res:
         res.raise_for_status()
         os.makedirs(os.path.dirname(filename), exist_ok=True)
@@ -78,9 +92,44 @@ def print_memory_usage(start_msg, end_msg="Done", silent=False):
         print(start_msg)
     yield
     if not silent:
+        import psutil
         print("{}. Resident memory: {}mb".format(end_msg, psutil.Process().memory_info().rss / (1024 * 1024)))
 
 
+# set by the graceful_sigterm handler, shared by all threads
+sigterm_received = threading.Event()
+
+# set to abort the current run (e.g. when the process queue lease of the date was lost),
+# the loaders stop after their current batch like on SIGTERM, but the process keeps running
+run_aborted = threading.Event()
+
+
+def is_stop_requested():
+    return sigterm_received.is_set() or run_aborted.is_set()
+
+
+def graceful_sigterm_handler(signum, frame):
+    print("Received SIGTERM, will stop after the current batch")
+    sigterm_received.set()
+
+
+@contextmanager
+def graceful_sigterm():
+    """Defers SIGTERM handling while the block runs - yields an event which is set when SIGTERM was received,
+    so that the block can finish its current batch and stop. The handler can only be installed from the main thread,
+    blocks running in other threads get the event of the handler installed by the main thread (e.g. by loaders_dag)."""
+    if threading.current_thread() is not threading.main_thread():
+        yield sigterm_received
+        return
+    previous_handler = signal.signal(signal.SIGTERM, graceful_sigterm_handler)
+    if previous_handler is not graceful_sigterm_handler:
+        sigterm_received.clear()
+    try:
+        yield sigterm_received
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+
+
 class UserError(Exception):
     """
     Exception that represent error caused by wrong input of user
@@ -8,12 +8,58 @@ GTFS_ETL_ROOT_ARCHIVES_FOLDER = Path(os.environ.get('GTFS_ETL_ROOT_ARCHIVES_FOLD
 
 GTFS_ARCHIVE_FOLDER = 'gtfs_archive'
 
+# content-addressed cache of files downloaded from stride, shared by all dates / processes on the same host
+# entries are evicted (least recently used first) when the cache size exceeds the max bytes, 0 disables the cache
+ARCHIVE_CACHE_FOLDER = 'archive_cache'
+GTFS_ETL_ARCHIVE_CACHE_MAX_BYTES = int(os.environ.get('GTFS_ETL_ARCHIVE_CACHE_MAX_BYTES') or 10 * 1024 * 1024 * 1024)
+
 WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION = 'israel-public-transportation'
 WORKDIR_TARIFF = 'Tariff'
 WORKDIR_CLUSTER_TO_LINE = 'ClusterToLine'
 WORKDIR_TRIP_ID_TO_DATE = 'TripIdToDate'
 WORKDIR_ANALYZED_OUTPUT = 'analyzed'
 
+# checkpoints of load_stop_times_to_db, stored under the root archives folder by date and feed hash,
+# so that they survive the (temporary) workdir of an interrupted run
+STOP_TIMES_CHECKPOINTS_FOLDER = 'stop_times_checkpoints'
+WORKDIR_PARQUET = 'parquet'
+
+# the engine used to parse the gtfs feed tables: "partridge" (default) or "arrow" (pyarrow multithreaded csv reader)
+GTFS_ETL_FEED_ENGINE = os.environ.get('GTFS_ETL_FEED_ENGINE') or 'partridge'
+
+# the engine used to transform stop times to ride stops in load_stop_times_to_db:
+# "python" (default) or "duckdb" (in-process multithreaded SQL, requires the duckdb package)
+GTFS_ETL_TRANSFORM_ENGINE = os.environ.get('GTFS_ETL_TRANSFORM_ENGINE') or 'python'
+
+# loaders write to DB in batches which are committed separately (see db_helper.WriteBatcher), the batch rows start
+# from GTFS_ETL_WRITE_BATCH_ROWS and adapt (between the min and max rows) so that each flush takes about the target seconds,
+# dataframe batches are also limited by max bytes
+GTFS_ETL_WRITE_BATCH_ROWS = int(os.environ.get('GTFS_ETL_WRITE_BATCH_ROWS') or 20000)
+GTFS_ETL_WRITE_BATCH_MIN_ROWS = int(os.environ.get('GTFS_ETL_WRITE_BATCH_MIN_ROWS') or 1000)
+GTFS_ETL_WRITE_BATCH_MAX_ROWS = int(os.environ.get('GTFS_ETL_WRITE_BATCH_MAX_ROWS') or 500000)
+GTFS_ETL_WRITE_BATCH_MAX_BYTES = int(os.environ.get('GTFS_ETL_WRITE_BATCH_MAX_BYTES') or 64 * 1024 * 1024)
+GTFS_ETL_WRITE_BATCH_TARGET_SECONDS = float(os.environ.get('GTFS_ETL_WRITE_BATCH_TARGET_SECONDS') or 2)
+
+# when enabled, stop times of the date's trips are read using a byte offsets index of stop_times.txt by trip_id,
+# which is stored next to the extracted feed (see stop_times_index.py), instead of scanning the whole file
+GTFS_ETL_STOP_TIMES_INDEX = os.environ.get('GTFS_ETL_STOP_TIMES_INDEX') == 'yes'
+
+# resources tuning overrides, by default the values are chosen according to the available memory / cpus (see resources.py)
+# max number of loaders of a date which run concurrently (see loaders_dag)
+GTFS_ETL_LOADERS_MAX_WORKERS = int(os.environ.get('GTFS_ETL_LOADERS_MAX_WORKERS') or 0)
+# size of the chunks in which stop_times.txt is read when prefiltering by trip ids
+GTFS_ETL_STOP_TIMES_CHUNK_BYTES = int(os.environ.get('GTFS_ETL_STOP_TIMES_CHUNK_BYTES') or 0)
+# number of threads used by the arrow feed engine csv parser and the duckdb transform engine
+GTFS_ETL_PARSER_THREADS = int(os.environ.get('GTFS_ETL_PARSER_THREADS') or 0)
+
+# idempotent processing worker mode (see process_queue) - seconds until the lease of a claimed date expires
+# (it's renewed by a heartbeat while the date is processed) and max attempts of a failed date
+GTFS_ETL_PROCESS_QUEUE_LEASE_SECONDS = int(os.environ.get('GTFS_ETL_PROCESS_QUEUE_LEASE_SECONDS') or 600)
+GTFS_ETL_PROCESS_QUEUE_MAX_ATTEMPTS = int(os.environ.get('GTFS_ETL_PROCESS_QUEUE_MAX_ATTEMPTS') or 3)
+
+# when enabled, the idempotent processing exports each processed date to Parquet and uploads it to S3
+GTFS_ETL_EXPORT_PARQUET = os.environ.get('GTFS_ETL_EXPORT_PARQUET') == 'yes'
+
 OPEN_BUS_STRIDE_PUBLIC_S3_BUCKET_NAME = os.environ.get('OPEN_BUS_STRIDE_PUBLIC_S3_BUCKET_NAME') or 'openbus-stride-public'
 OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_ACCESS_KEY_ID = os.environ.get('OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_ACCESS_KEY_ID')
 OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_SECRET_ACCESS_KEY = os.environ.get('OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_SECRET_ACCESS_KEY')
@@ -0,0 +1,163 @@
+import io
+import time
+from textwrap import dedent
+from contextlib import contextmanager
+
+import pandas as pd
+
+from . import config
+
+
+COPY_CHUNK_ROWS = 100000
+STREAM_PARTITION_ROWS = 50000
+
+
+def copy_dataframe(session, table_name, df, columns=None):
+    """Bulk inserts the dataframe to the given table using postgresql COPY,
+    empty / NaN values are inserted as NULL"""
+    columns = list(columns) if columns else list(df.columns)
+    cursor = session.connection().connection.cursor()
+    try:
+        for start in range(0, len(df), COPY_CHUNK_ROWS):
+            buf = io.StringIO()
+            df[columns].iloc[start:start + COPY_CHUNK_ROWS].to_csv(buf, index=False, header=False)
+            buf.seek(0)
+            cursor.copy_expert('copy {} ({}) from stdin with (format csv)'.format(table_name, ', '.join(columns)), buf)
+    finally:
+        cursor.close()
+    return len(df)
+
+
+def drop_table(session, table_name):
+    session.execute('drop table if exists {}'.format(table_name))
+
+
+def create_unlogged_table(session, table_name, columns_sql):
+    drop_table(session, table_name)
+    session.execute(dedent("""
+        create unlogged table {} ({})
+    """.format(table_name, columns_sql)))
+
+
+def create_temp_table(session, table_name, columns_sql):
+    """Creates a temporary table which is dropped on commit"""
+    session.execute(dedent("""
+        create temp table {} ({}) on commit drop
+    """.format(table_name, columns_sql)))
+
+
+def update_dataframe(session, table_name, df, columns, key_column='id'):
+    """Bulk updates the given columns of the table rows matching the dataframe key column values,
+    using COPY to a temporary table with the same column types and a single update statement.
+    Returns the number of updated rows"""
+    temp_table_name = 'gtfs_etl_update_{}'.format(table_name)
+    drop_table(session, temp_table_name)
+    session.execute(dedent("""
+        create temp table {} on commit drop as select {}, {} from {} limit 0
+    """.format(temp_table_name, key_column, ', '.join(columns), table_name)))
+    copy_dataframe(session, temp_table_name, df, [key_column, *columns])
+    return session.execute(dedent("""
+        update {} t set {}
+        from {} u
+        where t.{} = u.{}
+    """.format(
+        table_name, ', '.join('{} = u.{}'.format(column, column) for column in columns),
+        temp_table_name, key_column, key_column
+    ))).rowcount
+
+
+def iterate_rows(session, statement, partition_rows=STREAM_PARTITION_ROWS):
+    """Yields the result rows of the given sql / select statement,
+    the rows are fetched from a server side cursor in partitions, without creating ORM objects"""
+    result = session.execute(statement, execution_options={'stream_results': True})
+    for partition in result.partitions(partition_rows):
+        yield from partition
+
+
+def get_dataframe(session, statement, partition_rows=STREAM_PARTITION_ROWS):
+    """Returns the results of the given sql / select statement as a dataframe, streamed from a server side cursor"""
+    result = session.execute(statement, execution_options={'stream_results': True})
+    columns = list(result.keys())
+    rows = []
+    for partition in result.partitions(partition_rows):
+        rows.extend(partition)
+    return pd.DataFrame.from_records(rows, columns=columns)
+
+
+class WriteBatcher:
+    """Splits the DB writes of a loader to batches which are committed separately, so that transactions,
+    WAL bursts and lock hold times are bounded. The batch rows adapt to the observed flush latency -
+    after each flush the target rows is scaled towards the target seconds (by x0.5 - x2), within the min / max rows.
+    Rows can be added one by one (flushed with flush_func(rows) when the batch is full),
+    or written as dataframe slices (see iterate_dataframe_batches / write_dataframe_batches).
+    Batch statistics are added to stats, prefixed with the batcher name."""
+
+    def __init__(self, name, stats, flush_func=None, target_rows=None, min_rows=None, max_rows=None, max_bytes=None, target_seconds=None):
+        self.name = name
+        self.stats = stats
+        self.flush_func = flush_func
+        self.target_rows = int(target_rows or config.GTFS_ETL_WRITE_BATCH_ROWS)
+        self.min_rows = int(min_rows or config.GTFS_ETL_WRITE_BATCH_MIN_ROWS)
+        self.max_rows = int(max_rows or config.GTFS_ETL_WRITE_BATCH_MAX_ROWS)
+        self.max_bytes = int(max_bytes or config.GTFS_ETL_WRITE_BATCH_MAX_BYTES)
+        self.target_seconds = float(target_seconds or config.GTFS_ETL_WRITE_BATCH_TARGET_SECONDS)
+        self.rows = []
+
+    @contextmanager
+    def timed_flush(self, num_rows):
+        start_time = time.monotonic()
+        yield
+        seconds = time.monotonic() - start_time
+        self.stats[f'{self.name} write batches'] += 1
+        self.stats[f'{self.name} write batch rows'] += num_rows
+        self.stats[f'{self.name} write batch total seconds'] = round(self.stats[f'{self.name} write batch total seconds'] + seconds, 3)
+        self.stats[f'{self.name} write batch max seconds'] = round(max(self.stats[f'{self.name} write batch max seconds'], seconds), 3)
+        # batches which are smaller than the target rows (e.g. the last batch) don't indicate the latency of a full batch
+        if num_rows >= self.target_rows:
+            ratio = min(2.0, max(0.5, self.target_seconds / max(seconds, 0.001)))
+            self.target_rows = min(self.max_rows, max(self.min_rows, int(self.target_rows * ratio)))
+        self.stats[f'{self.name} write batch target rows'] = self.target_rows
+
+    def add(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.target_rows:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            rows, self.rows = self.rows, []
+            with self.timed_flush(len(rows)):
+                self.flush_func(rows)
+
+    def iterate_dataframe_batches(self, df):
+        """Yields slices of the dataframe sized by the current target rows (and max bytes),
+        the time until the next slice is requested is the slice's flush latency"""
+        if len(df) == 0:
+            return
+        sample = df.head(1000)
+        row_bytes = max(1, int(sample.memory_usage(deep=True).sum() / len(sample)))
+        start = 0
+        while start < len(df):
+            batch = df.iloc[start:start + max(1, min(self.target_rows, self.max_bytes // row_bytes))]
+            with self.timed_flush(len(batch)):
+                yield batch
+            start += len(batch)
+
+
+def write_dataframe_batches(session, batcher, df, write_func):
+    """Calls write_func(batch) for each batch of the dataframe (see WriteBatcher.iterate_dataframe_batches)
+    and commits it, returns the sum of the write_func results"""
+    total = 0
+    for batch in batcher.iterate_dataframe_batches(df):
+        total += write_func(batch)
+        session.commit()
+    return total
+
+
+def get_table_count(session, table_name):
+    return list(session.execute('select count(1) from {}'.format(table_name)))[0][0]
+
+
+def get_gtfs_datetime_sql(date, seconds_column):
+    """Returns sql which converts gtfs time (seconds since start of service day) to a timestamp in Israel timezone"""
+    return "(date '{}' + make_interval(secs => {})) at time zone 'Israel'".format(date.strftime('%Y-%m-%d'), seconds_column)
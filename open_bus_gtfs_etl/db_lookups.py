@@ -0,0 +1,77 @@
+from sqlalchemy import select
+
+from open_bus_stride_db import model
+
+from . import db_helper
+
+
+# column-only lookups of the date's existing DB keys, streamed without creating ORM objects
+
+
+def get_stops_dataframe(session, date):
+    """Returns dataframe with the date's stops id and code"""
+    return db_helper.get_dataframe(session, select(
+        model.GtfsStop.id, model.GtfsStop.code
+    ).where(model.GtfsStop.date == date)).astype({'id': int, 'code': int})
+
+
+def get_stop_mot_ids_dataframe(session, date):
+    """Returns dataframe with the date's stops id, code and mot_id"""
+    return db_helper.get_dataframe(session, select(
+        model.GtfsStop.id, model.GtfsStop.code, model.GtfsStopMotId.mot_id
+    ).select_from(model.GtfsStop).join(model.GtfsStopMotId, model.GtfsStopMotId.gtfs_stop_id == model.GtfsStop.id).where(
+        model.GtfsStop.date == date
+    )).astype({'id': int, 'code': int, 'mot_id': int})
+
+
+def get_gtfs_stop_ids_by_mot_id(session, date):
+    return {
+        int(mot_id): gtfs_stop_id
+        for gtfs_stop_id, mot_id
+        in db_helper.iterate_rows(session, select(
+            model.GtfsStop.id, model.GtfsStopMotId.mot_id
+        ).select_from(model.GtfsStop).join(model.GtfsStopMotId, model.GtfsStopMotId.gtfs_stop_id == model.GtfsStop.id).where(
+            model.GtfsStop.date == date
+        ))
+    }
+
+
+def get_routes_dataframe(session, date):
+    """Returns dataframe with the date's routes id and line_ref"""
+    return db_helper.get_dataframe(session, select(
+        model.GtfsRoute.id, model.GtfsRoute.line_ref
+    ).where(model.GtfsRoute.date == date)).astype({'id': int, 'line_ref': int})
+
+
+def get_gtfs_route_ids_by_line_ref(session, date):
+    return {
+        int(line_ref): gtfs_route_id
+        for gtfs_route_id, line_ref
+        in db_helper.iterate_rows(session, select(
+            model.GtfsRoute.id, model.GtfsRoute.line_ref
+        ).where(model.GtfsRoute.date == date))
+    }
+
+
+def get_gtfs_route_ids_ride_ids_by_journey_ref(session, date):
+    return {
+        journey_ref: (gtfs_route_id, gtfs_ride_id)
+        for gtfs_ride_id, gtfs_route_id, journey_ref
+        in db_helper.iterate_rows(session, select(
+            model.GtfsRide.id, model.GtfsRide.gtfs_route_id, model.GtfsRide.journey_ref
+        ).select_from(model.GtfsRide).join(model.GtfsRoute, model.GtfsRoute.id == model.GtfsRide.gtfs_route_id).where(
+            model.GtfsRoute.date == date
+        ))
+    }
+
+
+def get_gtfs_ride_stop_ids_by_gtfs_ride_id_gtfs_stop_id(session, gtfs_route_id):
+    return {
+        (gtfs_ride_id, gtfs_stop_id): gtfs_ride_stop_id
+        for gtfs_ride_stop_id, gtfs_ride_id, gtfs_stop_id
+        in db_helper.iterate_rows(session, select(
+            model.GtfsRideStop.id, model.GtfsRideStop.gtfs_ride_id, model.GtfsRideStop.gtfs_stop_id
+        ).select_from(model.GtfsRideStop).join(model.GtfsRide, model.GtfsRide.id == model.GtfsRideStop.gtfs_ride_id).where(
+            model.GtfsRide.gtfs_route_id == gtfs_route_id
+        ))
+    }
@@ -1,19 +1,27 @@
 import os
 import datetime
 
-from . import common, config, gtfs_extractor
+from . import common, config, gtfs_extractor, archive_cache, upload_to_s3
 
 
-def from_mot(archive_folder=None):
+def from_mot(archive_folder=None, only_missing=False, stream_upload=False):
+    """if stream_upload is set, the files are uploaded to temporary S3 keys while they are downloaded,
+    upload_to_s3.main_finish_stream_upload should be called after the files were verified"""
     date: datetime.date = datetime.date.today()
     if not archive_folder:
         archive_folder = common.get_dated_path(date)
     print("Downloading GTFS files to archive folder: {}".format(archive_folder))
-    gtfs_extractor.GtfsRetriever(archive_folder).retrieve_gtfs_files()
+    if stream_upload:
+        def stream_upload_func(local_name):
+            basename, ext = os.path.splitext(local_name)
+            return upload_to_s3.start_stream_upload(date, basename, ext.lstrip('.'))
+    else:
+        stream_upload_func = None
+    gtfs_extractor.GtfsRetriever(archive_folder, stream_upload_func=stream_upload_func).retrieve_gtfs_files(only_missing=only_missing)
     return date
 
 
-def from_stride(date, force_download, silent=False, archive_folder=None):
+def from_stride(date, force_download, silent=False, archive_folder=None, refresh_cache=False):
     date = common.parse_date_str(date)
     assert date, 'must provide date or download analyzed data'
     s3_path = common.get_s3_path('gtfs_archive', date.strftime("%Y/%m/%d"))
@@ -35,5 +43,5 @@ def from_stride(date, force_download, silent=False, archive_folder=None):
         if os.path.exists(path) and not force_download:
             print("File already exists: {}".format(path))
         else:
-            common.http_stream_download(path, url=url)
+            archive_cache.download(url, f'{s3_path}/{filename}', path, silent=silent, refresh=refresh_cache)
     return date
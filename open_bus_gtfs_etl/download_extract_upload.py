@@ -2,11 +2,13 @@ import os
 import time
 import traceback
 
-from . import download, extract, upload_to_s3
+from . import common, download, extract, upload_to_s3
 
 
 def main(from_mot=False, from_stride=False, date=None, force_download=False, num_retries=None,
-         retry_sleep_seconds=120, silent=False, target_path=None):
+         retry_sleep_seconds=120, silent=False, target_path=None, stream_upload=False):
+    """if stream_upload is set (only with from_mot), the files are uploaded to S3 while they are downloaded
+    and renamed to their final S3 keys only after they were extracted successfully"""
     if from_mot:
         assert not from_stride, 'must choose either from_mot or from_stride, but not both'
         assert not date, 'must not specify date when choosing from_mot - it always downloads latest data'
@@ -15,8 +17,9 @@ def main(from_mot=False, from_stride=False, date=None, force_download=False, num
             num_retries=10
     else:
         assert from_stride, 'must choose either from_mot or from_stride, but not both'
-        assert not num_retries, 'when downloading from stride only a single retry is attempted'
-        num_retries = 1
+        if not num_retries:
+            # a single retry, which downloads the corrupted files again (bypassing the archive cache)
+            num_retries = 2
     num_retries = int(num_retries)
     retry_sleep_seconds = int(retry_sleep_seconds)
     num_failures = 0
@@ -30,19 +33,34 @@ def main(from_mot=False, from_stride=False, date=None, force_download=False, num
         if num_failures > 0:
             print(f'failure {num_failures}/{num_retries}, will try again in {retry_sleep_seconds} seconds...')
             time.sleep(retry_sleep_seconds)
+        # on retries only the files which failed to extract (and were deleted) are downloaded again
         if from_mot:
-            date = download.from_mot(archive_folder=archive_folder)
+            date = download.from_mot(archive_folder=archive_folder, only_missing=num_failures > 0, stream_upload=stream_upload)
         else:
-            date = download.from_stride(date, force_download, silent=silent, archive_folder=archive_folder)
+            date = download.from_stride(date, force_download and num_failures == 0, silent=silent,
+                                        archive_folder=archive_folder, refresh_cache=num_failures > 0)
         if not silent:
             print(f'Downloaded date: {date}, proceeding with extract..')
         try:
             extract.main(date, silent=silent, archive_folder=archive_folder, extracted_workdir=extracted_workdir)
             is_success = True
-        except extract.ExtractUnzipException:
+        except extract.ExtractUnzipException as e:
             traceback.print_exc()
+            for zip_file_name in e.zip_file_names:
+                if os.path.exists(zip_file_name):
+                    print(f'deleting corrupted file: {zip_file_name}')
+                    os.unlink(zip_file_name)
             num_failures += 1
+    if not is_success and from_mot and stream_upload:
+        upload_to_s3.main_abort_stream_upload(date)
     assert is_success
     if from_mot:
-        upload_to_s3.main(date, archive_folder=archive_folder)
+        if stream_upload:
+            try:
+                upload_to_s3.main_finish_stream_upload(date, archive_folder or common.get_dated_path(date))
+            except BaseException:
+                upload_to_s3.main_abort_stream_upload(date)
+                raise
+        else:
+            upload_to_s3.main(date, archive_folder=archive_folder)
     return extracted_workdir
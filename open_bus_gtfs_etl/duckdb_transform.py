@@ -0,0 +1,121 @@
+from pathlib import Path
+from textwrap import dedent
+from contextlib import contextmanager
+
+import pandas as pd
+
+from . import feed_frames, resources
+
+
+# number of ride stop rows fetched from duckdb in each arrow record batch
+FETCH_BATCH_ROWS = 100000
+
+
+def get_time_seconds_sql(column):
+    return "try_cast(split_part({c}, ':', 1) as integer) * 3600 + try_cast(split_part({c}, ':', 2) as integer) * 60 + try_cast(split_part({c}, ':', 3) as integer)".format(c=column)
+
+
+@contextmanager
+def connect(gtfs_path: Path, date, trip_ids, gtfs_stop_id_by_mot_ids, gtfs_route_ids_ride_ids_by_journey_ref, limit=None):
+    """Returns an in-memory duckdb connection with the date's stop times (a view on the extracted stop_times.txt)
+    and the DB key maps registered as tables, the view resolves the DB ride / route / stop ids of each stop time.
+    If limit is set, the first limit stop times (ordered by trip_id, stop_sequence) are materialized once to a table,
+    so that all the queries (ride stops and aggregates) use the same stop times."""
+    import duckdb
+    con = duckdb.connect()
+    try:
+        con.execute('set threads to {}'.format(int(resources.get_tuning()['parser_threads'])))
+        # tables are created with explicit types, so that empty key maps are also supported
+        con.execute('create table db_stops (mot_id bigint, gtfs_stop_id bigint)')
+        con.register('db_stops_df', pd.DataFrame(list(gtfs_stop_id_by_mot_ids.items()), columns=['mot_id', 'gtfs_stop_id']))
+        con.execute('insert into db_stops select * from db_stops_df')
+        con.execute('create table db_rides (journey_ref varchar, gtfs_route_id bigint, gtfs_ride_id bigint)')
+        con.register('db_rides_df', pd.DataFrame([
+            (journey_ref, gtfs_route_id, gtfs_ride_id)
+            for journey_ref, (gtfs_route_id, gtfs_ride_id) in gtfs_route_ids_ride_ids_by_journey_ref.items()
+            if journey_ref in trip_ids and gtfs_route_id and gtfs_ride_id
+        ], columns=['journey_ref', 'gtfs_route_id', 'gtfs_ride_id']))
+        con.execute('insert into db_rides select * from db_rides_df')
+        con.execute(dedent("""
+            create {source_type} source_stop_times as
+            select
+                trip_id,
+                {arrival_time} arrival_time,
+                {departure_time} departure_time,
+                cast(stop_id as integer) stop_id,
+                cast(stop_sequence as integer) stop_sequence,
+                coalesce(try_cast(pickup_type as integer), 0) pickup_type,
+                coalesce(try_cast(drop_off_type as integer), 0) drop_off_type,
+                cast(trunc(try_cast(shape_dist_traveled as double)) as bigint) shape_dist_traveled
+            from read_csv_auto('{path}', header=true, all_varchar=true)
+            where trip_id in (select journey_ref from db_rides)
+            {limit}
+        """.format(
+            source_type='table' if limit else 'view',
+            arrival_time=get_time_seconds_sql('arrival_time'),
+            departure_time=get_time_seconds_sql('departure_time'),
+            path=Path(gtfs_path, 'stop_times.txt').as_posix().replace("'", "''"),
+            limit='order by trip_id, stop_sequence limit {}'.format(int(limit)) if limit else '',
+        )))
+        con.execute(dedent("""
+            create view ride_stops as
+            select r.gtfs_route_id, r.gtfs_ride_id, s.gtfs_stop_id, st.*
+            from source_stop_times st
+            join db_rides r on r.journey_ref = st.trip_id
+            left join db_stops s on s.mot_id = st.stop_id
+        """))
+        yield con
+    finally:
+        con.close()
+
+
+def get_ride_aggregates(con) -> pd.DataFrame:
+    """Same as feed_frames.get_ride_aggregates"""
+    return con.execute(dedent("""
+        select
+            trip_id journey_ref,
+            min(stop_sequence) first_stop_sequence,
+            max(stop_sequence) last_stop_sequence,
+            arg_min(departure_time, stop_sequence) start_time
+        from source_stop_times
+        group by trip_id
+    """)).df()
+
+
+def get_num_routes(con):
+    return con.execute('select count(distinct gtfs_route_id) from ride_stops').fetchone()[0]
+
+
+def get_ride_stop_mappings(date, df: pd.DataFrame):
+    df = pd.DataFrame({
+        'gtfs_ride_id': df['gtfs_ride_id'],
+        'gtfs_stop_id': df['gtfs_stop_id'].astype(object).where(df['gtfs_stop_id'].notna(), None),
+        'arrival_time': feed_frames.get_gtfs_datetimes(date, df['arrival_time']),
+        'departure_time': feed_frames.get_gtfs_datetimes(date, df['departure_time']),
+        'stop_sequence': df['stop_sequence'],
+        'pickup_type': df['pickup_type'],
+        'drop_off_type': df['drop_off_type'],
+        'shape_dist_traveled': df['shape_dist_traveled'].astype(object).where(df['shape_dist_traveled'].notna(), None),
+    })
+    return df.to_dict('records')
+
+
+def iterate_route_ride_stops(con, date):
+    """Yields (gtfs_route_id, ride stop mappings) for each route, the transform runs in duckdb (multithreaded)
+    and the results are streamed in arrow record batches ordered by route"""
+    reader = con.execute('select * from ride_stops order by gtfs_route_id').fetch_record_batch(FETCH_BATCH_ROWS)
+    pending = None
+    for batch in reader:
+        if batch.num_rows == 0:
+            continue
+        # nullable integer columns (gtfs_stop_id, shape_dist_traveled) are kept as int / None instead of float
+        df = batch.to_pandas(integer_object_nulls=True)
+        if pending is not None:
+            df = pd.concat([pending, df], ignore_index=True)
+        last_gtfs_route_id = df['gtfs_route_id'].iloc[-1]
+        # the last route of the batch may continue in the next batch
+        pending = df[df['gtfs_route_id'] == last_gtfs_route_id]
+        for gtfs_route_id, route_df in df[df['gtfs_route_id'] != last_gtfs_route_id].groupby('gtfs_route_id', sort=False):
+            yield int(gtfs_route_id), get_ride_stop_mappings(date, route_df)
+    if pending is not None and len(pending) > 0:
+        yield int(pending['gtfs_route_id'].iloc[0]), get_ride_stop_mappings(date, pending)
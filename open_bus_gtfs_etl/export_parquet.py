@@ -0,0 +1,117 @@
+import os
+import shutil
+from pathlib import Path
+from pprint import pprint
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+from . import common, config, partridge_helper, feed_frames, upload_to_s3, shared_feed
+
+
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_ROW_GROUP_SIZE = 1000000
+
+# the large tables are exported as hive partitioned datasets with a file per operator,
+# e.g. ride_stops/operator_ref=3/part-0.parquet, the other tables to a single file, e.g. stops.parquet
+PARQUET_PARTITIONED_TABLES = ['rides', 'ride_stops']
+PARQUET_PARTITION_COLUMN = 'operator_ref'
+HIVE_DEFAULT_PARTITION = '__HIVE_DEFAULT_PARTITION__'
+
+
+def get_operator_refs(journey_refs: pd.Series, rides: pd.DataFrame) -> np.ndarray:
+    """Returns the operator_ref of each journey_ref (float, nan if the ride is unknown),
+    it's looked up once per distinct journey_ref"""
+    journey_refs = pd.Categorical(journey_refs)
+    operator_refs = rides.set_index('journey_ref')['operator_ref'].astype('float64').reindex(journey_refs.categories).to_numpy()
+    return np.where(journey_refs.codes >= 0, operator_refs[np.maximum(journey_refs.codes, 0)], np.nan)
+
+
+def get_tables(date, gtfs_path, stats, silent, feed=None, stop_times=None, use_index=None):
+    if feed is None:
+        with common.print_memory_usage("Preloading feed...", silent=silent):
+            feed = partridge_helper.preload_partridge_feed(date, gtfs_path)
+    with common.print_memory_usage("Preparing stops, routes and rides...", silent=silent):
+        stops = feed_frames.get_stops(feed, stats)
+        routes = feed_frames.get_routes(feed, stats)
+        rides = feed_frames.get_rides(feed, stats)
+    if stop_times is None:
+        stop_times = shared_feed.get_trips_stop_times(gtfs_path, date, set(rides['journey_ref']), silent=silent, use_index=use_index)
+    with common.print_memory_usage("Preparing ride stops...", silent=silent):
+        ride_aggregates = feed_frames.get_ride_aggregates(stop_times)
+        ride_aggregates['start_time'] = feed_frames.get_gtfs_datetimes(date, ride_aggregates['start_time'])
+        rides = rides.merge(ride_aggregates, on='journey_ref', how='left')
+        rides['operator_ref'] = rides['line_ref'].map(routes.set_index('line_ref')['operator_ref']).astype('Int64')
+        ride_stops = feed_frames.get_ride_stops(stop_times, stats)
+        for column in ['arrival_time', 'departure_time']:
+            ride_stops[column] = feed_frames.get_gtfs_datetimes(date, ride_stops[column])
+        ride_stops = ride_stops.sort_values(['journey_ref', 'stop_sequence'])
+    return {
+        'stops': stops,
+        'routes': routes,
+        'rides': rides,
+        'ride_stops': ride_stops,
+    }
+
+
+def write_parquet(df: pd.DataFrame, file_path: Path):
+    df.to_parquet(file_path, engine='pyarrow', compression=PARQUET_COMPRESSION, index=False, row_group_size=PARQUET_ROW_GROUP_SIZE)
+
+
+def write_parquet_partitioned(df: pd.DataFrame, path: Path, operator_refs: np.ndarray):
+    """Writes the table as a hive partitioned dataset - a file per operator (see PARQUET_PARTITIONED_TABLES),
+    rows keep their order within each partition. Returns the number of written files."""
+    df = df.drop(columns=[PARQUET_PARTITION_COLUMN], errors='ignore')
+    partitions = pd.Series(operator_refs).groupby(operator_refs, dropna=False, sort=True).indices
+    for operator_ref, indices in partitions.items():
+        partition_value = HIVE_DEFAULT_PARTITION if np.isnan(operator_ref) else int(operator_ref)
+        partition_path = Path(path, f'{PARQUET_PARTITION_COLUMN}={partition_value}')
+        os.makedirs(partition_path)
+        write_parquet(df.take(indices), Path(partition_path, 'part-0.parquet'))
+    return len(partitions)
+
+
+def main(date: str, silent=False, extracted_workdir=None, upload=False, force=True, feed=None, stop_times=None, use_index=None):
+    """Exports the date's typed GTFS tables (stops, routes, rides and ride stops with resolved timestamps)
+    to compressed Parquet files and optionally uploads them to S3 under the date's gtfs_archive path,
+    e.g. gtfs_archive/2022/06/03/parquet/stops.parquet, rides and ride stops are partitioned by operator
+    (see PARQUET_PARTITIONED_TABLES), e.g. gtfs_archive/2022/06/03/parquet/ride_stops/operator_ref=3/part-0.parquet
+    The exported schema: stops (mot_id, code, lat, lon, name, city), routes (see feed_frames.get_routes),
+    rides (line_ref, journey_ref, first_stop_sequence, last_stop_sequence, start_time, operator_ref) and
+    ride_stops (see feed_frames.get_ride_stops), all times are timestamps in Israel timezone.
+    stop_times is the typed stop times of the feed's trips (see partridge_helper.read_stop_times_typed),
+    if it's not provided the date's shared stop times are used (see shared_feed.get_stop_times), so that stop_times.txt
+    is not parsed again after the stop times loader, use_index is used if they were not parsed yet."""
+    date = common.parse_date_str(date)
+    dated_workdir = extracted_workdir if extracted_workdir else common.get_dated_workdir(date)
+    stats = defaultdict(int)
+    tables = get_tables(
+        date, Path(dated_workdir, config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION), stats, silent,
+        feed=feed, stop_times=stop_times, use_index=use_index
+    )
+    parquet_path = Path(dated_workdir, config.WORKDIR_PARQUET)
+    shutil.rmtree(parquet_path, ignore_errors=True)
+    os.makedirs(parquet_path)
+    for name, df in tables.items():
+        if name in PARQUET_PARTITIONED_TABLES:
+            path = Path(parquet_path, name)
+            with common.print_memory_usage(f'Writing {path}...', silent=silent):
+                stats[f'{name} parquet files'] += write_parquet_partitioned(df, path, get_operator_refs(df['journey_ref'], tables['rides']))
+                stats[f'{name} rows exported'] += len(df)
+                stats[f'{name} parquet bytes'] += sum(os.path.getsize(file_path) for file_path in path.glob('*/*.parquet'))
+            if upload:
+                upload_to_s3.upload_sync_dir(str(path), date, f'{config.WORKDIR_PARQUET}/{name}', force)
+                stats[f'{name} uploaded to S3'] += 1
+        else:
+            file_path = Path(parquet_path, f'{name}.parquet')
+            with common.print_memory_usage(f'Writing {file_path}...', silent=silent):
+                write_parquet(df, file_path)
+                stats[f'{name} rows exported'] += len(df)
+                stats[f'{name} parquet bytes'] += os.path.getsize(file_path)
+            if upload:
+                upload_to_s3.upload_rename(str(file_path), date, f'{config.WORKDIR_PARQUET}/{name}', 'parquet', force)
+                stats[f'{name} uploaded to S3'] += 1
+    if not silent:
+        pprint(dict(stats))
+    return stats
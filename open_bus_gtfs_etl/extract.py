@@ -1,13 +1,73 @@
 import os
+import zlib
 import shutil
-import subprocess
+import zipfile
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from . import common, config
 
 
+DATES_WITH_ONLY_GTFS_FILE = ('2023-03-26', '2023-03-27', '2023-03-28', '2023-03-29', '2023-03-30', '2023-03-31', '2023-04-01', '2023-04-02')
+
+
 class ExtractUnzipException(Exception):
-    pass
+
+    def __init__(self, zip_file_name=None, member=None, error=None, zip_file_names=None):
+        self.zip_file_name = zip_file_name
+        self.member = member
+        self.error = error
+        # all the corrupted files, when more than one archive was verified
+        self.zip_file_names = zip_file_names or ([zip_file_name] if zip_file_name else [])
+        super().__init__('failed to extract {}{}: {}'.format(zip_file_name, f' member {member}' if member else '', error))
+
+
+def open_zip_file(zip_file_name):
+    """Opens the zip file, reading the central directory, raises ExtractUnzipException if it's missing or corrupted.
+    This is fast and detects truncated downloads before any extraction is started."""
+    try:
+        return zipfile.ZipFile(zip_file_name)
+    except (zipfile.BadZipFile, OSError) as e:
+        raise ExtractUnzipException(zip_file_name, error=e)
+
+
+def extract_zip_file(zip_file, extracted_path, silent=False):
+    """Extracts all members into a temporary directory next to extracted_path, which replaces extracted_path only after
+    all members were extracted. The CRC of each member is verified while it's read (ZipFile.extract raises BadZipFile),
+    so the archive is decompressed only once, raises ExtractUnzipException if any member is corrupted."""
+    extracting_path = extracted_path + '.extracting'
+    shutil.rmtree(extracting_path, ignore_errors=True)
+    try:
+        with zip_file:
+            for info in zip_file.infolist():
+                if not silent:
+                    print("extracting: {}".format(info.filename))
+                try:
+                    zip_file.extract(info, extracting_path)
+                except (zipfile.BadZipFile, zlib.error, EOFError) as e:
+                    raise ExtractUnzipException(zip_file.filename, info.filename, e)
+        os.makedirs(extracting_path, exist_ok=True)
+        shutil.rmtree(extracted_path, ignore_errors=True)
+        os.rename(extracting_path, extracted_path)
+    finally:
+        shutil.rmtree(extracting_path, ignore_errors=True)
+
+
+def extract_zip_files(zip_files, silent=False):
+    """Extracts all the archives in parallel, if any of them is corrupted raises ExtractUnzipException
+    of the first corrupted archive with the names of all corrupted archives (after all extractions completed)"""
+    errors = []
+    with ThreadPoolExecutor(max_workers=len(zip_files)) as executor:
+        futures = [executor.submit(extract_zip_file, zip_file, extracted_path, silent) for zip_file, extracted_path in zip_files]
+        for future in futures:
+            try:
+                future.result()
+            except ExtractUnzipException as e:
+                errors.append(e)
+    if errors:
+        raise ExtractUnzipException(
+            errors[0].zip_file_name, errors[0].member, errors[0].error, zip_file_names=[e.zip_file_name for e in errors]
+        )
 
 
 def main(date, silent=False, archive_folder=None, extracted_workdir=None):
@@ -26,6 +86,7 @@ def main(date, silent=False, archive_folder=None, extracted_workdir=None):
     tariff_file_path = Path(base_path, 'Tariff.zip').absolute()
     cluster_to_line_file_path = Path(base_path, 'ClusterToLine.zip').absolute()
     trip_id_to_date_file_path = Path(base_path, 'TripIdToDate.zip').absolute()
+    zip_files = []
     for zip_file_name, extracted_rel_path in {
         gtfs_file_path: config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION,
         tariff_file_path: config.WORKDIR_TARIFF,
@@ -33,13 +94,16 @@ def main(date, silent=False, archive_folder=None, extracted_workdir=None):
         trip_id_to_date_file_path: config.WORKDIR_TRIP_ID_TO_DATE,
     }.items():
         extracted_path = os.path.join(dated_workdir, extracted_rel_path)
-        shutil.rmtree(extracted_path, ignore_errors=True)
-        os.makedirs(extracted_path, exist_ok=True)
-        if subprocess.call(['unzip', zip_file_name], cwd=extracted_path, **({'stdout': subprocess.DEVNULL} if silent else {})) != 0:
-            if (
-                date.strftime("%Y-%m-%d") in ('2023-03-26', '2023-03-27', '2023-03-28', '2023-03-29', '2023-03-30', '2023-03-31', '2023-04-01', '2023-04-02')
-                and zip_file_name != gtfs_file_path
-            ):
+        try:
+            zip_file = open_zip_file(zip_file_name)
+        except ExtractUnzipException:
+            if date.strftime("%Y-%m-%d") in DATES_WITH_ONLY_GTFS_FILE and zip_file_name != gtfs_file_path:
                 print("WARNING! Only israel-public-transporation.zip is available for given date, other files are missing")
-            else:
-                raise ExtractUnzipException()
+                shutil.rmtree(extracted_path, ignore_errors=True)
+                os.makedirs(extracted_path, exist_ok=True)
+                continue
+            for opened_zip_file, _ in zip_files:
+                opened_zip_file.close()
+            raise
+        zip_files.append((zip_file, extracted_path))
+    extract_zip_files(zip_files, silent)
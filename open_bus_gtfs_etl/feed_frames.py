@@ -0,0 +1,104 @@
+import re
+import datetime
+
+import numpy as np
+import pandas as pd
+
+
+# רחוב: בן יהודה 74 עיר: כפר סבא רציף:  קומה:
+# the city is the text after "עיר:" up to "רציף:" / another "עיר:" / end of string
+STOP_DESC_CITY_RE = re.compile(r'עיר:((?:(?!עיר:|רציף:).)*)', re.DOTALL)
+
+
+def parse_stop_desc_city(stop_desc: pd.Series, stats) -> pd.Series:
+    city = stop_desc.str.extract(STOP_DESC_CITY_RE, expand=False).str.strip()
+    stats['rows failed to parse stop_desc'] += int(city.isna().sum())
+    return city.astype(object).where(city.notna(), None)
+
+
+def parse_route_desc(route_desc: pd.Series, stats) -> pd.DataFrame:
+    """Splits route_desc (e.g. 10001-1-0) to route_mkt, route_direction and route_alternative,
+    all parts are None if route_desc doesn't have exactly 3 parts"""
+    parts = route_desc.str.split('-', expand=True).reindex(columns=range(3))
+    is_invalid = route_desc.str.count('-') != 2
+    stats['rows failed to parse route_desc'] += int(is_invalid.sum())
+    parts = parts.astype(object).where(~is_invalid, None)
+    parts.columns = ['route_mkt', 'route_direction', 'route_alternative']
+    return parts
+
+
+def get_stops(feed, stats):
+    stops = feed.stops[['stop_id', 'stop_code', 'stop_name', 'stop_lat', 'stop_lon', 'stop_desc']]
+    stats['stops in source data'] = len(stops)
+    return pd.DataFrame({
+        'mot_id': stops['stop_id'].astype(int),
+        'code': stops['stop_code'].astype(int),
+        'lat': stops['stop_lat'],
+        'lon': stops['stop_lon'],
+        'name': stops['stop_name'],
+        'city': parse_stop_desc_city(stops['stop_desc'], stats),
+    })
+
+
+def get_routes(feed, stats):
+    agency_names = feed.agency[['agency_id', 'agency_name']].copy()
+    agency_names['agency_id'] = agency_names['agency_id'].astype(int)
+    agency_names = agency_names.set_index('agency_id')['agency_name']
+    routes = feed.routes[['route_id', 'route_short_name', 'route_long_name', 'route_type', 'agency_id', 'route_desc']]
+    stats['routes in source data'] = len(routes)
+    route_desc_parts = parse_route_desc(routes['route_desc'], stats)
+    operator_ref = routes['agency_id'].astype(int)
+    return pd.DataFrame({
+        'line_ref': routes['route_id'].astype(int),
+        'operator_ref': operator_ref,
+        'route_short_name': routes['route_short_name'],
+        'route_long_name': routes['route_long_name'],
+        'route_mkt': route_desc_parts['route_mkt'],
+        'route_direction': route_desc_parts['route_direction'],
+        'route_alternative': route_desc_parts['route_alternative'],
+        'agency_name': operator_ref.map(agency_names),
+        'route_type': routes['route_type'],
+    })
+
+
+def get_rides(feed, stats):
+    trips = feed.trips[['route_id', 'trip_id']]
+    stats['rides in source data'] = len(trips)
+    return pd.DataFrame({
+        'line_ref': trips['route_id'].astype(int),
+        'journey_ref': trips['trip_id'],
+    })
+
+
+def get_ride_stops(stop_times, stats):
+    """Returns the date's stop times from typed stop_times (see partridge_helper.read_stop_times_typed),
+    arrival / departure times are kept as gtfs seconds, conversion to timestamps is done when the rows are published"""
+    stats['ride stops in source data'] = len(stop_times)
+    return pd.DataFrame({
+        'journey_ref': stop_times['trip_id'],
+        'mot_id': stop_times['stop_id'],
+        'arrival_time': stop_times['arrival_time'],
+        'departure_time': stop_times['departure_time'],
+        'stop_sequence': stop_times['stop_sequence'],
+        'pickup_type': stop_times['pickup_type'],
+        'drop_off_type': stop_times['drop_off_type'],
+        'shape_dist_traveled': np.trunc(stop_times['shape_dist_traveled']).astype('Int64'),
+    })
+
+
+def get_ride_aggregates(stop_times):
+    """Returns the first / last stop_sequence and the first departure time (gtfs seconds) of each trip"""
+    stop_sequences = stop_times.groupby('trip_id', observed=True)['stop_sequence']
+    first_stop_times = stop_times.loc[stop_sequences.idxmin()]
+    return pd.DataFrame({
+        'journey_ref': first_stop_times['trip_id'].astype(str).to_numpy(),
+        'first_stop_sequence': first_stop_times['stop_sequence'].to_numpy(),
+        'last_stop_sequence': stop_sequences.max().reindex(first_stop_times['trip_id']).to_numpy(),
+        'start_time': first_stop_times['departure_time'].to_numpy(),
+    })
+
+
+def get_gtfs_datetimes(date: datetime.date, seconds: pd.Series) -> pd.Series:
+    """Vectorized conversion of gtfs times (seconds since start of service day) to timestamps in Israel timezone"""
+    datetimes = pd.Timestamp(date) + pd.to_timedelta(seconds.astype('float64'), unit='s')
+    return datetimes.dt.tz_localize('Israel', ambiguous=np.zeros(len(datetimes), dtype=bool), nonexistent='shift_forward')
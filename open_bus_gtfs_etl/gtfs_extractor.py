@@ -1,10 +1,10 @@
 import os
-import shutil
 import time
+import hashlib
 from contextlib import closing
 from logging import getLogger
 from pathlib import Path
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional
 from urllib import request
 from urllib.error import URLError
 import ssl
@@ -13,6 +13,7 @@ from pydantic import BaseModel
 from tqdm import tqdm
 
 GTFS_METADATA_FILE = '.gtfs_metadata.json'
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
 logger = getLogger(__file__)
 
@@ -65,17 +66,27 @@ class GTFSFiles(BaseModel):
     tariff: Path
     cluster_to_line: Path
     trip_id_to_date: Path
+    sha256: Dict[str, str] = {}
 
 
 class GtfsRetriever:
     """
     GtfsRetriever is utility to manage downloading GTFS files and creating metadata file
     """
-    def __init__(self, folder: Path, app_config: GtfsExtractorConfig = GTFS_EXTRACTOR_CONFIG):
+    def __init__(self, folder: Path, app_config: GtfsExtractorConfig = GTFS_EXTRACTOR_CONFIG,
+                 stream_upload_func: Optional[Callable] = None):
+        """
+        stream_upload_func - optional function which gets a file local name and returns a writer (with write / close /
+        abort methods), the downloaded bytes are written to it while they are written to the local file
+        """
         self.folder = folder
         self.app_config = app_config
+        self.stream_upload_func = stream_upload_func
 
-    def retrieve_gtfs_files(self) -> GTFSFiles:
+    def retrieve_gtfs_files(self, only_missing: bool = False) -> GTFSFiles:
+        """
+        Downloads the GTFS files, if only_missing is set - files which already exist in the folder are not downloaded
+        """
         os.makedirs(self.folder, exist_ok=True)
 
         args: Dict[str, FileConfig] = dict(gtfs=self.app_config.gtfs_file,
@@ -91,7 +102,13 @@ class GtfsRetriever:
         for i, delay_in_sec in enumerate(tries, start=1):
             try:
                 for item in tqdm(args.values()):
-                    self.download_file_from_ftp(url=item.url, local_file=Path(self.folder, item.local_name))
+                    local_file = Path(self.folder, item.local_name)
+                    if only_missing and local_file.exists():
+                        gtfs_files.sha256[item.local_name] = self.get_file_sha256(local_file)
+                        continue
+                    stream_upload = self.stream_upload_func(item.local_name) if self.stream_upload_func else None
+                    gtfs_files.sha256[item.local_name] = self.download_file_from_ftp(
+                        url=item.url, local_file=local_file, stream_upload=stream_upload)
 
                 with open(Path(self.folder, GTFS_METADATA_FILE), 'w') as metadata_file:
                     metadata_file.write(gtfs_files.json())
@@ -107,10 +124,36 @@ class GtfsRetriever:
         raise DownloadingException('Failed to Download GTFS Files.')
 
     @staticmethod
-    def download_file_from_ftp(url, local_file: Path):
+    def get_file_sha256(local_file: Path) -> str:
+        file_hash = hashlib.sha256()
+        with local_file.open('rb') as f:
+            for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+                file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    @staticmethod
+    def download_file_from_ftp(url, local_file: Path, stream_upload=None) -> str:
+        """
+        Downloads the url to the local file and optionally to the stream upload in a single pass,
+        returns the sha256 hex digest of the downloaded file
+        """
         ctx = ssl.create_default_context()
         ctx.check_hostname = False
         ctx.verify_mode = ssl.CERT_NONE
-        with closing(request.urlopen(url, context=ctx)) as downloaded_content:
-            with local_file.open('wb') as target_file:
-                shutil.copyfileobj(downloaded_content, target_file)
+        file_hash = hashlib.sha256()
+        try:
+            with closing(request.urlopen(url, context=ctx)) as downloaded_content:
+                with local_file.open('wb') as target_file:
+                    for chunk in iter(lambda: downloaded_content.read(DOWNLOAD_CHUNK_SIZE), b''):
+                        file_hash.update(chunk)
+                        target_file.write(chunk)
+                        if stream_upload:
+                            stream_upload.write(chunk)
+            if stream_upload:
+                # fails if the upload failed, so it's aborted as well
+                stream_upload.close()
+        except BaseException:
+            if stream_upload:
+                stream_upload.abort()
+            raise
+        return file_hash.hexdigest()
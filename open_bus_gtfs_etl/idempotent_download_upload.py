@@ -62,7 +62,7 @@ def main():
             gtfs_data_id = gtfs_data_download_upload_started(date)
             try:
                 stats['download_upload_from_mot'] += 1
-                download_extract_upload.main(from_mot=True, target_path=workdir)
+                download_extract_upload.main(from_mot=True, target_path=workdir, stream_upload=True)
             except:
                 update_gtfs_data(gtfs_data_id, error=traceback.format_exc())
                 raise
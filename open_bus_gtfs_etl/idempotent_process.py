@@ -1,14 +1,19 @@
 import time
+import shutil
 import tempfile
 import datetime
 import traceback
+from pathlib import Path
 from pprint import pprint
 from collections import defaultdict
 
 from open_bus_stride_db.db import get_session
 from open_bus_stride_db.model import GtfsData
 
-from . import common, download_extract_upload, load_stops_to_db, load_trips_to_db, load_routes_to_db, load_stop_times_to_db
+from . import (
+    common, download_extract_upload, load_atomic_to_db, export_parquet, config, calendar_index, prefetch, loaders_dag,
+    process_queue
+)
 
 
 # the last days for which we want to make sure all data exists
@@ -28,30 +33,50 @@ def download_from_stride(workdir, from_stride_date, stats):
     return download_extract_upload.main(from_stride=True, date=from_stride_date, target_path=workdir)
 
 
-def process_gtfs_data(extracted_workdir, date, stats):
+def process_gtfs_data(extracted_workdir, date, stats, atomic=False, resume=False):
+    """Each step prepares the feed tables it needs and releases them when it's done, the date's typed stop times
+    are parsed once and shared by all the steps through a memory mapped file (see shared_feed)"""
     print(f"Processing GTFS data for date {date}...")
     stats['process_gtfs_data'] += 1
-    load_stops_stats = load_stops_to_db.main(date, silent=True, extracted_workdir=extracted_workdir)
-    print("Loaded stops")
-    pprint(dict(load_stops_stats))
-    stats['stop rows updated in DB'] += load_stops_stats['rows updated in DB']
-    stats['stop rows inserted to DB'] += load_stops_stats['rows inserted to DB']
-    stats['stop mot id rows inserted to DB'] += load_stops_stats['stop mot id rows inserted to DB']
-    load_routes_stats = load_routes_to_db.main(date, silent=True, extracted_workdir=extracted_workdir)
-    print("Loaded routes")
-    pprint(dict(load_routes_stats))
-    stats['route rows updated in DB'] += load_routes_stats['rows updated in DB']
-    stats['route rows insert to DB'] += load_routes_stats['rows inserted to DB']
-    load_trips_stats = load_trips_to_db.main(date, silent=True, extracted_workdir=extracted_workdir)
-    print("Loaded trips")
-    pprint(dict(load_trips_stats))
-    stats['load trip rows updated in DB'] += load_trips_stats['rows updated in DB']
-    stats['load trip rows inserted to DB'] += load_trips_stats['rows inserted to DB']
-    load_stop_times_stats = load_stop_times_to_db.main(date=date, limit=0, debug=False, silent=True, extracted_workdir=extracted_workdir)
-    print("Loaded stop times")
-    pprint(dict(load_stop_times_stats))
-    stats['stop time rows updated in DB'] += load_stop_times_stats['rows updated in DB']
-    stats['stop time rows inserted to DB'] += load_stop_times_stats['rows inserted to DB']
+    if atomic:
+        load_atomic_stats = load_atomic_to_db.main(date, silent=True, extracted_workdir=extracted_workdir)
+        print("Loaded all data atomically")
+        pprint(dict(load_atomic_stats))
+        for key in [
+            'stop rows updated in DB', 'stop rows inserted to DB', 'stop mot id rows inserted to DB',
+            'route rows updated in DB', 'route rows insert to DB',
+            'load trip rows updated in DB', 'load trip rows inserted to DB',
+            'stop time rows updated in DB', 'stop time rows inserted to DB',
+        ]:
+            stats[key] += load_atomic_stats[key]
+        # the MOT datasets loaders are independent of the atomic load, their failures don't fail the date
+        loaders_dag.main(
+            date, extracted_workdir=extracted_workdir, loaders=loaders_dag.MOT_DATASETS_LOADERS, stats=stats,
+            optional_loaders=loaders_dag.MOT_DATASETS_LOADERS
+        )
+    else:
+        process_gtfs_data_loaders(extracted_workdir, date, stats, resume=resume)
+    if config.GTFS_ETL_EXPORT_PARQUET:
+        # the data was already loaded to DB, so an export / upload failure doesn't fail the date's processing
+        try:
+            export_parquet_stats = export_parquet.main(date, silent=True, extracted_workdir=extracted_workdir, upload=True)
+        except Exception:
+            print(f'WARNING! failed to export parquet for date {date}')
+            traceback.print_exc()
+            stats['export parquet errors'] += 1
+        else:
+            print("Exported parquet")
+            pprint(dict(export_parquet_stats))
+            stats['exported parquet dates'] += 1
+
+
+def process_gtfs_data_loaders(extracted_workdir, date, stats, resume=False):
+    """Runs all the loaders of the date, independent loaders run concurrently (see loaders_dag),
+    if resume is set the stop times loader resumes from the checkpoint of a previous interrupted run of the date.
+    Failures of the MOT datasets loaders don't fail the date (see loaders_dag.main optional_loaders)"""
+    loaders_dag.main(
+        date, extracted_workdir=extracted_workdir, resume=resume, stats=stats, optional_loaders=loaders_dag.MOT_DATASETS_LOADERS
+    )
 
 
 def gtfs_data_processing_started(date, processing_used_stride_date=None):
@@ -104,41 +129,150 @@ def check_date(date):
     return needs_processing_download_from_stride_date
 
 
-def do_process_date(date, stats, download_from_stride_date):
+def process_extracted_date(date, stats, download_from_stride_date, extracted_workdir, atomic=False, resume=False):
+    gtfs_data_id = gtfs_data_processing_started(
+        date,
+        processing_used_stride_date=download_from_stride_date
+    )
+    try:
+        process_gtfs_data(extracted_workdir, date, stats, atomic=atomic, resume=resume)
+    except:
+        # an aborted run's date is processed by another worker (see process_queue.LeaseHeartbeat), its status is kept
+        if not common.run_aborted.is_set():
+            update_gtfs_data(gtfs_data_id, error=traceback.format_exc())
+        raise
+    else:
+        update_gtfs_data(gtfs_data_id, success=True)
+
+
+def do_process_date(date, stats, download_from_stride_date, atomic=False, resume=False):
     with tempfile.TemporaryDirectory() as workdir:
         extracted_workdir = download_from_stride(workdir, download_from_stride_date, stats)
-        gtfs_data_id = gtfs_data_processing_started(
-            date,
-            processing_used_stride_date=download_from_stride_date
-        )
-        try:
-            process_gtfs_data(extracted_workdir, date, stats)
-        except:
-            update_gtfs_data(gtfs_data_id, error=traceback.format_exc())
-            raise
-        else:
-            update_gtfs_data(gtfs_data_id, success=True)
+        process_extracted_date(date, stats, download_from_stride_date, extracted_workdir, atomic=atomic, resume=resume)
 
 
-def process_date(date, stats):
+def process_date(date, stats, atomic=False, resume=False):
     needs_processing_download_from_stride_date = check_date(date)
     if needs_processing_download_from_stride_date:
         print(f'Processing was not completed for date {date}, will download the data from Stride date {needs_processing_download_from_stride_date}')
-        do_process_date(date, stats, needs_processing_download_from_stride_date)
+        do_process_date(date, stats, needs_processing_download_from_stride_date, atomic=atomic, resume=resume)
         return True
     else:
         return False
 
 
-def process_iterate_last_dates(last_days, stats):
+def process_iterate_last_dates(last_days, stats, atomic=False, resume=False):
     for date in iterate_last_dates(last_days):
-        if process_date(date, stats):
+        if process_date(date, stats, atomic=atomic, resume=resume):
             stats['processed_dates'] += 1
             return True
     return False
 
 
-def main(last_days=None, only_date=None):
+def prefetch_date(date_download_from_stride_date):
+    """Runs in a background thread - downloads and extracts the feed for the date and builds its calendar index,
+    only the extracted path is kept, the feed is parsed when the date is processed"""
+    date, download_from_stride_date = date_download_from_stride_date
+    prefetch_stats = defaultdict(int)
+    workdir = tempfile.mkdtemp()
+    try:
+        extracted_workdir = download_from_stride(workdir, download_from_stride_date, prefetch_stats)
+        calendar_index.get_index(Path(extracted_workdir, config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION))
+    except:
+        shutil.rmtree(workdir, ignore_errors=True)
+        raise
+    return workdir, extracted_workdir, prefetch_stats
+
+
+def cleanup_prefetched_date(prefetched):
+    workdir, *_ = prefetched
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+def process_last_dates_pipelined(last_days, stats, prefetch_dates, atomic=False, resume=False):
+    """Processes all the last dates which need processing, newest first, while the following prefetch_dates dates
+    are downloaded and extracted in background threads, so that the download overlaps with DB loading"""
+    dates = []
+    for date in iterate_last_dates(last_days):
+        needs_processing_download_from_stride_date = check_date(date)
+        if needs_processing_download_from_stride_date:
+            dates.append((date, needs_processing_download_from_stride_date))
+    print(f'Found {len(dates)} dates which need processing, will process with {prefetch_dates} prefetched dates')
+    for (date, download_from_stride_date), prefetched in prefetch.iterate_prefetched(dates, prefetch_date, prefetch_dates, cleanup_prefetched_date):
+        workdir, extracted_workdir, prefetch_stats = prefetched
+        try:
+            for key, value in prefetch_stats.items():
+                stats[key] += value
+            print(f'Processing was not completed for date {date}, using prefetched data from Stride date {download_from_stride_date}')
+            process_extracted_date(date, stats, download_from_stride_date, extracted_workdir, atomic=atomic, resume=resume)
+            stats['processed_dates'] += 1
+        finally:
+            cleanup_prefetched_date(prefetched)
+
+
+def enqueue_last_dates(last_days, stats):
+    """Adds all the last dates which need processing to the process queue"""
+    with get_session() as session:
+        process_queue.create_table(session)
+        session.commit()
+    for date in iterate_last_dates(last_days):
+        needs_processing_download_from_stride_date = check_date(date)
+        if needs_processing_download_from_stride_date:
+            with get_session() as session:
+                if process_queue.enqueue(session, date, needs_processing_download_from_stride_date):
+                    stats['enqueued_dates'] += 1
+                session.commit()
+
+
+def process_claimed_date(date, download_from_stride_date, worker_id, stats, atomic=False, resume=False):
+    with process_queue.LeaseHeartbeat(date, worker_id) as heartbeat:
+        try:
+            do_process_date(date, stats, download_from_stride_date, atomic=atomic, resume=resume)
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+            stats['failed_dates'] += 1
+        else:
+            error = None
+            stats['processed_dates'] += 1
+    if heartbeat.lease_lost.is_set():
+        # the date was claimed by another worker, so it's not completed / released by this worker
+        print(f'Lost the lease of date {date}, the run was aborted')
+        stats['lost_leases'] += 1
+        common.run_aborted.clear()
+        return
+    with get_session() as session:
+        if error and common.sigterm_received.is_set():
+            # the worker was stopped, so the date is returned to the queue for another worker
+            process_queue.release(session, date, worker_id)
+            stats['released_dates'] += 1
+        else:
+            process_queue.complete(session, date, worker_id, error=error)
+        session.commit()
+
+
+def process_queue_worker(last_days, stats, atomic=False, max_dates=None, resume=False):
+    """Worker mode - multiple workers (e.g. on different nodes) can run concurrently, each worker adds the last dates
+    which need processing to the DB process queue and then claims dates from the queue and processes them,
+    until the queue is empty. Claimed dates are kept leased by a heartbeat, dates of workers which died are
+    claimed again when their lease expires. A failed date doesn't stop the worker, it's retried up to max attempts."""
+    worker_id = process_queue.get_worker_id()
+    print(f'Starting process queue worker {worker_id}')
+    enqueue_last_dates(last_days, stats)
+    with common.graceful_sigterm() as sigterm:
+        while not sigterm.is_set() and not (max_dates and stats['claimed_dates'] >= max_dates):
+            with get_session() as session:
+                claimed = process_queue.claim(session, worker_id)
+                session.commit()
+            if not claimed:
+                break
+            date, download_from_stride_date = claimed
+            stats['claimed_dates'] += 1
+            print(f'Claimed date {date}, will download the data from Stride date {download_from_stride_date}')
+            process_claimed_date(date, download_from_stride_date, worker_id, stats, atomic=atomic, resume=resume)
+
+
+def main(last_days=None, only_date=None, atomic=False, prefetch_dates=None, worker=False, max_dates=None, resume=False):
     """This task is idempotent and makes sure that all GTFS data
     was processed for last_days days. It uses DB gtfs_data table to keep track
     of the days for which we have GTFS data. It has 3 modes of operation:
@@ -146,20 +280,35 @@ def main(last_days=None, only_date=None):
     2. only_date is not set: iterate over the given last_days and make sure all of them are processed.
                              after a date was processed it starts iterating over all dates again,
                              so that newest dates will always be processed first.
+    If atomic is set, each date is loaded using load_atomic_to_db - into staging tables which are
+    published in a single transaction, so that a failed date leaves no partial data in the DB.
+    If prefetch_dates is set (and only_date is not set), the dates which need processing are determined once
+    and processed in a pipeline - while a date is loaded to DB, the next prefetch_dates dates are downloaded
+    in background threads (see process_last_dates_pipelined).
+    If worker is set (and only_date is not set), runs as a process queue worker (see process_queue_worker), so that
+    multiple instances can run concurrently, max_dates limits the number of dates the worker processes.
+    If resume is set (and atomic is not set), the stop times of a date which was interrupted in a previous run
+    continue from the date's checkpoint (see load_stop_times_to_db.RoutesCheckpoint) instead of from the start.
     """
     last_days = common.parse_None(last_days)
     only_date = common.parse_None(only_date)
+    prefetch_dates = int(common.parse_None(prefetch_dates) or 0)
     stats = defaultdict(int)
     if only_date is not None:
         assert last_days is None
         only_date = common.parse_date_str(only_date)
-        process_date(only_date, stats)
+        process_date(only_date, stats, atomic=atomic, resume=resume)
         stats['processed_dates'] += 1
     else:
         if not last_days:
             last_days = DEFAULT_LAST_DAYS
         last_days = int(last_days)
-        while process_iterate_last_dates(last_days, stats):
-            pass
+        if worker:
+            process_queue_worker(last_days, stats, atomic=atomic, max_dates=int(common.parse_None(max_dates) or 0), resume=resume)
+        elif prefetch_dates > 0:
+            process_last_dates_pipelined(last_days, stats, prefetch_dates, atomic=atomic, resume=resume)
+        else:
+            while process_iterate_last_dates(last_days, stats, atomic=atomic, resume=resume):
+                pass
     pprint(dict(stats))
     print('OK')
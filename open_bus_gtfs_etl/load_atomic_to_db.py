@@ -0,0 +1,263 @@
+from pathlib import Path
+from pprint import pprint
+from textwrap import dedent
+from contextlib import contextmanager
+from collections import defaultdict
+
+import pandas as pd
+from sqlalchemy import text
+
+from open_bus_stride_db.db import get_session
+
+from . import (
+    common, config, partridge_helper, feed_frames, db_helper, load_stop_times_to_db, calendar_index, shared_feed, stop_times_index
+)
+
+
+STAGING_TABLES = {
+    'stop': """
+        code integer, lat double precision, lon double precision, name text, city text
+    """,
+    'stop_mot_id': """
+        code integer, mot_id integer
+    """,
+    'route': """
+        line_ref integer, operator_ref integer, route_short_name text, route_long_name text,
+        route_mkt text, route_direction text, route_alternative text, agency_name text, route_type text
+    """,
+    'ride': """
+        line_ref integer, journey_ref text
+    """,
+    'ride_stop': """
+        journey_ref text, mot_id integer, arrival_time double precision, departure_time double precision,
+        stop_sequence integer, pickup_type integer, drop_off_type integer, shape_dist_traveled integer
+    """,
+    'ride_aggregate': load_stop_times_to_db.RIDE_AGGREGATES_COLUMNS_SQL,
+}
+
+# first key of the advisory lock on the date (the second key is the date), taken while the date's staging tables are used
+STAGING_LOCK_NAMESPACE = 26011
+
+
+def get_staging_table_name(date, name):
+    return 'gtfs_etl_staging_{}_{}'.format(date.strftime('%Y%m%d'), name)
+
+
+def drop_staging_tables(date):
+    with get_session() as session:
+        for name in STAGING_TABLES:
+            db_helper.drop_table(session, get_staging_table_name(date, name))
+        session.commit()
+
+
+@contextmanager
+def staging_lock(date, silent):
+    """Holds a session level advisory lock on the date while the block runs, so that concurrent atomic loads
+    of the same date (which use the same staging tables) run one after the other. The lock's connection
+    is in autocommit mode, so it doesn't keep a transaction open (idle in transaction) during the load."""
+    params = {'namespace': STAGING_LOCK_NAMESPACE, 'date_key': int(date.strftime('%Y%m%d'))}
+    with get_session() as session:
+        connection = session.connection(execution_options={'isolation_level': 'AUTOCOMMIT'})
+        with common.print_memory_usage('Waiting for staging lock of date {}...'.format(date), silent=silent):
+            connection.execute(text('select pg_advisory_lock(:namespace, :date_key)'), params)
+        try:
+            yield
+        finally:
+            connection.execute(text('select pg_advisory_unlock(:namespace, :date_key)'), params)
+
+
+def count_source_stop_times(gtfs_path, trip_ids):
+    """Counts the raw stop_times.txt lines of the given trips without parsing them - read using the stop_times index
+    if it's enabled (see config.GTFS_ETL_STOP_TIMES_INDEX), otherwise filtered on the raw bytes"""
+    if config.GTFS_ETL_STOP_TIMES_INDEX:
+        chunks = stop_times_index.iterate_trips_bytes(gtfs_path, trip_ids)
+    else:
+        chunks = partridge_helper.iterate_prefiltered_stop_times_chunks(Path(gtfs_path, 'stop_times.txt'), trip_ids)
+    next(chunks)  # header
+    # the last line of the file may not end with a newline
+    return sum(chunk.count(b'\n') + (1 if chunk and not chunk.endswith(b'\n') else 0) for chunk in chunks)
+
+
+def get_source_counts(session, date, gtfs_path):
+    """Returns the expected number of rows of each staging table, derived from the raw source files independently
+    of the parsed feed and of the data frames which were copied to the staging tables:
+    rides - the date's trips in trips.txt (counted using the calendar index), routes - distinct routes of these trips,
+    ride stops - the raw stop_times.txt lines of these trips, ride aggregates - distinct rides of the staged ride stops,
+    stops / stop mot ids - the stops.txt rows of the distinct stops of the staged ride stops"""
+    service_ids = calendar_index.get_service_ids(gtfs_path, date)
+    trips = pd.read_csv(Path(gtfs_path, 'trips.txt'), usecols=['route_id', 'service_id', 'trip_id'], dtype=str)
+    trips = trips[trips['service_id'].isin(service_ids)]
+    ride_stop_table_name = get_staging_table_name(date, 'ride_stop')
+    mot_ids = {row[0] for row in session.execute('select distinct mot_id from {}'.format(ride_stop_table_name))}
+    stops = pd.read_csv(Path(gtfs_path, 'stops.txt'), usecols=['stop_id', 'stop_code'], dtype=str)
+    stops = stops[stops['stop_id'].astype(int).isin(mot_ids)].astype(int)
+    return {
+        'stop': stops['stop_code'].nunique(),
+        'stop_mot_id': len(stops.drop_duplicates()),
+        'route': trips['route_id'].nunique(),
+        'ride': calendar_index.get_trip_count(gtfs_path, date),
+        'ride_stop': count_source_stop_times(gtfs_path, set(trips['trip_id'])),
+        'ride_aggregate': session.execute('select count(distinct journey_ref) from {}'.format(ride_stop_table_name)).scalar(),
+    }
+
+
+def load_staging_tables(date, feed, gtfs_path, stats, silent, stop_times=None):
+    if stop_times is None:
+        stop_times = shared_feed.get_trips_stop_times(gtfs_path, date, set(feed.trips['trip_id']), silent=silent)
+    with common.print_memory_usage('Preparing data frames...', silent=silent):
+        stops = feed_frames.get_stops(feed, stats)
+        frames = {
+            'stop': stops.drop_duplicates('code', keep='last')[['code', 'lat', 'lon', 'name', 'city']],
+            'stop_mot_id': stops[['code', 'mot_id']].drop_duplicates(),
+            'route': feed_frames.get_routes(feed, stats),
+            'ride': feed_frames.get_rides(feed, stats),
+            'ride_stop': feed_frames.get_ride_stops(stop_times, stats),
+            'ride_aggregate': feed_frames.get_ride_aggregates(stop_times),
+        }
+    with get_session() as session:
+        for name, columns_sql in STAGING_TABLES.items():
+            table_name = get_staging_table_name(date, name)
+            with common.print_memory_usage('Loading staging table {}...'.format(table_name), silent=silent):
+                db_helper.create_unlogged_table(session, table_name, columns_sql)
+                db_helper.copy_dataframe(session, table_name, frames[name])
+                session.execute('analyze {}'.format(table_name))
+                session.commit()
+        for name, num_source in get_source_counts(session, date, gtfs_path).items():
+            num_staged = db_helper.get_table_count(session, get_staging_table_name(date, name))
+            stats['{} rows in staging'.format(name)] = num_staged
+            assert num_staged == num_source, 'staging table {} has {} rows but source data has {} rows'.format(name, num_staged, num_source)
+        assert len(frames['stop']) > 0 and len(frames['route']) > 0 and len(frames['ride']) > 0, 'source data is missing stops / routes / rides'
+
+
+def execute_count(session, stats, stat_name, sql):
+    stats[stat_name] += session.execute(dedent(sql)).rowcount
+
+
+def publish_staging_tables(session, date, stats):
+    date_str = date.strftime('%Y-%m-%d')
+    t = {name: get_staging_table_name(date, name) for name in STAGING_TABLES}
+    execute_count(session, stats, 'stop rows updated in DB', f"""
+        update gtfs_stop s set lat = t.lat, lon = t.lon, name = t.name, city = t.city
+        from {t['stop']} t
+        where s.date = '{date_str}' and s.code = t.code
+    """)
+    execute_count(session, stats, 'stop rows inserted to DB', f"""
+        insert into gtfs_stop (date, code, lat, lon, name, city)
+        select '{date_str}', t.code, t.lat, t.lon, t.name, t.city
+        from {t['stop']} t
+        where not exists (select 1 from gtfs_stop s where s.date = '{date_str}' and s.code = t.code)
+    """)
+    execute_count(session, stats, 'stop mot id rows inserted to DB', f"""
+        insert into gtfs_stop_mot_id (gtfs_stop_id, mot_id)
+        select s.id, t.mot_id
+        from {t['stop_mot_id']} t, gtfs_stop s
+        where s.date = '{date_str}' and s.code = t.code
+        and not exists (
+            select 1 from gtfs_stop_mot_id m, gtfs_stop ms
+            where m.gtfs_stop_id = ms.id and ms.date = '{date_str}' and ms.code = t.code and m.mot_id = t.mot_id
+        )
+    """)
+    execute_count(session, stats, 'route rows updated in DB', f"""
+        update gtfs_route r
+        set route_short_name = t.route_short_name, route_long_name = t.route_long_name,
+            route_mkt = t.route_mkt, route_direction = t.route_direction, route_alternative = t.route_alternative,
+            agency_name = t.agency_name, route_type = t.route_type
+        from {t['route']} t
+        where r.date = '{date_str}' and r.line_ref = t.line_ref
+    """)
+    execute_count(session, stats, 'route rows insert to DB', f"""
+        insert into gtfs_route (
+            date, line_ref, operator_ref, route_short_name, route_long_name,
+            route_mkt, route_direction, route_alternative, agency_name, route_type
+        )
+        select
+            '{date_str}', t.line_ref, t.operator_ref, t.route_short_name, t.route_long_name,
+            t.route_mkt, t.route_direction, t.route_alternative, t.agency_name, t.route_type
+        from {t['route']} t
+        where not exists (select 1 from gtfs_route r where r.date = '{date_str}' and r.line_ref = t.line_ref)
+    """)
+    execute_count(session, stats, 'load trip rows updated in DB', f"""
+        update gtfs_ride r set gtfs_route_id = ro.id
+        from {t['ride']} t, gtfs_route ro, gtfs_route old_ro
+        where ro.date = '{date_str}' and ro.line_ref = t.line_ref
+        and r.journey_ref = t.journey_ref and r.gtfs_route_id = old_ro.id and old_ro.date = '{date_str}'
+    """)
+    execute_count(session, stats, 'load trip rows inserted to DB', f"""
+        insert into gtfs_ride (gtfs_route_id, journey_ref)
+        select ro.id, t.journey_ref
+        from {t['ride']} t, gtfs_route ro
+        where ro.date = '{date_str}' and ro.line_ref = t.line_ref
+        and not exists (
+            select 1 from gtfs_ride r, gtfs_route old_ro
+            where r.gtfs_route_id = old_ro.id and old_ro.date = '{date_str}' and r.journey_ref = t.journey_ref
+        )
+    """)
+    session.execute(dedent(f"""
+        create temp table gtfs_etl_resolved_ride_stop on commit drop as
+        select
+            r.id gtfs_ride_id, s.id gtfs_stop_id,
+            {db_helper.get_gtfs_datetime_sql(date, 't.arrival_time')} arrival_time,
+            {db_helper.get_gtfs_datetime_sql(date, 't.departure_time')} departure_time,
+            t.stop_sequence, t.pickup_type, t.drop_off_type, t.shape_dist_traveled
+        from {t['ride_stop']} t
+        join gtfs_ride r on r.journey_ref = t.journey_ref
+        join gtfs_route ro on ro.id = r.gtfs_route_id and ro.date = '{date_str}'
+        left join (
+            select m.mot_id, min(ms.id) id
+            from gtfs_stop_mot_id m, gtfs_stop ms
+            where m.gtfs_stop_id = ms.id and ms.date = '{date_str}'
+            group by m.mot_id
+        ) s on s.mot_id = t.mot_id
+    """))
+    execute_count(session, stats, 'stop time rows updated in DB', """
+        update gtfs_ride_stop rs
+        set arrival_time = t.arrival_time, departure_time = t.departure_time, stop_sequence = t.stop_sequence,
+            pickup_type = t.pickup_type, drop_off_type = t.drop_off_type, shape_dist_traveled = t.shape_dist_traveled
+        from gtfs_etl_resolved_ride_stop t
+        where rs.gtfs_ride_id = t.gtfs_ride_id and rs.gtfs_stop_id is not distinct from t.gtfs_stop_id
+    """)
+    execute_count(session, stats, 'stop time rows inserted to DB', """
+        insert into gtfs_ride_stop (
+            gtfs_ride_id, gtfs_stop_id, arrival_time, departure_time,
+            stop_sequence, pickup_type, drop_off_type, shape_dist_traveled
+        )
+        select
+            t.gtfs_ride_id, t.gtfs_stop_id, t.arrival_time, t.departure_time,
+            t.stop_sequence, t.pickup_type, t.drop_off_type, t.shape_dist_traveled
+        from gtfs_etl_resolved_ride_stop t
+        where not exists (
+            select 1 from gtfs_ride_stop rs
+            where rs.gtfs_ride_id = t.gtfs_ride_id and rs.gtfs_stop_id is not distinct from t.gtfs_stop_id
+        )
+    """)
+    stats['rides updated with first / last ride stops'] += load_stop_times_to_db.update_rides_aggregates(session, date, t['ride_aggregate'])
+
+
+def main(date: str, silent=False, extracted_workdir=None, feed=None, stop_times=None):
+    """Loads all the GTFS data for a date (stops, routes, trips and stop times) into unlogged staging tables
+    using bulk inserts, validates the staged row counts against the raw source files (see get_source_counts) and then publishes all the data
+    in a single transaction. If anything fails, nothing is published and the staging tables are dropped,
+    so a retry starts from a clean state. Concurrent runs of the same date wait for each other (see staging_lock).
+    If stop_times (typed stop times of the feed's trips) is not provided, the date's shared stop times are used (see shared_feed).
+    """
+    date = common.parse_date_str(date)
+    dated_workdir = extracted_workdir if extracted_workdir else common.get_dated_workdir(date)
+    stats = defaultdict(int)
+    gtfs_path = Path(dated_workdir, config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION)
+    if feed is None:
+        with common.print_memory_usage("Preloading feed...", silent=silent):
+            feed = partridge_helper.preload_partridge_feed(date, gtfs_path)
+    with staging_lock(date, silent):
+        drop_staging_tables(date)
+        try:
+            load_staging_tables(date, feed, gtfs_path, stats, silent, stop_times=stop_times)
+            with get_session() as session:
+                with common.print_memory_usage('Publishing staging tables...', silent=silent):
+                    publish_staging_tables(session, date, stats)
+                with common.print_memory_usage('Committing...', silent=silent):
+                    session.commit()
+        finally:
+            drop_staging_tables(date)
+    if not silent:
+        pprint(dict(stats))
+    return stats
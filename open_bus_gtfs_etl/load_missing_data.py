@@ -5,33 +5,25 @@ from collections import defaultdict
 from . import (
     common,
     download_extract_upload,
-    load_stops_to_db,
-    load_routes_to_db,
-    load_trips_to_db,
-    load_stop_times_to_db,
-    cleanup_dated_paths
+    loaders_dag,
+    cleanup_dated_paths,
+    idempotent_process,
+    prefetch,
 )
 
 
-def load_missing_data(dt):
+def load_missing_data(dt, extracted_workdir=None):
     print("Loading missing data for date {}".format(dt))
     stats = defaultdict(int)
     start_time = datetime.datetime.now()
     try:
-        download_extract_upload.main(from_stride=True, date=dt, force_download=True, silent=True)
-        load_stops_stats = load_stops_to_db.main(dt, silent=True)
-        stats['stop rows updated in DB'] += load_stops_stats['rows updated in DB']
-        stats['stop rows inserted to DB'] += load_stops_stats['rows inserted to DB']
-        stats['stop mot id rows inserted to DB'] += load_stops_stats['stop mot id rows inserted to DB']
-        load_routes_stats = load_routes_to_db.main(dt, silent=True)
-        stats['route rows updated in DB'] += load_routes_stats['rows updated in DB']
-        stats['route rows insert to DB'] += load_routes_stats['rows inserted to DB']
-        load_trips_stats = load_trips_to_db.main(dt, silent=True)
-        stats['load trip rows updated in DB'] += load_trips_stats['rows updated in DB']
-        stats['load trip rows inserted to DB'] += load_trips_stats['rows inserted to DB']
-        load_stop_times_stats = load_stop_times_to_db.main(date=dt, limit=0, debug=False, silent=True)
-        stats['stop time rows updated in DB'] += load_stop_times_stats['rows updated in DB']
-        stats['stop time rows inserted to DB'] += load_stop_times_stats['rows inserted to DB']
+        if not extracted_workdir:
+            download_extract_upload.main(from_stride=True, date=dt, force_download=True, silent=True)
+        # backfills resume the stop times of an interrupted previous run of the date
+        loaders_dag.main(
+            dt, extracted_workdir=extracted_workdir, resume=True, silent=True, stats=stats,
+            optional_loaders=loaders_dag.MOT_DATASETS_LOADERS
+        )
         stats['processed dates'] += 1
     finally:
         print("Elapsed time: {} seconds".format((datetime.datetime.now() - start_time).total_seconds()))
@@ -39,7 +31,10 @@ def load_missing_data(dt):
         cleanup_dated_paths.main(10, 10, silent=True)
 
 
-def main(from_date, to_date):
+def main(from_date, to_date, prefetch_dates=0):
+    """Loads all the data for dates in the given range, newest first.
+    If prefetch_dates is set, the next prefetch_dates dates are downloaded and extracted
+    in background threads while the current date is loaded to DB."""
     from_date = common.parse_date_str(from_date)
     to_date = common.parse_date_str(to_date)
     if to_date > from_date:
@@ -48,7 +43,22 @@ def main(from_date, to_date):
     else:
         dt = from_date
         min_dt = to_date
+    dates = []
     while dt >= min_dt:
-        print(dt)
-        load_missing_data(dt.strftime('%Y-%m-%d'))
+        dates.append(dt)
         dt = dt - datetime.timedelta(days=1)
+    if prefetch_dates:
+        for (dt, _), prefetched in prefetch.iterate_prefetched(
+            [(dt, dt) for dt in dates], idempotent_process.prefetch_date, int(prefetch_dates),
+            idempotent_process.cleanup_prefetched_date
+        ):
+            print(dt)
+            workdir, extracted_workdir, _ = prefetched
+            try:
+                load_missing_data(dt.strftime('%Y-%m-%d'), extracted_workdir=extracted_workdir)
+            finally:
+                idempotent_process.cleanup_prefetched_date(prefetched)
+    else:
+        for dt in dates:
+            print(dt)
+            load_missing_data(dt.strftime('%Y-%m-%d'))
@@ -0,0 +1,156 @@
+import re
+from pathlib import Path
+from pprint import pprint
+from textwrap import dedent
+from collections import defaultdict
+
+import pandas as pd
+from sqlalchemy import text
+
+from open_bus_stride_db.db import get_session
+
+from . import common, config, partridge_helper, db_helper
+
+
+# the additional datasets which MOT publishes alongside the GTFS feed
+# dataset name: (extracted workdir, source file name, DB table name)
+MOT_DATASETS = {
+    'trip_id_to_date': (config.WORKDIR_TRIP_ID_TO_DATE, 'TripIdToDate.txt', 'gtfs_mot_trip_id_to_date'),
+    'cluster_to_line': (config.WORKDIR_CLUSTER_TO_LINE, 'ClusterToLine.txt', 'gtfs_mot_cluster_to_line'),
+    'tariff': (config.WORKDIR_TARIFF, 'Tariff.txt', 'gtfs_mot_tariff'),
+}
+
+# the known source columns of each dataset, the DB tables are created with these columns (see get_table_columns),
+# other source columns are ignored and a source file which is missing any of them fails the dataset's load
+MOT_DATASETS_SOURCE_COLUMNS = {
+    'trip_id_to_date': [
+        'OfficeLineId', 'Direction', 'LineAlternative', 'FromDate', 'ToDate', 'TripId', 'DayInWeek', 'DepartureTime',
+    ],
+    'cluster_to_line': [
+        'OperatorName', 'OfficeLineId', 'OperatorLineId', 'ClusterName', 'FromDate', 'ToDate', 'ClusterId',
+        'LineType', 'LineTypeDesc', 'ClusterSubDesc',
+    ],
+    'tariff': [
+        'ShareCode', 'ShareCodeDesc', 'ZoneCodes', 'Daily', 'Weekly', 'Monthly', 'FromDate', 'ToDate',
+    ],
+}
+
+# source columns which are parsed from HH:MM to seconds, all other columns are loaded as text,
+# except for columns ending with "Date" which are parsed as dates
+TIME_NO_SECONDS_COLUMNS = ['DepartureTime']
+
+
+class MotDatasetSchemaException(Exception):
+    pass
+
+
+def get_column_name(source_column_name):
+    return re.sub(r'\W+', '_', re.sub(r'(?<!^)(?=[A-Z])', '_', source_column_name.strip())).lower()
+
+
+def get_column_sql_type(source_column_name):
+    if source_column_name in TIME_NO_SECONDS_COLUMNS:
+        return 'integer'
+    elif source_column_name.endswith('Date'):
+        return 'date'
+    else:
+        return 'text'
+
+
+def get_table_columns(dataset):
+    """Returns the DB table columns of the dataset: {column name: sql type}"""
+    return {
+        'date': 'date',
+        **{get_column_name(name): get_column_sql_type(name) for name in MOT_DATASETS_SOURCE_COLUMNS[dataset]},
+    }
+
+
+def parse_date_column(values):
+    dates = pd.to_datetime(values, format='%d/%m/%Y %H:%M:%S', errors='coerce')
+    if dates.isna().all() and values.notna().any():
+        dates = pd.to_datetime(values, dayfirst=True, errors='coerce')
+    return dates.dt.date
+
+
+def read_mot_dataset(source_path: Path, source_columns, stats):
+    """Reads and parses the known source columns of the dataset (see MOT_DATASETS_SOURCE_COLUMNS),
+    raises MotDatasetSchemaException if any of them is missing, unknown columns are ignored"""
+    df = pd.read_csv(source_path, dtype=str, encoding='utf-8-sig', encoding_errors='replace')
+    df.columns = [source_column_name.strip() for source_column_name in df.columns]
+    stats['rows in source data'] = len(df)
+    missing_columns = [source_column_name for source_column_name in source_columns if source_column_name not in df.columns]
+    if missing_columns:
+        raise MotDatasetSchemaException('{} is missing the columns: {} (source columns: {})'.format(
+            source_path, ', '.join(missing_columns), ', '.join(df.columns)
+        ))
+    unknown_columns = [
+        source_column_name for source_column_name in df.columns
+        if source_column_name not in source_columns and not source_column_name.startswith('Unnamed:')
+    ]
+    if unknown_columns:
+        print('WARNING! ignoring unknown columns of {}: {}'.format(source_path, ', '.join(unknown_columns)))
+        stats['unknown source columns ignored'] += len(unknown_columns)
+    columns = {}
+    for source_column_name in source_columns:
+        values = df[source_column_name]
+        column_name = get_column_name(source_column_name)
+        column_sql_type = get_column_sql_type(source_column_name)
+        if column_sql_type == 'integer':
+            columns[column_name] = pd.Series(partridge_helper.parse_time_no_seconds_column(values), index=df.index).astype('Int64')
+        elif column_sql_type == 'date':
+            columns[column_name] = parse_date_column(values)
+        else:
+            columns[column_name] = values.str.strip()
+        if column_sql_type != 'text':
+            stats['rows failed to parse {}'.format(column_name)] = int((columns[column_name].isna() & values.notna()).sum())
+    return pd.DataFrame(columns)
+
+
+def create_table(session, table_name, table_columns):
+    """Creates the table if it doesn't exist, raises MotDatasetSchemaException if the existing table's columns
+    don't match the dataset's columns (the table should be migrated)"""
+    session.execute(dedent("""
+        create table if not exists {} (
+            {}
+        )
+    """.format(table_name, ', '.join('{} {}{}'.format(
+        name, sql_type, ' not null' if name == 'date' else ''
+    ) for name, sql_type in table_columns.items()))))
+    session.execute('create index if not exists ix_{0}_date on {0} (date)'.format(table_name))
+    existing_columns = [row[0] for row in session.execute(text(dedent("""
+        select column_name from information_schema.columns
+        where table_schema = current_schema() and table_name = :table_name
+        order by ordinal_position
+    """)), {'table_name': table_name})]
+    if existing_columns != list(table_columns):
+        raise MotDatasetSchemaException('table {} columns ({}) don\'t match the dataset columns ({})'.format(
+            table_name, ', '.join(existing_columns), ', '.join(table_columns)
+        ))
+
+
+def main(date: str, dataset: str, silent=False, extracted_workdir=None):
+    """Loads one of the additional MOT datasets (see MOT_DATASETS) for the given date.
+    Existing rows of the date are replaced, new data is bulk inserted using COPY.
+    Only the known columns are loaded (see MOT_DATASETS_SOURCE_COLUMNS), a schema drift fails with MotDatasetSchemaException"""
+    date = common.parse_date_str(date)
+    dated_workdir = extracted_workdir if extracted_workdir else common.get_dated_workdir(date)
+    stats = defaultdict(int)
+    workdir, source_file_name, table_name = MOT_DATASETS[dataset]
+    source_path = Path(dated_workdir, workdir, source_file_name)
+    if not source_path.exists():
+        print("WARNING! missing {} source file: {}".format(dataset, source_path))
+        stats['missing source file'] += 1
+        return stats
+    with common.print_memory_usage("Reading {}...".format(source_path), silent=silent):
+        df = read_mot_dataset(source_path, MOT_DATASETS_SOURCE_COLUMNS[dataset], stats)
+        df.insert(0, 'date', date)
+    with get_session() as session:
+        with common.print_memory_usage("Loading {} rows to {}...".format(len(df), table_name), silent=silent):
+            create_table(session, table_name, get_table_columns(dataset))
+            stats['rows deleted from DB'] += session.execute("delete from {} where date = '{}'".format(table_name, date.strftime('%Y-%m-%d'))).rowcount
+            stats['rows inserted to DB'] += db_helper.copy_dataframe(session, table_name, df)
+        with common.print_memory_usage('Committing...', silent=silent):
+            session.commit()
+    if not silent:
+        pprint(dict(stats))
+    return stats
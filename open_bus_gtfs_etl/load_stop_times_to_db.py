@@ -1,3 +1,4 @@
+import os
 import json
 import datetime
 import traceback
@@ -14,7 +15,75 @@ import gtfs_kit
 from open_bus_stride_db.db import get_session
 from open_bus_stride_db import model
 
-from . import common, config, partridge_helper
+from . import common, config, partridge_helper, feed_frames, db_helper, db_lookups, calendar_index, shared_feed
+
+
+RIDE_AGGREGATES_COLUMNS_SQL = 'journey_ref text, first_stop_sequence integer, last_stop_sequence integer, start_time double precision'
+
+
+class LoadStopTimesInterrupted(Exception):
+    pass
+
+
+def get_checkpoints_path(date):
+    return Path(config.GTFS_ETL_ROOT_ARCHIVES_FOLDER, config.STOP_TIMES_CHECKPOINTS_FOLDER, date.strftime('%Y/%m/%d'))
+
+
+class RoutesCheckpoint:
+    """Keeps track of the routes which were committed to DB in a json lines file under the root archives folder
+    (see get_checkpoints_path), so that it's kept after the workdir of an interrupted run was deleted -
+    first line is the checkpoint key (date, feed hash, limit), followed by a line for each completed gtfs_route_id.
+    The checkpoint is used by resume mode to skip completed routes, it is ignored if the key doesn't match."""
+
+    def __init__(self, date, gtfs_path, limit):
+        self.key = {
+            'date': date.strftime('%Y-%m-%d'),
+            'feed_hash': calendar_index.get_feed_hash(gtfs_path),
+            'stop_times_size': os.path.getsize(Path(gtfs_path, 'stop_times.txt')),
+            'limit': limit or 0,
+        }
+        self.path = Path(get_checkpoints_path(date), '{}.jsonl'.format(self.key['feed_hash']))
+        self.completed_gtfs_route_ids = set()
+
+    def load(self, silent):
+        if self.path.exists():
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+            if lines and json.loads(lines[0]) == self.key:
+                # last line may be partial if the process was killed while writing it
+                for line in lines[1:]:
+                    try:
+                        self.completed_gtfs_route_ids.add(int(line))
+                    except ValueError:
+                        pass
+            elif not silent:
+                print("Ignoring checkpoint of a different date / feed: {}".format(self.path))
+        if not silent:
+            print("Resuming from checkpoint with {} completed routes".format(len(self.completed_gtfs_route_ids)))
+
+    def start(self, resume, silent):
+        if resume:
+            self.load(silent)
+        os.makedirs(self.path.parent, exist_ok=True)
+        # checkpoints of other feeds of the same date can't be resumed anymore
+        for path in self.path.parent.glob('*.jsonl'):
+            if path != self.path:
+                path.unlink()
+        with common.safe_open_write(self.path, 'w') as f:
+            f.write(json.dumps(self.key) + '\n')
+            for gtfs_route_id in self.completed_gtfs_route_ids:
+                f.write('{}\n'.format(gtfs_route_id))
+
+    def add(self, gtfs_route_id):
+        self.completed_gtfs_route_ids.add(gtfs_route_id)
+        with open(self.path, 'a') as f:
+            f.write('{}\n'.format(gtfs_route_id))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def remove(self):
+        if self.path.exists():
+            self.path.unlink()
 
 
 def parse_gtfs_datetime(gtfs_time, date, stats, debug):
@@ -39,41 +108,157 @@ def parse_gtfs_datetime(gtfs_time, date, stats, debug):
             raise
 
 
-def main(date: str, limit: int, debug: bool, silent=False, extracted_workdir=None):
+def update_rides_aggregates(session, date, ride_aggregates_table_name):
+    """Updates the date's rides first / last ride stop ids and start_time from a table
+    with the first / last stop sequence and first departure time of each journey_ref"""
+    return session.execute(dedent("""
+        update gtfs_ride r
+        set first_gtfs_ride_stop_id = f.id, last_gtfs_ride_stop_id = l.id, start_time = {start_time_sql}
+        from {table_name} t, gtfs_route ro, gtfs_ride_stop f, gtfs_ride_stop l
+        where r.journey_ref = t.journey_ref and ro.id = r.gtfs_route_id and ro.date = '{date}'
+        and f.gtfs_ride_id = r.id and f.stop_sequence = t.first_stop_sequence
+        and l.gtfs_ride_id = r.id and l.stop_sequence = t.last_stop_sequence
+    """.format(
+        start_time_sql=db_helper.get_gtfs_datetime_sql(date, 't.start_time'),
+        table_name=ride_aggregates_table_name, date=date.strftime('%Y-%m-%d')
+    ))).rowcount
+
+
+def iterate_kv_ride_stops(kv, rownums):
+    for rownum in rownums:
+        row = json.loads(kv.get(str(rownum)))
+        yield dict(
+            gtfs_ride_id=row['gtfs_ride_id'],
+            gtfs_stop_id=row['gtfs_stop_id'],
+            arrival_time=datetime.datetime.strptime(row['arrival_time'], '%Y-%m-%d %H:%M:%S %z'),
+            departure_time=datetime.datetime.strptime(row['departure_time'], '%Y-%m-%d %H:%M:%S %z'),
+            stop_sequence=row['stop_sequence'],
+            pickup_type=row['pickup_type'],
+            drop_off_type=row['drop_off_type'],
+            shape_dist_traveled=row['shape_dist_traveled'],
+        )
+
+
+def add_route_ride_stops(batcher, gtfs_route_id, ride_stops, stats, silent):
+    """Adds the ride stops of a single route to the write batcher as (is_update, mapping) rows, ride_stops is an
+    iterable of dicts with gtfs_ride_id, gtfs_stop_id, arrival_time, departure_time (datetimes), stop_sequence,
+    pickup_type, drop_off_type and shape_dist_traveled"""
+    with get_session() as session:
+        with common.print_memory_usage('Getting all ride_stops from DB...', silent=silent):
+            gtfs_ride_stop_ids_by_gtfs_ride_id_gtfs_stop_id = db_lookups.get_gtfs_ride_stop_ids_by_gtfs_ride_id_gtfs_stop_id(session, gtfs_route_id)
+    for mapping in ride_stops:
+        gtfs_ride_stop_id = gtfs_ride_stop_ids_by_gtfs_ride_id_gtfs_stop_id.get((mapping['gtfs_ride_id'], mapping['gtfs_stop_id']))
+        if gtfs_ride_stop_id:
+            stats['rows updated in DB'] += 1
+            batcher.add((True, dict(mapping, id=gtfs_ride_stop_id)))
+        else:
+            stats['rows inserted to DB'] += 1
+            batcher.add((False, mapping))
+
+
+def upsert_routes_ride_stops(route_ride_stops, num_routes, checkpoint, stats, silent):
+    """Upserts the ride stops of each route (route_ride_stops yields (gtfs_route_id, ride_stops)), skipping routes which
+    were completed according to the checkpoint. Ride stops are committed in batches (see db_helper.WriteBatcher),
+    so small routes are grouped to a single transaction and big routes are split, a route is added to the checkpoint
+    once all its ride stops were committed. On SIGTERM (or when the run was aborted, see common.run_aborted)
+    the current route is completed and then it stops."""
+    added_gtfs_route_ids = []
+
+    def checkpoint_added_routes():
+        # all the ride stops of the added routes were committed
+        for gtfs_route_id in added_gtfs_route_ids:
+            checkpoint.add(gtfs_route_id)
+            stats['routes completed'] += 1
+        added_gtfs_route_ids.clear()
+
+    def flush(rows):
+        with get_session() as session:
+            with common.print_memory_usage('Upserting {} ride stops...'.format(len(rows)), silent=silent):
+                session.bulk_update_mappings(model.GtfsRideStop, [mapping for is_update, mapping in rows if is_update])
+                session.bulk_insert_mappings(model.GtfsRideStop, [mapping for is_update, mapping in rows if not is_update])
+                session.commit()
+        checkpoint_added_routes()
+        if not silent:
+            pprint(dict(stats))
+
+    batcher = db_helper.WriteBatcher('ride stops', stats, flush)
+    with common.graceful_sigterm():
+        for i, (gtfs_route_id, ride_stops) in enumerate(route_ride_stops, start=1):
+            if gtfs_route_id in checkpoint.completed_gtfs_route_ids:
+                continue
+            if not silent:
+                print("Processing gtfs_route_id {} ({}/{})".format(gtfs_route_id, i, num_routes))
+            add_route_ride_stops(batcher, gtfs_route_id, ride_stops, stats, silent)
+            added_gtfs_route_ids.append(gtfs_route_id)
+            if common.is_stop_requested():
+                batcher.flush()
+                checkpoint_added_routes()
+                raise LoadStopTimesInterrupted(
+                    'Interrupted by SIGTERM / aborted run after {} completed routes, run with resume to continue'.format(len(checkpoint.completed_gtfs_route_ids))
+                )
+        batcher.flush()
+        checkpoint_added_routes()
+
+
+def update_rides_aggregates_from_dataframe(date, ride_aggregates, stats, silent):
+    with get_session() as session:
+        with common.print_memory_usage('Updating rides first / last ride stops and start time...', silent=silent):
+            db_helper.create_temp_table(session, 'gtfs_etl_ride_aggregates', RIDE_AGGREGATES_COLUMNS_SQL)
+            db_helper.copy_dataframe(session, 'gtfs_etl_ride_aggregates', ride_aggregates)
+            stats['rides updated with first / last ride stops'] += update_rides_aggregates(session, date, 'gtfs_etl_ride_aggregates')
+            session.commit()
+
+
+def main_duckdb(date, gtfs_path, trip_ids, gtfs_stop_id_by_mot_ids, gtfs_route_ids_ride_ids_by_journey_ref, limit, checkpoint, stats, silent):
+    from . import duckdb_transform
+    with duckdb_transform.connect(gtfs_path, date, trip_ids, gtfs_stop_id_by_mot_ids, gtfs_route_ids_ride_ids_by_journey_ref, limit) as con:
+        with common.print_memory_usage('Calculating rides first / last stops and start time...', silent=silent):
+            ride_aggregates = duckdb_transform.get_ride_aggregates(con)
+        num_routes = duckdb_transform.get_num_routes(con)
+        upsert_routes_ride_stops(duckdb_transform.iterate_route_ride_stops(con, date), num_routes, checkpoint, stats, silent)
+    update_rides_aggregates_from_dataframe(date, ride_aggregates, stats, silent)
+
+
+def main(date: str, limit: int, debug: bool, silent=False, extracted_workdir=None, resume=False, use_index=None):
+    """Loads the date's stop times to DB, routes are committed in batches and recorded in a checkpoint
+    (see RoutesCheckpoint). If resume is set, routes which were completed by a previous (interrupted) run
+    of the same date / feed are skipped, even if the previous run used a different workdir.
+    The stop times are shared with the other consumers of the date (see shared_feed.get_stop_times),
+    if use_index is set (default: config.GTFS_ETL_STOP_TIMES_INDEX) they are read using the stop_times index."""
     date = common.parse_date_str(date)
     dated_workdir = extracted_workdir if extracted_workdir else common.get_dated_workdir(date)
     stats = defaultdict(int)
     with get_session() as session:
         with common.print_memory_usage('Getting all mot_ids from DB...', silent=silent):
-            gtfs_stop_id_by_mot_ids = {
-                mot_id: gtfs_stop_id
-                for gtfs_stop_id, mot_id
-                in session.execute(dedent("""
-                    select s.id, m.mot_id
-                    from gtfs_stop_mot_id m, gtfs_stop s
-                    where m.gtfs_stop_id = s.id
-                    and s.date = '{}'
-                """.format(date.strftime('%Y-%m-%d')))).fetchall()
-            }
+            gtfs_stop_id_by_mot_ids = db_lookups.get_gtfs_stop_ids_by_mot_id(session, date)
             stats['existing mot ids loaded from DB'] = len(gtfs_stop_id_by_mot_ids)
         with common.print_memory_usage('Getting all route and ride ids from DB...', silent=silent):
-            gtfs_route_ids_ride_ids_by_journey_ref = {
-                gtfs_ride.journey_ref: (gtfs_ride.gtfs_route_id, gtfs_ride.id)
-                for gtfs_ride
-                in session.query(model.GtfsRide).join(model.GtfsRoute.gtfs_rides).where(model.GtfsRoute.date == date).all()
-            }
-    with common.print_memory_usage("Preparing partridge feed...", silent=silent):
-        feed = partridge_helper.prepare_partridge_feed(
-            date, Path(dated_workdir, config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION)
-        )
+            gtfs_route_ids_ride_ids_by_journey_ref = db_lookups.get_gtfs_route_ids_ride_ids_by_journey_ref(session, date)
+    gtfs_path = Path(dated_workdir, config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION)
+    with common.print_memory_usage("Getting trip ids for date...", silent=silent):
+        trip_ids = partridge_helper.get_trip_ids_for_date(gtfs_path, date)
+        stats['trips for date in source data'] = len(trip_ids)
+        trip_ids &= set(gtfs_route_ids_ride_ids_by_journey_ref)
+        stats['trips for date with rides in DB'] = len(trip_ids)
+    checkpoint = RoutesCheckpoint(date, gtfs_path, limit)
+    checkpoint.start(resume, silent)
+    stats['routes skipped (completed in checkpoint)'] = len(checkpoint.completed_gtfs_route_ids)
+    if config.GTFS_ETL_TRANSFORM_ENGINE == 'duckdb':
+        main_duckdb(date, gtfs_path, trip_ids, gtfs_stop_id_by_mot_ids, gtfs_route_ids_ride_ids_by_journey_ref, limit, checkpoint, stats, silent)
+        checkpoint.remove()
+        if not silent:
+            pprint(dict(stats))
+        return stats
+    stop_times = shared_feed.get_trips_stop_times(gtfs_path, date, trip_ids, silent=silent, use_index=True if use_index else None)
     if not silent:
         print("Preparing data for quick loading from disk...")
     rownums_by_route_id = {}
     assert kvfile.db_kind == 'LevelDB', "If not using LevelDB operation is very slow!"
     kv = kvfile.KVFile()
-    stop_times = feed.stop_times
     if limit:
         stop_times = stop_times.head(limit)
+    with common.print_memory_usage('Calculating rides first / last stops and start time...', silent=silent):
+        ride_aggregates = feed_frames.get_ride_aggregates(stop_times)
     for rownum, row in enumerate(stop_times.to_dict('records')):
         if not silent and (debug or rownum % 10000 == 0):
             print('rownum {}'.format(rownum))
@@ -81,7 +266,8 @@ def main(date: str, limit: int, debug: bool, silent=False, extracted_workdir=Non
         gtfs_route_id_ride_id = gtfs_route_ids_ride_ids_by_journey_ref.get(trip_id)
         if gtfs_route_id_ride_id:
             gtfs_route_id, gtfs_ride_id = gtfs_route_id_ride_id
-            if gtfs_route_id and gtfs_ride_id:
+            # rows of routes which were completed according to the checkpoint are not needed
+            if gtfs_route_id and gtfs_ride_id and gtfs_route_id not in checkpoint.completed_gtfs_route_ids:
                 rownums_by_route_id.setdefault(gtfs_route_id, set()).add(rownum)
                 stop_id = int(row['stop_id'])
                 output_row = dict(
@@ -109,48 +295,12 @@ def main(date: str, limit: int, debug: bool, silent=False, extracted_workdir=Non
                         else:
                             raise
                 kv.set(str(rownum), json.dumps(output_row))
-    i = 0
-    for gtfs_route_id, rownums in rownums_by_route_id.items():
-        i += 1
-        if not silent:
-            print("Processing gtfs_route_id {} ({}/{})".format(gtfs_route_id, i, len(rownums_by_route_id)))
-        with get_session() as session:
-            with common.print_memory_usage('Getting all ride_stops from DB...', silent=silent):
-                gtfs_ride_stops_by_gtfs_ride_id_gtfs_stop_id = {
-                    '{}-{}'.format(gtfs_ride_stop.gtfs_ride_id, gtfs_ride_stop.gtfs_stop_id): gtfs_ride_stop
-                    for gtfs_ride_stop
-                    in session.query(model.GtfsRideStop).join(model.GtfsRide.gtfs_ride_stops).where(model.GtfsRide.gtfs_route_id == gtfs_route_id).all()
-                }
-            with common.print_memory_usage('Upserting data...', silent=silent):
-                for rownum in rownums:
-                    row = json.loads(kv.get(str(rownum)))
-                    row['arrival_time'] = datetime.datetime.strptime(row['arrival_time'], '%Y-%m-%d %H:%M:%S %z')
-                    row['departure_time'] = datetime.datetime.strptime(row['departure_time'], '%Y-%m-%d %H:%M:%S %z')
-                    gtfs_ride_stop = gtfs_ride_stops_by_gtfs_ride_id_gtfs_stop_id.get('{}-{}'.format(row['gtfs_ride_id'], row['gtfs_stop_id']))
-                    if gtfs_ride_stop:
-                        stats['rows updated in DB'] += 1
-                        gtfs_ride_stop.arrival_time = row['arrival_time']
-                        gtfs_ride_stop.departure_time = row['departure_time']
-                        gtfs_ride_stop.stop_sequence = row['stop_sequence']
-                        gtfs_ride_stop.pickup_type = row['pickup_type']
-                        gtfs_ride_stop.drop_off_type = row['drop_off_type']
-                        gtfs_ride_stop.shape_dist_traveled = row['shape_dist_traveled']
-                    else:
-                        stats['rows inserted to DB'] += 1
-                        session.add(model.GtfsRideStop(
-                            gtfs_ride_id=row['gtfs_ride_id'],
-                            gtfs_stop_id=row['gtfs_stop_id'],
-                            arrival_time=row['arrival_time'],
-                            departure_time=row['departure_time'],
-                            stop_sequence=row['stop_sequence'],
-                            pickup_type=row['pickup_type'],
-                            drop_off_type=row['drop_off_type'],
-                            shape_dist_traveled=row['shape_dist_traveled'],
-                        ))
-            if not silent:
-                pprint(dict(stats))
-            with common.print_memory_usage('Committing...', silent=silent):
-                session.commit()
+    upsert_routes_ride_stops(
+        ((gtfs_route_id, iterate_kv_ride_stops(kv, rownums)) for gtfs_route_id, rownums in rownums_by_route_id.items()),
+        len(rownums_by_route_id), checkpoint, stats, silent
+    )
+    update_rides_aggregates_from_dataframe(date, ride_aggregates, stats, silent)
+    checkpoint.remove()
     if not silent:
         pprint(dict(stats))
     return stats
@@ -1,84 +1,60 @@
 from pathlib import Path
 from pprint import pprint
-from textwrap import dedent
 from collections import defaultdict
 
 from open_bus_stride_db.db import session_decorator, Session
-from open_bus_stride_db import model
 
-from . import common, config, partridge_helper
+from . import common, config, partridge_helper, feed_frames, db_helper, db_lookups
 
 
-def parse_stop_desc(stop_desc, stats):
-    # רחוב: בן יהודה 74 עיר: כפר סבא רציף:  קומה:
-    try:
-        return stop_desc.split('עיר:')[1].split('רציף:')[0].strip()
-    except Exception:
-        stats['rows failed to parse stop_desc'] += 1
-        return None
+STOP_UPDATE_COLUMNS = ['lat', 'lon', 'name', 'city']
 
 
 @session_decorator
-def main(session: Session, date: str, silent=False, extracted_workdir=None):
+def main(session: Session, date: str, silent=False, extracted_workdir=None, feed=None):
     date = common.parse_date_str(date)
     dated_workdir = extracted_workdir if extracted_workdir else common.get_dated_workdir(date)
     stats = defaultdict(int)
-    with common.print_memory_usage("Preparing partridge feed...", silent=silent):
-        feed = partridge_helper.prepare_partridge_feed(
-            date, Path(dated_workdir, config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION)
-        )
+    if feed is None:
+        with common.print_memory_usage("Preparing partridge feed...", silent=silent):
+            feed = partridge_helper.prepare_partridge_feed(
+                date, Path(dated_workdir, config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION)
+            )
     with common.print_memory_usage('Getting all stops from DB...', silent=silent):
-        gtfs_stops_by_code = {
-            int(gtfs_stop.code): gtfs_stop
-            for gtfs_stop
-            in session.query(model.GtfsStop).where(model.GtfsStop.date == date).all()
-        }
-        stats['existing stops in DB'] = len(gtfs_stops_by_code)
+        db_stops = db_lookups.get_stops_dataframe(session, date)
+        stats['existing stops in DB'] = len(db_stops)
     with common.print_memory_usage('Getting all mot_ids from DB...', silent=silent):
-        mot_ids_by_code = {}
-        for stop_code, mot_id in session.execute(dedent("""
-            select s.code, m.mot_id
-            from gtfs_stop_mot_id m, gtfs_stop s
-            where m.gtfs_stop_id = s.id
-            and s.date = '{}'
-        """.format(date.strftime('%Y-%m-%d')))).fetchall():
-            mot_ids_by_code.setdefault(int(stop_code), set()).add(int(mot_id))
-        stats['existing stops with mot ids in DB'] = len(mot_ids_by_code)
+        db_stop_mot_ids = db_lookups.get_stop_mot_ids_dataframe(session, date)[['code', 'mot_id']]
+        stats['existing stops with mot ids in DB'] = int(db_stop_mot_ids['code'].nunique())
     with common.print_memory_usage('Upserting data...', silent=silent):
-        for row in feed.stops[[
-            'stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'stop_code', 'stop_desc'
-        ]].to_dict('records'):
-            stats['total rows in source data'] += 1
-            stop_id = int(row['stop_id'])
-            stop_code = int(row['stop_code'])
-            stop_city = parse_stop_desc(row['stop_desc'], stats)
-            if stop_code in gtfs_stops_by_code:
-                stats['rows updated in DB'] += 1
-                gtfs_stop = gtfs_stops_by_code[stop_code]
-                gtfs_stop.lat = row['stop_lat']
-                gtfs_stop.lon = row['stop_lon']
-                gtfs_stop.name = row['stop_name']
-                gtfs_stop.city = stop_city
-            else:
-                stats['rows inserted to DB'] += 1
-                gtfs_stop = model.GtfsStop(
-                    date=date,
-                    code=stop_code,
-                    lat=row['stop_lat'],
-                    lon=row['stop_lon'],
-                    name=row['stop_name'],
-                    city=stop_city
-                )
-                session.add(gtfs_stop)
-            if stop_code in mot_ids_by_code:
-                if stop_id not in mot_ids_by_code[stop_code]:
-                    stats['stop mot id rows inserted to DB'] += 1
-                    mot_ids_by_code[stop_code].add(stop_id)
-                    session.add(model.GtfsStopMotId(gtfs_stop=gtfs_stop, mot_id=stop_id))
-            else:
-                stats['stop mot id rows inserted to DB'] += 1
-                mot_ids_by_code[stop_code] = {stop_id}
-                session.add(model.GtfsStopMotId(gtfs_stop=gtfs_stop, mot_id=stop_id))
+        source_stops = feed_frames.get_stops(feed, stats)
+        stats['total rows in source data'] = len(source_stops)
+        # a stop code may appear multiple times (with different mot ids), the last row's details are used
+        stops = source_stops.drop_duplicates('code', keep='last').merge(db_stops, on='code', how='left')
+        is_existing = stops['id'].notna()
+        batcher = db_helper.WriteBatcher('stops', stats)
+        update_stops = stops[is_existing].astype({'id': int})
+        stats['rows updated in DB'] += db_helper.write_dataframe_batches(
+            session, batcher, update_stops,
+            lambda batch: db_helper.update_dataframe(session, 'gtfs_stop', batch, STOP_UPDATE_COLUMNS)
+        )
+        insert_stops = stops[~is_existing].assign(date=date.strftime('%Y-%m-%d'))
+        stats['rows inserted to DB'] += db_helper.write_dataframe_batches(
+            session, batcher, insert_stops,
+            lambda batch: db_helper.copy_dataframe(session, 'gtfs_stop', batch, ['date', 'code', *STOP_UPDATE_COLUMNS])
+        )
+        stop_mot_ids = (
+            source_stops[['code', 'mot_id']].drop_duplicates()
+            .merge(db_stop_mot_ids, on=['code', 'mot_id'], how='left', indicator=True)
+        )
+        stop_mot_ids = stop_mot_ids[stop_mot_ids['_merge'] == 'left_only']
+        if len(stop_mot_ids) > 0:
+            # ids of inserted stops are assigned by the DB
+            stop_mot_ids = stop_mot_ids.merge(db_lookups.get_stops_dataframe(session, date), on='code').rename(columns={'id': 'gtfs_stop_id'})
+            stats['stop mot id rows inserted to DB'] += db_helper.write_dataframe_batches(
+                session, batcher, stop_mot_ids,
+                lambda batch: db_helper.copy_dataframe(session, 'gtfs_stop_mot_id', batch, ['gtfs_stop_id', 'mot_id'])
+            )
     with common.print_memory_usage('Committing...', silent=silent):
         session.commit()
     if not silent:
@@ -0,0 +1,170 @@
+import json
+import traceback
+from pprint import pprint
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from . import common, resources
+
+
+# the loaders of a date and the loaders each of them depends on, loaders without a dependency between them
+# run concurrently (each loader uses its own DB session)
+LOADERS_DEPENDENCIES = {
+    'stops': [],
+    'routes': [],
+    'trips': ['routes'],
+    'stop_times': ['trips', 'stops'],
+    'trip_id_to_date': [],
+    'cluster_to_line': [],
+    'tariff': [],
+}
+
+# mapping of the stats keys of each loader to the aggregated processing stats keys
+LOADERS_STATS_KEYS = {
+    'stops': {
+        'stop rows updated in DB': 'rows updated in DB',
+        'stop rows inserted to DB': 'rows inserted to DB',
+        'stop mot id rows inserted to DB': 'stop mot id rows inserted to DB',
+    },
+    'routes': {
+        'route rows updated in DB': 'rows updated in DB',
+        'route rows insert to DB': 'rows inserted to DB',
+    },
+    'trips': {
+        'load trip rows updated in DB': 'rows updated in DB',
+        'load trip rows inserted to DB': 'rows inserted to DB',
+    },
+    'stop_times': {
+        'stop time rows updated in DB': 'rows updated in DB',
+        'stop time rows inserted to DB': 'rows inserted to DB',
+    },
+    'trip_id_to_date': {'trip_id_to_date rows inserted to DB': 'rows inserted to DB'},
+    'cluster_to_line': {'cluster_to_line rows inserted to DB': 'rows inserted to DB'},
+    'tariff': {'tariff rows inserted to DB': 'rows inserted to DB'},
+}
+
+MOT_DATASETS_LOADERS = ['trip_id_to_date', 'cluster_to_line', 'tariff']
+
+# the loaders which use the date's feed tables, if more than one of them runs the feed is preloaded once (see preload_feed)
+FEED_LOADERS = ['stops', 'routes', 'trips']
+
+
+def get_graph(loaders=None):
+    """Returns the dependencies graph of the given loaders (default: all loaders),
+    dependencies on loaders which are not included are ignored"""
+    loaders = list(loaders or LOADERS_DEPENDENCIES)
+    for loader in loaders:
+        assert loader in LOADERS_DEPENDENCIES, f'invalid loader: {loader}'
+    return {
+        loader: [dependency for dependency in LOADERS_DEPENDENCIES[loader] if dependency in loaders]
+        for loader in loaders
+    }
+
+
+def get_airflow_tasks(loaders=None):
+    """Returns the graph as a list of tasks in the dags.yaml format, each task runs a single loader
+    (using main with loaders=[loader]) and depends on the tasks of its dependencies"""
+    return [
+        {
+            'id': f'load-{loader.replace("_", "-")}',
+            'depends_on': [f'load-{dependency.replace("_", "-")}' for dependency in dependencies],
+            'config': {
+                'type': 'api',
+                'module': 'open_bus_gtfs_etl.loaders_dag',
+                'function': 'main',
+                'kwargs': {'loaders': [loader]},
+            },
+        }
+        for loader, dependencies in get_graph(loaders).items()
+    ]
+
+
+def run_loader(loader, date, extracted_workdir=None, feed=None, resume=False):
+    from . import load_stops_to_db, load_routes_to_db, load_trips_to_db, load_stop_times_to_db, load_mot_datasets_to_db
+    if loader == 'stops':
+        return load_stops_to_db.main(date, silent=True, extracted_workdir=extracted_workdir, feed=feed)
+    elif loader == 'routes':
+        return load_routes_to_db.main(date, silent=True, extracted_workdir=extracted_workdir, feed=feed)
+    elif loader == 'trips':
+        return load_trips_to_db.main(date, silent=True, extracted_workdir=extracted_workdir, feed=feed)
+    elif loader == 'stop_times':
+        return load_stop_times_to_db.main(date=date, limit=0, debug=False, silent=True, extracted_workdir=extracted_workdir, resume=resume)
+    else:
+        return load_mot_datasets_to_db.main(date, loader, silent=True, extracted_workdir=extracted_workdir)
+
+
+def preload_feed(date, extracted_workdir=None, silent=False):
+    from pathlib import Path
+    from . import config, partridge_helper
+    date = common.parse_date_str(date)
+    dated_workdir = extracted_workdir if extracted_workdir else common.get_dated_workdir(date)
+    with common.print_memory_usage('Preloading feed...', silent=silent):
+        return partridge_helper.preload_partridge_feed(date, Path(dated_workdir, config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION))
+
+
+def add_loader_stats(stats, loader, loader_stats):
+    for key, loader_key in LOADERS_STATS_KEYS[loader].items():
+        stats[key] += loader_stats[loader_key]
+
+
+def main(date=None, extracted_workdir=None, feed=None, loaders=None, max_workers=None, resume=False, silent=False, stats=None,
+         optional_loaders=None):
+    """Runs the loaders of the date (default: all loaders) - each loader starts as soon as all its dependencies completed,
+    up to max_workers loaders run concurrently. If a loader fails, no new loaders are started and the exception is raised
+    after the running loaders completed. On SIGTERM (or when the run was aborted, see common.run_aborted) no new loaders
+    are started and the running loaders complete their current batch (see common.graceful_sigterm). Returns the aggregated stats (see LOADERS_STATS_KEYS).
+    The feed (if not provided) is preloaded once for the feed loaders (see FEED_LOADERS) and released as soon as they completed,
+    so that it's not held while the stop times are loaded.
+    Failures of optional_loaders (e.g. MOT_DATASETS_LOADERS, which are independent of the core GTFS data) are printed
+    and counted in the stats ("<loader> loader errors") instead of failing the run."""
+    graph = get_graph(loaders)
+    optional_loaders = set(optional_loaders or [])
+    feed_loaders = [loader for loader in FEED_LOADERS if loader in graph]
+    if feed is None and len(feed_loaders) > 1:
+        feed = preload_feed(date, extracted_workdir, silent=silent)
+    max_workers = int(max_workers or resources.get_tuning()['db_writers'])
+    if stats is None:
+        stats = defaultdict(int)
+    pending = dict(graph)
+    completed = set()
+    running = {}
+    error = None
+    with common.graceful_sigterm(), ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            if error is None and not common.is_stop_requested():
+                for loader, dependencies in list(pending.items()):
+                    if all(dependency in completed for dependency in dependencies):
+                        del pending[loader]
+                        running[executor.submit(run_loader, loader, date, extracted_workdir, feed, resume)] = loader
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                loader = running.pop(future)
+                if future.exception() is not None:
+                    if loader in optional_loaders:
+                        print(f'WARNING! optional loader {loader} failed')
+                        traceback.print_exception(type(future.exception()), future.exception(), future.exception().__traceback__)
+                        stats[f'{loader} loader errors'] += 1
+                    elif error is None:
+                        error = future.exception()
+                    continue
+                loader_stats = future.result()
+                completed.add(loader)
+                if all(feed_loader in completed for feed_loader in feed_loaders):
+                    feed = None
+                add_loader_stats(stats, loader, loader_stats)
+                if not silent:
+                    print(f"Loaded {loader}")
+                    pprint(dict(loader_stats))
+    if error is not None:
+        raise error
+    assert not pending, f'Interrupted by SIGTERM / aborted run before running loaders: {", ".join(pending)}'
+    return stats
+
+
+def print_graph(loaders=None, airflow=False):
+    if airflow:
+        print(json.dumps(get_airflow_tasks(loaders), indent=2))
+    else:
+        print(json.dumps(get_graph(loaders), indent=2))
@@ -1,13 +1,36 @@
+import io
+import csv
 import datetime
-from functools import lru_cache
 from pathlib import Path
 
 import numpy as np
+import pandas as pd
 import partridge as ptg
+from partridge.config import default_config as get_partridge_default_config
+
+from . import common, config, calendar_index, resources, stop_times_index
+
+
+# the typed reader profile for stop_times.txt, arrival_time / departure_time are read as categories
+# so that each distinct time string is parsed only once and then converted to Int32 seconds
+STOP_TIMES_READ_DTYPES = {
+    'trip_id': 'category',
+    'arrival_time': 'category',
+    'departure_time': 'category',
+    'stop_id': 'int32',
+    'stop_sequence': 'int32',
+    'pickup_type': 'float32',
+    'drop_off_type': 'float32',
+    'shape_dist_traveled': 'float32',
+}
 
 
 def get_partridge_filter_for_date(zip_path: str, date: datetime.date):
-    service_ids = ptg.read_service_ids_by_date(zip_path)[date]
+    if Path(zip_path).is_dir():
+        service_ids = calendar_index.get_service_ids(zip_path, date)
+        calendar_index.warn_if_no_trips(zip_path, date)
+    else:
+        service_ids = ptg.read_service_ids_by_date(zip_path)[date]
 
     return {
         'trips.txt': {
@@ -16,33 +39,168 @@ def get_partridge_filter_for_date(zip_path: str, date: datetime.date):
     }
 
 
-def get_partridge_feed_by_date(zip_path: Path, date: datetime.date):
+def get_partridge_feed_by_date(zip_path: Path, date: datetime.date, partridge_config=None):
     zip_path = zip_path.as_posix()
-    return ptg.feed(zip_path, view=get_partridge_filter_for_date(zip_path, date))
+    return ptg.feed(zip_path, view=get_partridge_filter_for_date(zip_path, date), config=partridge_config)
 
 
 def prepare_partridge_feed(date: datetime.date, gtfs_file_full_path: Path):
-    return get_partridge_feed_by_date(gtfs_file_full_path, date)
-
-
-# Copied from partridge parsers, with a deletion of the seconds field
-# it is used to to parse TripIdToDate since the departure time is in HH:MM format
-# Why 2^17? See https://git.io/vxB2P.
-@lru_cache(maxsize=2 ** 17)
-def parse_time_no_seconds(val: str) -> np.float64:
-    if val is np.nan:
-        return val
-
-    val = val.strip()
-
-    if val == "":
-        return np.nan
-
-    h, m = val.split(":")
-    ssm = int(h) * 3600 + int(m) * 60
-
-    # pandas doesn't have a NaN int, use floats
-    return np.float64(ssm)
-
-
-parse_time_no_seconds_column = np.vectorize(parse_time_no_seconds)
+    """Returns the feed filtered for the date using the configured engine (see config.GTFS_ETL_FEED_ENGINE)"""
+    if config.GTFS_ETL_FEED_ENGINE == 'arrow':
+        from . import arrow_feed
+        return arrow_feed.ArrowFeed(gtfs_file_full_path, date)
+    else:
+        return get_partridge_feed_by_date(gtfs_file_full_path, date)
+
+
+def get_partridge_config_without_stops_pruning():
+    """Returns partridge's default config without the dependency of stops on stop times,
+    otherwise getting the stops parses (untyped) and caches the date's stop_times.txt"""
+    partridge_config = get_partridge_default_config()
+    partridge_config.remove_edge('stops.txt', 'stop_times.txt')
+    return partridge_config
+
+
+class PreloadedFeed:
+    """The tables of a date's feed which are used by the stops / routes / trips loaders (see preload_partridge_feed)"""
+
+    def __init__(self, agency, stops, routes, trips):
+        self.agency = agency
+        self.stops = stops
+        self.routes = routes
+        self.trips = trips
+
+
+def preload_partridge_feed(date: datetime.date, gtfs_file_full_path: Path):
+    """Parses the tables used by the stops / routes / trips loaders, so that the feed can be passed to the loaders
+    without any additional parsing. Partridge prunes the stops by the date's stop times, for which it parses
+    stop_times.txt untyped and keeps it cached, instead the stops are pruned by the stop ids of the date's typed
+    stop times (which are then shared with the stop times loader, see shared_feed) and only the loaders' tables are kept."""
+    if config.GTFS_ETL_FEED_ENGINE == 'arrow':
+        # the arrow feed prunes the stops without keeping the stop times (see arrow_feed.ArrowFeed.stops)
+        feed = prepare_partridge_feed(date, gtfs_file_full_path)
+        return PreloadedFeed(feed.agency, feed.stops, feed.routes, feed.trips)
+    from . import shared_feed
+    feed = get_partridge_feed_by_date(gtfs_file_full_path, date, partridge_config=get_partridge_config_without_stops_pruning())
+    trips = feed.trips
+    stop_ids = shared_feed.get_stop_times(gtfs_file_full_path, date, silent=True)['stop_id'].unique()
+    stops = feed.stops
+    stops = stops[stops['stop_id'].isin({str(stop_id) for stop_id in stop_ids})].reset_index(drop=True)
+    return PreloadedFeed(feed.agency, stops, feed.routes, trips)
+
+
+def parse_time_seconds(values, with_seconds=True) -> np.ndarray:
+    """Vectorized parsing of HH:MM:SS (or HH:MM if with_seconds is False) times to seconds,
+    returns a float64 array with nan for empty / invalid values.
+    Values are converted to categories so that each distinct time string is parsed only once."""
+    values = pd.Series(values)
+    if not pd.api.types.is_categorical_dtype(values):
+        values = values.astype('category')
+    if len(values.cat.categories) == 0:
+        return np.full(len(values), np.nan)
+    num_parts = 3 if with_seconds else 2
+    parts = pd.Series(values.cat.categories.astype(str)).str.strip().str.split(':', expand=True).reindex(columns=range(num_parts))
+    categories_seconds = pd.to_numeric(parts[0], errors='coerce') * 3600 + pd.to_numeric(parts[1], errors='coerce') * 60
+    if with_seconds:
+        categories_seconds += pd.to_numeric(parts[2], errors='coerce')
+    categories_seconds = categories_seconds.to_numpy(dtype=np.float64)
+    codes = values.cat.codes.to_numpy()
+    return np.where(codes >= 0, categories_seconds[np.maximum(codes, 0)], np.nan)
+
+
+def parse_time_no_seconds_column(values) -> np.ndarray:
+    """Parses HH:MM times (e.g. TripIdToDate departure times) to seconds"""
+    return parse_time_seconds(values, with_seconds=False)
+
+
+def parse_time_column(values: pd.Series) -> pd.Series:
+    """Vectorized parsing of gtfs HH:MM:SS times (hours can be more than 24) to seconds, returns Int32 series"""
+    return pd.Series(parse_time_seconds(values), index=values.index).astype('Int32')
+
+
+def get_frame_memory_mb(df: pd.DataFrame):
+    return df.memory_usage(deep=True).sum() / (1024 * 1024)
+
+
+def get_service_ids_for_date(gtfs_path: Path, date: datetime.date) -> set:
+    """Returns the service ids which are active on the given date according to calendar.txt and calendar_dates.txt
+    (looked up in the feed's calendar index, see calendar_index.get_index)"""
+    return calendar_index.get_service_ids(gtfs_path, date)
+
+
+def get_trip_ids_for_date(gtfs_path: Path, date: datetime.date) -> set:
+    service_ids = get_service_ids_for_date(gtfs_path, date)
+    calendar_index.warn_if_no_trips(gtfs_path, date)
+    trips = pd.read_csv(Path(gtfs_path, 'trips.txt'), usecols=['service_id', 'trip_id'], dtype=str)
+    return set(trips[trips['service_id'].isin(service_ids)]['trip_id'])
+
+
+def get_line_field(line: bytes, field_index):
+    """Returns the raw bytes of a field of a csv line, lines which contain quotes are parsed with the csv module
+    (quoted fields must not contain line breaks). Returns None if the line has less fields."""
+    line = line.rstrip(b'\r\n')
+    if b'"' in line:
+        fields = [field.encode() for field in next(csv.reader([line.decode('utf-8-sig')]), [])]
+    else:
+        fields = line.split(b',', field_index + 1)
+    return fields[field_index] if field_index < len(fields) else None
+
+
+def iterate_prefiltered_stop_times_chunks(stop_times_path: Path, trip_ids, chunk_bytes=None):
+    """Reads the stop_times file in chunks of bytes and yields only the lines of the given trip_ids (first yield is the header).
+    Lines are filtered on the raw bytes, so non-matching lines are never parsed (see get_line_field).
+    The chunk size defaults to the resources tuning (see resources.get_tuning)"""
+    chunk_bytes = int(chunk_bytes or resources.get_tuning()['stop_times_chunk_bytes'])
+    trip_ids = {trip_id.encode() for trip_id in trip_ids}
+    with open(stop_times_path, 'rb') as f:
+        header = f.readline()
+        yield header
+        trip_id_index = [column.strip() for column in next(csv.reader([header.decode('utf-8-sig')]))].index('trip_id')
+
+        def filter_lines(lines):
+            return b''.join(line for line in lines if get_line_field(line, trip_id_index) in trip_ids)
+
+        remainder = b''
+        while True:
+            chunk = f.read(chunk_bytes)
+            if not chunk:
+                break
+            chunk = remainder + chunk
+            last_newline = chunk.rfind(b'\n') + 1
+            remainder = chunk[last_newline:]
+            yield filter_lines(chunk[:last_newline].splitlines(keepends=True))
+        if remainder.strip():
+            yield filter_lines([remainder])
+
+
+def read_stop_times_typed(gtfs_path: Path, trip_ids=None, silent=False, use_index=None) -> pd.DataFrame:
+    """Reads stop_times.txt from an extracted GTFS directory directly to the typed profile:
+    categorical trip_id, Int32 seconds arrival / departure times, int32 stop_id / stop_sequence,
+    int8 pickup_type / drop_off_type and float32 shape_dist_traveled.
+    If trip_ids is provided, lines of other trips are skipped before parsing (see iterate_prefiltered_stop_times_chunks),
+    or if use_index is set (default: config.GTFS_ETL_STOP_TIMES_INDEX) only the lines of the trips are read (see stop_times_index).
+    With the arrow feed engine (see config.GTFS_ETL_FEED_ENGINE) the lines are parsed by pyarrow's multithreaded reader."""
+    if use_index is None:
+        use_index = config.GTFS_ETL_STOP_TIMES_INDEX
+    stop_times_path = Path(gtfs_path, 'stop_times.txt')
+    with common.print_memory_usage('Reading typed stop times from {}...'.format(stop_times_path), silent=silent):
+        if trip_ids is None:
+            source = stop_times_path
+        elif use_index:
+            source = io.BytesIO(b''.join(stop_times_index.iterate_trips_bytes(gtfs_path, trip_ids)))
+        else:
+            source = io.BytesIO(b''.join(iterate_prefiltered_stop_times_chunks(stop_times_path, trip_ids)))
+        if config.GTFS_ETL_FEED_ENGINE == 'arrow':
+            from . import arrow_feed
+            stop_times = arrow_feed.read_stop_times_typed(source)
+        else:
+            stop_times = pd.read_csv(source, usecols=list(STOP_TIMES_READ_DTYPES), dtype=STOP_TIMES_READ_DTYPES)
+        if not silent:
+            print("stop_times memory footprint as read: {:.2f}mb".format(get_frame_memory_mb(stop_times)))
+        for column in ['arrival_time', 'departure_time']:
+            stop_times[column] = parse_time_column(stop_times[column])
+        for column in ['pickup_type', 'drop_off_type']:
+            stop_times[column] = stop_times[column].fillna(0).astype('int8')
+        if not silent:
+            print("stop_times memory footprint with typed profile: {:.2f}mb ({} rows)".format(get_frame_memory_mb(stop_times), len(stop_times)))
+    return stop_times
@@ -0,0 +1,32 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+def iterate_prefetched(items, prefetch_func, num_prefetch, cleanup_func=None):
+    """Yields (item, prefetch_func(item)) for each item in order, while prefetch_func already runs
+    for up to num_prefetch of the following items in background threads.
+    If the iteration is stopped early (e.g. due to an exception in the consumer), cleanup_func is called
+    for the results of items which were prefetched but not yielded."""
+    items = iter(items)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=num_prefetch) as executor:
+
+        def submit_next():
+            for item in items:
+                pending.append((item, executor.submit(prefetch_func, item)))
+                break
+
+        try:
+            for _ in range(num_prefetch):
+                submit_next()
+            while pending:
+                item, future = pending.popleft()
+                result = future.result()
+                submit_next()
+                yield item, result
+        finally:
+            for item, future in pending:
+                future.cancel()
+            for item, future in pending:
+                if cleanup_func and not future.cancelled() and future.exception() is None:
+                    cleanup_func(future.result())
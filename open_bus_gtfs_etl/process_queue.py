@@ -0,0 +1,172 @@
+import os
+import socket
+import threading
+from textwrap import dedent
+
+from sqlalchemy import text
+
+from open_bus_stride_db.db import get_session
+
+from . import common, config
+
+
+QUEUE_TABLE_NAME = 'gtfs_etl_process_queue'
+
+# status of a queue item: pending -> claimed (by a worker, while its lease is valid) -> done / failed
+# a claimed item with an expired lease (the worker died) can be claimed again by another worker, unless it reached
+# max attempts (e.g. the date crashes its workers every time) - then it's marked as failed
+STATUS_PENDING = 'pending'
+STATUS_CLAIMED = 'claimed'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+
+def get_worker_id():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+def create_table(session):
+    session.execute(dedent("""
+        create table if not exists {} (
+            date date primary key,
+            download_from_stride_date date not null,
+            status text not null,
+            worker_id text,
+            lease_expires_at timestamp with time zone,
+            heartbeat_at timestamp with time zone,
+            attempts integer not null default 0,
+            error text,
+            enqueued_at timestamp with time zone not null default now(),
+            completed_at timestamp with time zone
+        )
+    """.format(QUEUE_TABLE_NAME)))
+    session.execute('create index if not exists ix_{0}_status on {0} (status)'.format(QUEUE_TABLE_NAME))
+
+
+def enqueue(session, date, download_from_stride_date, max_attempts=None):
+    """Adds a date which needs processing to the queue, or returns it to pending if it was completed or failed
+    (as long as it didn't reach max attempts). Claimed dates are not changed. Returns True if the date is pending."""
+    max_attempts = int(max_attempts or config.GTFS_ETL_PROCESS_QUEUE_MAX_ATTEMPTS)
+    return session.execute(text(dedent("""
+        insert into {0} (date, download_from_stride_date, status) values (:date, :download_from_stride_date, :pending)
+        on conflict (date) do update set
+            download_from_stride_date = excluded.download_from_stride_date, status = :pending, error = null,
+            attempts = case when {0}.status = :done then 0 else {0}.attempts end
+        where {0}.status = :done or ({0}.status = :failed and {0}.attempts < :max_attempts)
+    """.format(QUEUE_TABLE_NAME))), {
+        'date': date, 'download_from_stride_date': download_from_stride_date, 'max_attempts': max_attempts,
+        'pending': STATUS_PENDING, 'done': STATUS_DONE, 'failed': STATUS_FAILED,
+    }).rowcount > 0
+
+
+def fail_expired(session, max_attempts=None):
+    """Marks claimed dates with an expired lease which reached max attempts as failed, returns the number of dates"""
+    max_attempts = int(max_attempts or config.GTFS_ETL_PROCESS_QUEUE_MAX_ATTEMPTS)
+    return session.execute(text(dedent("""
+        update {} set status = :failed, error = :error, completed_at = now(), lease_expires_at = null
+        where status = :claimed and lease_expires_at < now() and attempts >= :max_attempts
+    """.format(QUEUE_TABLE_NAME))), {
+        'max_attempts': max_attempts, 'failed': STATUS_FAILED, 'claimed': STATUS_CLAIMED,
+        'error': 'lease expired after {} attempts (the worker died or was stuck)'.format(max_attempts),
+    }).rowcount
+
+
+def claim(session, worker_id, lease_seconds=None, max_attempts=None):
+    """Claims the newest pending date (or a claimed date with an expired lease which didn't reach max attempts),
+    rows locked by other workers are skipped so that concurrent workers never claim the same date.
+    Expired dates which reached max attempts are marked as failed (see fail_expired).
+    Returns (date, download_from_stride_date) or None if there is nothing to claim."""
+    lease_seconds = int(lease_seconds or config.GTFS_ETL_PROCESS_QUEUE_LEASE_SECONDS)
+    max_attempts = int(max_attempts or config.GTFS_ETL_PROCESS_QUEUE_MAX_ATTEMPTS)
+    fail_expired(session, max_attempts)
+    row = session.execute(text(dedent("""
+        update {0} q set
+            status = :claimed, worker_id = :worker_id, attempts = q.attempts + 1,
+            heartbeat_at = now(), lease_expires_at = now() + make_interval(secs => :lease_seconds)
+        where q.date = (
+            select date from {0}
+            where status = :pending or (status = :claimed and lease_expires_at < now() and attempts < :max_attempts)
+            order by date desc
+            limit 1
+            for update skip locked
+        )
+        returning q.date, q.download_from_stride_date
+    """.format(QUEUE_TABLE_NAME))), {
+        'worker_id': worker_id, 'lease_seconds': lease_seconds, 'max_attempts': max_attempts,
+        'pending': STATUS_PENDING, 'claimed': STATUS_CLAIMED,
+    }).fetchone()
+    return (row.date, row.download_from_stride_date) if row else None
+
+
+def renew_lease(session, date, worker_id, lease_seconds=None):
+    """Extends the lease of a date claimed by the worker, returns False if the worker doesn't hold the lease anymore"""
+    lease_seconds = int(lease_seconds or config.GTFS_ETL_PROCESS_QUEUE_LEASE_SECONDS)
+    return session.execute(text(dedent("""
+        update {} set heartbeat_at = now(), lease_expires_at = now() + make_interval(secs => :lease_seconds)
+        where date = :date and worker_id = :worker_id and status = :claimed
+    """.format(QUEUE_TABLE_NAME))), {
+        'date': date, 'worker_id': worker_id, 'lease_seconds': lease_seconds, 'claimed': STATUS_CLAIMED,
+    }).rowcount > 0
+
+
+def complete(session, date, worker_id, error=None):
+    """Marks a date claimed by the worker as done, or as failed if error is set"""
+    return session.execute(text(dedent("""
+        update {} set status = :status, error = :error, completed_at = now(), lease_expires_at = null
+        where date = :date and worker_id = :worker_id and status = :claimed
+    """.format(QUEUE_TABLE_NAME))), {
+        'date': date, 'worker_id': worker_id, 'error': error,
+        'status': STATUS_FAILED if error else STATUS_DONE, 'claimed': STATUS_CLAIMED,
+    }).rowcount > 0
+
+
+def release(session, date, worker_id):
+    """Returns a date claimed by the worker to pending without counting the attempt (e.g. when the worker was stopped)"""
+    return session.execute(text(dedent("""
+        update {} set status = :pending, worker_id = null, lease_expires_at = null, attempts = greatest(attempts - 1, 0)
+        where date = :date and worker_id = :worker_id and status = :claimed
+    """.format(QUEUE_TABLE_NAME))), {
+        'date': date, 'worker_id': worker_id, 'pending': STATUS_PENDING, 'claimed': STATUS_CLAIMED,
+    }).rowcount > 0
+
+
+class LeaseHeartbeat(threading.Thread):
+    """Renews the lease of a claimed date in a background thread (with its own DB session) while it's processed.
+    If the lease was lost (e.g. the worker was stuck longer than the lease and another worker claimed the date),
+    lease_lost is set and the run is aborted (see common.run_aborted), so that the loaders stop after their current batch."""
+
+    def __init__(self, date, worker_id, lease_seconds=None):
+        super().__init__(daemon=True)
+        self.date = date
+        self.worker_id = worker_id
+        self.lease_seconds = int(lease_seconds or config.GTFS_ETL_PROCESS_QUEUE_LEASE_SECONDS)
+        self.stopped = threading.Event()
+        self.lease_lost = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                with get_session() as session:
+                    renewed = renew_lease(session, self.date, self.worker_id, self.lease_seconds)
+                    session.commit()
+            except Exception as e:
+                # a temporary DB error should not stop the heartbeat, the lease is still valid until it expires
+                print("WARNING! failed to renew lease of date {}: {}".format(self.date, e))
+                continue
+            if not renewed:
+                print("WARNING! lost lease of date {}".format(self.date))
+                self.lease_lost.set()
+                common.run_aborted.set()
+                break
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def __enter__(self):
+        common.run_aborted.clear()
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
@@ -1,114 +1,144 @@
-from . import common
+import datetime
+from pprint import pprint
 from textwrap import dedent
+from contextlib import contextmanager
+from collections import defaultdict
+
+from open_bus_stride_db.db import get_session
+
+from . import common
 
 
-def main(dates):
-    dates_where = []
-    for date in dates:
-        dates_where.append(f"'{common.parse_date_str(date)}'")
-    dates_where = 'date in (' + ', '.join(dates_where) + ')'
-    print(dedent(f"""
--- Before attempting this you should stop the airflow processing:
--- Disable autosync for the openbus application in the argocd app configuration yaml
--- Scale the airflow scheduler deployment to 0
--- Wait for the airflow scheduler pod to be terminated
-
--- Following SQL deletes all gtfs date details
--- note that this is highly dependant on the current state of the code and it might not work in the future
--- Last updated: May 9, 2023
-
-alter table siri_ride disable TRIGGER all;
-
-update siri_ride
-set route_gtfs_ride_id = null, scheduled_time_gtfs_ride_id = null, journey_gtfs_ride_id = null, gtfs_ride_id = null
-from gtfs_ride, gtfs_route
-where gtfs_route.{dates_where}
-and gtfs_route.id = gtfs_ride.gtfs_route_id
-and gtfs_ride.id = siri_ride.route_gtfs_ride_id;
-
-update siri_ride
-set route_gtfs_ride_id = null, scheduled_time_gtfs_ride_id = null, journey_gtfs_ride_id = null, gtfs_ride_id = null
-from gtfs_ride, gtfs_route
-where gtfs_route.{dates_where}
-and gtfs_route.id = gtfs_ride.gtfs_route_id
-and gtfs_ride.id = siri_ride.gtfs_ride_id;
-
-update siri_ride
-set route_gtfs_ride_id = null, scheduled_time_gtfs_ride_id = null, journey_gtfs_ride_id = null, gtfs_ride_id = null
-from gtfs_ride, gtfs_route
-where gtfs_route.{dates_where}
-and gtfs_route.id = gtfs_ride.gtfs_route_id
-and gtfs_ride.id = siri_ride.journey_gtfs_ride_id;
-
-update siri_ride
-set route_gtfs_ride_id = null, scheduled_time_gtfs_ride_id = null, journey_gtfs_ride_id = null, gtfs_ride_id = null
-from gtfs_ride, gtfs_route
-where gtfs_route.{dates_where}
-and gtfs_route.id = gtfs_ride.gtfs_route_id
-and gtfs_ride.id = siri_ride.scheduled_time_gtfs_ride_id;
-
-alter table siri_ride enable TRIGGER all;
-
-update siri_ride_stop set gtfs_stop_id = null
-from gtfs_stop
-where gtfs_stop.{dates_where}
-and gtfs_stop.id = siri_ride_stop.gtfs_stop_id;
-
-DROP INDEX public.ix_gtfs_ride_gtfs_route_id;
-DROP INDEX public.ix_gtfs_ride_journey_ref;
-DROP INDEX public.ix_gtfs_ride_start_time;
-alter table gtfs_ride drop constraint fk_gtfs_ride_first_gtfs_ride_stop_id_gtfs_ride_stop;
-alter table gtfs_ride drop constraint fk_gtfs_ride_last_gtfs_ride_stop_id_gtfs_ride_stop;
-alter table gtfs_ride disable TRIGGER all;
-
-delete from gtfs_ride_stop
-using gtfs_ride, gtfs_route
-where gtfs_route.{dates_where}
-and gtfs_route.id = gtfs_ride.gtfs_route_id
-and gtfs_ride.id = gtfs_ride_stop.gtfs_ride_id;
-
-delete from gtfs_ride_stop
-using gtfs_stop
-where gtfs_stop.{dates_where}
-and gtfs_stop.id = gtfs_ride_stop.gtfs_stop_id;
-
-DELETE FROM gtfs_ride
-USING gtfs_route
-WHERE gtfs_ride.gtfs_route_id = gtfs_route.id
-AND gtfs_route.{dates_where};
-
-alter table gtfs_ride enable TRIGGER all;
-alter table public.gtfs_ride add constraint fk_gtfs_ride_first_gtfs_ride_stop_id_gtfs_ride_stop
-    foreign key (first_gtfs_ride_stop_id) references public.gtfs_ride_stop;
-alter table public.gtfs_ride add constraint fk_gtfs_ride_last_gtfs_ride_stop_id_gtfs_ride_stop
-    foreign key (last_gtfs_ride_stop_id) references public.gtfs_ride_stop;
-CREATE INDEX ix_gtfs_ride_gtfs_route_id ON public.gtfs_ride (gtfs_route_id);
-CREATE INDEX ix_gtfs_ride_journey_ref ON public.gtfs_ride (journey_ref);
-CREATE INDEX ix_gtfs_ride_start_time ON public.gtfs_ride (start_time);
-
-delete from gtfs_route
-where {dates_where};
-
-delete from gtfs_stop_mot_id
-using gtfs_stop
-where gtfs_stop_mot_id.id = gtfs_stop.id
-and gtfs_stop.{dates_where};
-
-delete from gtfs_stop
-where {dates_where};
-
-update gtfs_data
-set
-    processing_started_at = null,
-    processing_completed_at = null,
-    processing_error = null,
-    processing_success = null,
-    processing_used_stride_date = null,
-    download_upload_started_at = null,
-    download_upload_completed_at = null,
-    download_upload_error = null,
-    download_upload_success = true
-where {dates_where};
-
--- The hourly gtfs processing task should now be able to process the data
-    """))
+DEFAULT_BATCH_SIZE = 5000
+
+
+def iterate_batches(ids, batch_size):
+    for i in range(0, len(ids), batch_size):
+        yield ids[i:i + batch_size]
+
+
+def get_ids(session, sql):
+    return sorted(row[0] for row in session.execute(dedent(sql)))
+
+
+def get_purge_ids(session, dates_where, batch_size=DEFAULT_BATCH_SIZE):
+    route_ids = get_ids(session, f"select id from gtfs_route where {dates_where}")
+    stop_ids = get_ids(session, f"select id from gtfs_stop where {dates_where}")
+    ride_ids = []
+    for batch in iterate_batches(route_ids, batch_size):
+        ride_ids += get_ids(session, f"select id from gtfs_ride where gtfs_route_id in ({', '.join(map(str, batch))})")
+    return sorted(ride_ids), stop_ids, route_ids
+
+
+def execute_batches(session, stats, stat_name, ids, batch_size, sql_template, dry_run, silent):
+    """Executes the sql template for each batch of ids, sql_template should include {ids} which is replaced
+    with a comma-separated list of ids, commits after each batch so that locks are held for a short time only"""
+    num_batches = (len(ids) + batch_size - 1) // batch_size
+    if dry_run:
+        if not silent:
+            print('{}: {} ids in {} batches (dry run)'.format(stat_name, len(ids), num_batches))
+        return
+    for batch_num, batch in enumerate(iterate_batches(ids, batch_size), start=1):
+        start_time = datetime.datetime.now()
+        stats[stat_name] += session.execute(dedent(sql_template.format(ids=', '.join(map(str, batch))))).rowcount
+        session.commit()
+        if not silent:
+            print('{} ({}/{} batches, ids {}-{}): {} rows, {} seconds'.format(
+                stat_name, batch_num, num_batches, batch[0], batch[-1], stats[stat_name],
+                (datetime.datetime.now() - start_time).total_seconds()
+            ))
+
+
+@contextmanager
+def disabled_triggers(session, table_name, dry_run, silent):
+    """Disables all the triggers of the table (including its foreign key checks) while the block runs, so that
+    the batched updates / deletes don't run the referential integrity checks for each row. The triggers are
+    enabled again even if the block failed."""
+    if dry_run:
+        yield
+        return
+    if not silent:
+        print(f'Disabling triggers of {table_name}')
+    session.execute(f'alter table {table_name} disable trigger all')
+    session.commit()
+    try:
+        yield
+    finally:
+        session.rollback()
+        if not silent:
+            print(f'Enabling triggers of {table_name}')
+        session.execute(f'alter table {table_name} enable trigger all')
+        session.commit()
+
+
+def main(dates, dry_run=False, batch_size=DEFAULT_BATCH_SIZE, silent=False):
+    """Deletes all the GTFS data of the given dates from the DB and marks them for reprocessing.
+    All the relevant ids are collected first and then deleted / dereferenced in small batches by primary key,
+    so it doesn't require dropping indexes on gtfs_ride. The triggers of siri_ride and gtfs_ride are disabled
+    while they are updated / deleted (see disabled_triggers), so the processing should be stopped while it runs.
+    """
+    assert dates, 'must provide at least one date'
+    batch_size = int(batch_size)
+    stats = defaultdict(int)
+    dates_where = 'date in (' + ', '.join(f"'{common.parse_date_str(date)}'" for date in dates) + ')'
+    with get_session() as session:
+        with common.print_memory_usage('Collecting ids to purge...', silent=silent):
+            ride_ids, stop_ids, route_ids = get_purge_ids(session, dates_where, batch_size)
+            stats['gtfs_ride ids to purge'] = len(ride_ids)
+            stats['gtfs_stop ids to purge'] = len(stop_ids)
+            stats['gtfs_route ids to purge'] = len(route_ids)
+            if not silent:
+                pprint(dict(stats))
+        with disabled_triggers(session, 'siri_ride', dry_run, silent):
+            for column in ['route_gtfs_ride_id', 'scheduled_time_gtfs_ride_id', 'journey_gtfs_ride_id', 'gtfs_ride_id']:
+                execute_batches(session, stats, f'siri_ride rows dereferenced by {column}', ride_ids, batch_size, f"""
+                    update siri_ride
+                    set route_gtfs_ride_id = null, scheduled_time_gtfs_ride_id = null, journey_gtfs_ride_id = null, gtfs_ride_id = null
+                    where {column} in ({{ids}})
+                """, dry_run, silent)
+        execute_batches(session, stats, 'siri_ride_stop rows dereferenced', stop_ids, batch_size, """
+            update siri_ride_stop set gtfs_stop_id = null where gtfs_stop_id in ({ids})
+        """, dry_run, silent)
+        with disabled_triggers(session, 'gtfs_ride', dry_run, silent):
+            execute_batches(session, stats, 'gtfs_ride first / last ride stops dereferenced', ride_ids, batch_size, """
+                update gtfs_ride set first_gtfs_ride_stop_id = null, last_gtfs_ride_stop_id = null
+                where id in ({ids}) and (first_gtfs_ride_stop_id is not null or last_gtfs_ride_stop_id is not null)
+            """, dry_run, silent)
+            execute_batches(session, stats, 'gtfs_ride_stop rows deleted by ride', ride_ids, batch_size, """
+                delete from gtfs_ride_stop where gtfs_ride_id in ({ids})
+            """, dry_run, silent)
+            execute_batches(session, stats, 'gtfs_ride_stop rows deleted by stop', stop_ids, batch_size, """
+                delete from gtfs_ride_stop where gtfs_stop_id in ({ids})
+            """, dry_run, silent)
+            execute_batches(session, stats, 'gtfs_ride rows deleted', ride_ids, batch_size, """
+                delete from gtfs_ride where id in ({ids})
+            """, dry_run, silent)
+        execute_batches(session, stats, 'gtfs_route rows deleted', route_ids, batch_size, """
+            delete from gtfs_route where id in ({ids})
+        """, dry_run, silent)
+        execute_batches(session, stats, 'gtfs_stop_mot_id rows deleted', stop_ids, batch_size, """
+            delete from gtfs_stop_mot_id where gtfs_stop_id in ({ids})
+        """, dry_run, silent)
+        execute_batches(session, stats, 'gtfs_stop rows deleted', stop_ids, batch_size, """
+            delete from gtfs_stop where id in ({ids})
+        """, dry_run, silent)
+        if not dry_run:
+            stats['gtfs_data rows reset'] += session.execute(dedent(f"""
+                update gtfs_data
+                set
+                    processing_started_at = null,
+                    processing_completed_at = null,
+                    processing_error = null,
+                    processing_success = null,
+                    processing_used_stride_date = null,
+                    download_upload_started_at = null,
+                    download_upload_completed_at = null,
+                    download_upload_error = null,
+                    download_upload_success = true
+                where {dates_where}
+            """)).rowcount
+            session.commit()
+    if dry_run:
+        print('Dry run - no changes were made to the DB')
+    pprint(dict(stats))
+    return stats
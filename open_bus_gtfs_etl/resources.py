@@ -0,0 +1,98 @@
+import os
+from pathlib import Path
+from functools import lru_cache
+
+from . import config
+
+
+CGROUP_ROOT = Path('/sys/fs/cgroup')
+
+# cgroup v1 reports a huge number instead of "no limit"
+CGROUP_V1_UNLIMITED_MEMORY_BYTES = 2 ** 60
+
+MIN_STOP_TIMES_CHUNK_BYTES = 16 * 1024 * 1024
+MAX_STOP_TIMES_CHUNK_BYTES = 256 * 1024 * 1024
+
+# approximate memory needed by each concurrent loader (the stop times loader holds the date's stop times in memory)
+DB_WRITER_MEMORY_BYTES = 2 * 1024 * 1024 * 1024
+MAX_DB_WRITERS = 4
+
+
+def read_cgroup_file(*path):
+    try:
+        return CGROUP_ROOT.joinpath(*path).read_text().strip()
+    except (OSError, ValueError):
+        return None
+
+
+def get_cgroup_memory_limit_usage():
+    """Returns (limit bytes, usage bytes) of the container's cgroup (v2 or v1), limit is None if there is no limit"""
+    limit = read_cgroup_file('memory.max')
+    if limit is not None:
+        usage = read_cgroup_file('memory.current')
+    else:
+        limit = read_cgroup_file('memory', 'memory.limit_in_bytes')
+        usage = read_cgroup_file('memory', 'memory.usage_in_bytes')
+    if not limit or limit == 'max' or int(limit) >= CGROUP_V1_UNLIMITED_MEMORY_BYTES:
+        return None, None
+    return int(limit), int(usage or 0)
+
+
+def get_cgroup_cpu_limit():
+    """Returns the cpu quota of the container's cgroup (v2 or v1) in cores, or None if there is no limit"""
+    cpu_max = read_cgroup_file('cpu.max')
+    if cpu_max is not None:
+        quota, period = cpu_max.split()
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    quota = read_cgroup_file('cpu', 'cpu.cfs_quota_us')
+    period = read_cgroup_file('cpu', 'cpu.cfs_period_us')
+    if not quota or not period or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
+
+
+def get_available_memory_bytes():
+    import psutil
+    available = psutil.virtual_memory().available
+    limit, usage = get_cgroup_memory_limit_usage()
+    if limit is not None:
+        available = min(available, limit - usage)
+    return max(0, available)
+
+
+def get_available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    cpu_limit = get_cgroup_cpu_limit()
+    if cpu_limit is not None:
+        cpus = min(cpus, cpu_limit)
+    return max(1, int(cpus))
+
+
+@lru_cache()
+def get_tuning():
+    """Returns the resources tuning, based on the available memory / cpus (according to the cgroup limits and psutil),
+    each value can be overridden by its env var (see config.py). The decision is printed on first call."""
+    memory_bytes = get_available_memory_bytes()
+    cpus = get_available_cpus()
+    auto_tuning = {
+        'stop_times_chunk_bytes': min(MAX_STOP_TIMES_CHUNK_BYTES, max(MIN_STOP_TIMES_CHUNK_BYTES, memory_bytes // 32)),
+        'parser_threads': cpus,
+        'db_writers': max(1, min(MAX_DB_WRITERS, cpus, memory_bytes // DB_WRITER_MEMORY_BYTES)),
+    }
+    overrides = {
+        'stop_times_chunk_bytes': config.GTFS_ETL_STOP_TIMES_CHUNK_BYTES,
+        'parser_threads': config.GTFS_ETL_PARSER_THREADS,
+        'db_writers': config.GTFS_ETL_LOADERS_MAX_WORKERS,
+    }
+    tuning = {key: overrides[key] or value for key, value in auto_tuning.items()}
+    print("Resources tuning (available memory: {:.0f}mb, cpus: {}): {}".format(
+        memory_bytes / (1024 * 1024), cpus, ', '.join(
+            '{}={}{}'.format(key, value, ' (env override)' if overrides[key] else '') for key, value in tuning.items()
+        )
+    ))
+    return tuning
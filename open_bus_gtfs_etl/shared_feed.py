@@ -0,0 +1,71 @@
+import os
+import datetime
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+
+from . import common, calendar_index, partridge_helper
+
+
+# schema metadata key of the feed files key (see get_stop_times_key)
+STOP_TIMES_KEY_METADATA = b'gtfs_etl_key'
+
+
+def get_stop_times_path(gtfs_path: Path, date: datetime.date):
+    return Path(gtfs_path, '.stop_times_{}.arrow'.format(date.strftime('%Y%m%d')))
+
+
+def get_stop_times_key(gtfs_path: Path):
+    """The shared stop times are valid as long as the feed (see calendar_index.get_feed_hash) and stop_times.txt didn't change"""
+    stat = os.stat(Path(gtfs_path, 'stop_times.txt'))
+    return '{} {} {}'.format(calendar_index.get_feed_hash(gtfs_path), stat.st_size, stat.st_mtime_ns)
+
+
+def export_stop_times(path: Path, stop_times: pd.DataFrame, key):
+    """Writes the typed stop times to an Arrow IPC file, the pandas metadata (categorical / nullable dtypes) is kept"""
+    table = pa.Table.from_pandas(stop_times, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), STOP_TIMES_KEY_METADATA: key.encode()})
+    with common.safe_open_write(path, 'wb') as f:
+        with pa.ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+
+
+def attach_stop_times(path: Path, key):
+    """Returns the typed stop times from the memory mapped Arrow IPC file, or None if it doesn't exist or it's
+    of a different feed. Columns without nulls (trip_id codes, stop_id, stop_sequence, pickup / drop off types)
+    are read-only views of the mapped file pages, so processes / threads which attach the same file share them,
+    the nullable columns (times, shape_dist_traveled) are copied by the conversion to pandas."""
+    if not path.exists():
+        return None
+    reader = pa.ipc.open_file(pa.memory_map(str(path)))
+    if (reader.schema.metadata or {}).get(STOP_TIMES_KEY_METADATA) != key.encode():
+        return None
+    return reader.read_all().to_pandas(split_blocks=True)
+
+
+def get_stop_times(gtfs_path: Path, date: datetime.date, silent=False, use_index=None) -> pd.DataFrame:
+    """Returns the typed stop times of all the date's trips (see partridge_helper.read_stop_times_typed).
+    The stop times are parsed once per date and feed and stored next to the extracted feed, all the consumers of the date
+    (stops pruning, stop times loader, atomic load, parquet export) attach to the stored file instead of parsing again.
+    The file is locked while it's created, so concurrent consumers wait for a single parse."""
+    path = get_stop_times_path(gtfs_path, date)
+    key = get_stop_times_key(gtfs_path)
+    with common.file_lock(str(path) + '.lock'):
+        stop_times = attach_stop_times(path, key)
+        if stop_times is None:
+            trip_ids = partridge_helper.get_trip_ids_for_date(gtfs_path, date)
+            stop_times = partridge_helper.read_stop_times_typed(gtfs_path, trip_ids=trip_ids, silent=silent, use_index=use_index)
+            with common.print_memory_usage('Storing shared stop times to {}...'.format(path), silent=silent):
+                export_stop_times(path, stop_times, key)
+            # the parsed frame is replaced by the mapped one, so that its memory is released
+            del stop_times
+            stop_times = attach_stop_times(path, key)
+    return stop_times
+
+
+def get_trips_stop_times(gtfs_path: Path, date: datetime.date, trip_ids, silent=False, use_index=None) -> pd.DataFrame:
+    """Returns the date's shared typed stop times of the given trips (see get_stop_times)"""
+    stop_times = get_stop_times(gtfs_path, date, silent=silent, use_index=use_index)
+    is_trip = stop_times['trip_id'].isin(trip_ids)
+    return stop_times if is_trip.all() else stop_times[is_trip].reset_index(drop=True)
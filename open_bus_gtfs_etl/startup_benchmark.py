@@ -0,0 +1,72 @@
+import sys
+import time
+import statistics
+import subprocess
+
+
+# the modules imported by each cli command, --help only imports the cli module
+COMMAND_MODULES = {
+    '--help': None,
+    'download-extract': 'download_extract_upload',
+    'load-stops-to-db': 'load_stops_to_db',
+    'load-routes-to-db': 'load_routes_to_db',
+    'load-trips-to-db': 'load_trips_to_db',
+    'load-stop-times-to-db': 'load_stop_times_to_db',
+    'load-mot-datasets-to-db': 'load_mot_datasets_to_db',
+    'load-atomic-to-db': 'load_atomic_to_db',
+    'stop-times-index': 'stop_times_index',
+    'run-loaders': 'loaders_dag',
+    'loaders-graph': 'loaders_dag',
+    'export-parquet': 'export_parquet',
+    'cleanup-dated-paths': 'cleanup_dated_paths',
+    'cleanup-workdir': 'cleanup_workdir',
+    'idempotent-process': 'idempotent_process',
+    'idempotent-download-upload': 'idempotent_download_upload',
+    'update-gtfs-data-db': 'update_gtfs_data_db',
+    'reprocess-data': 'reprocess_data',
+}
+
+
+def parse_importtime(stderr):
+    """Parses python -X importtime output, returns list of (module, cumulative microseconds) of top level imports"""
+    imports = []
+    for line in stderr.splitlines():
+        if line.startswith('import time:') and '|' in line:
+            _, cumulative, name = line[len('import time:'):].split('|')
+            if not name.strip() or not cumulative.strip().isdigit():
+                continue
+            # nested imports are indented in the module name column
+            if name[1:].startswith(' '):
+                continue
+            imports.append((name.strip(), int(cumulative.strip())))
+    return imports
+
+
+def benchmark_command(command, repeats):
+    module = COMMAND_MODULES[command]
+    code = 'from open_bus_gtfs_etl import cli' + (f', {module}' if module else '')
+    wall_times, imports = [], []
+    for _ in range(repeats):
+        start_time = time.time()
+        proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], stderr=subprocess.PIPE, text=True)
+        wall_times.append(time.time() - start_time)
+        if proc.returncode != 0:
+            print('\n'.join(line for line in proc.stderr.splitlines() if not line.startswith('import time:')))
+            raise Exception(f'failed to import modules for command {command}')
+        imports = parse_importtime(proc.stderr)
+    return statistics.median(wall_times), imports
+
+
+def main(command=None, repeats=3, top=5, max_seconds=None):
+    """Measures the cold start latency (python interpreter startup and imports) of each cli command"""
+    commands = command if command else list(COMMAND_MODULES)
+    failed_commands = []
+    for command_name in commands:
+        wall_seconds, imports = benchmark_command(command_name, int(repeats))
+        slowest = sorted(imports, key=lambda i: i[1], reverse=True)[:int(top)]
+        print('{}: {:.3f} seconds, slowest imports: {}'.format(
+            command_name, wall_seconds, ', '.join('{} ({:.0f}ms)'.format(name, us / 1000) for name, us in slowest)
+        ))
+        if max_seconds and wall_seconds > float(max_seconds):
+            failed_commands.append(command_name)
+    assert not failed_commands, 'commands exceeded max seconds: {}'.format(', '.join(failed_commands))
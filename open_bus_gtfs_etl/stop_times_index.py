@@ -0,0 +1,156 @@
+import os
+from pathlib import Path
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from . import common, config
+
+
+STOP_TIMES_INDEX_FILE_NAME = '.stop_times_index.npz'
+INDEX_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def get_index_key(stop_times_path: Path):
+    stat = os.stat(stop_times_path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def iterate_chunk_trip_runs(chunk: bytes, offset, trip_id_index):
+    """Yields (trip_id, start offset, end offset) for each run of consecutive lines of the same trip in the chunk
+    (the chunk contains only complete lines). Trip ids of consecutive lines are compared with numpy, byte by byte,
+    so only the first line of each run is decoded. Fields must not contain quoted commas."""
+    data = np.frombuffer(chunk, dtype=np.uint8)
+    line_ends = np.flatnonzero(data == ord('\n')) + 1
+    line_starts = np.concatenate([[0], line_ends[:-1]])
+    commas = np.flatnonzero(data == ord(','))
+    if trip_id_index == 0:
+        field_starts = line_starts
+    else:
+        field_starts = commas[np.minimum(np.searchsorted(commas, line_starts) + trip_id_index - 1, len(commas) - 1)] + 1
+    next_commas = commas[np.minimum(np.searchsorted(commas, field_starts), len(commas) - 1)] if len(commas) else line_ends
+    field_ends = np.where(next_commas >= field_starts, np.minimum(next_commas, line_ends - 1), line_ends - 1)
+    field_lengths = field_ends - field_starts
+    is_run_start = np.ones(len(line_starts), dtype=bool)
+    is_run_start[1:] = field_lengths[1:] != field_lengths[:-1]
+    for i in range(int(field_lengths.max()) if len(field_lengths) else 0):
+        column = data[np.minimum(field_starts + i, len(data) - 1)]
+        is_run_start[1:] |= (column[1:] != column[:-1]) & (i < field_lengths[1:])
+    run_starts = np.flatnonzero(is_run_start)
+    run_ends = np.concatenate([run_starts[1:], [len(line_starts)]])
+    for run_start, run_end in zip(run_starts, run_ends):
+        trip_id = chunk[field_starts[run_start]:field_ends[run_start]].decode().strip()
+        yield trip_id, offset + int(line_starts[run_start]), offset + int(line_ends[run_end - 1])
+
+
+def build_index(stop_times_path: Path, chunk_bytes=INDEX_CHUNK_BYTES):
+    """Reads stop_times.txt once and returns the index - header and arrays of trip ids and byte ranges (start, end)
+    of each run of consecutive lines of the trip. MOT's file is grouped by trip, so usually a trip has a single range."""
+    trip_ids, starts, ends = [], [], []
+    with open(stop_times_path, 'rb') as f:
+        header = f.readline()
+        trip_id_index = header.strip().decode('utf-8-sig').split(',').index('trip_id')
+        offset = len(header)
+        remainder = b''
+        while True:
+            data = f.read(chunk_bytes)
+            if data:
+                chunk = remainder + data
+                last_newline = chunk.rfind(b'\n') + 1
+                chunk, remainder = chunk[:last_newline], chunk[last_newline:]
+                if not chunk:
+                    # no complete line yet (a line longer than chunk_bytes), continue reading
+                    continue
+            elif remainder.strip():
+                # last line of a file without a trailing newline
+                chunk, remainder = remainder + b'\n', b''
+            else:
+                break
+            for trip_id, start, end in iterate_chunk_trip_runs(chunk, offset, trip_id_index):
+                if trip_ids and trip_ids[-1] == trip_id and ends[-1] == start:
+                    # run continues from the previous chunk
+                    ends[-1] = end
+                else:
+                    trip_ids.append(trip_id)
+                    starts.append(start)
+                    ends.append(end)
+            offset += len(chunk)
+    return {
+        'header': header,
+        'trip_ids': np.array(trip_ids, dtype=str),
+        'starts': np.array(starts, dtype=np.int64),
+        'ends': np.array(ends, dtype=np.int64),
+    }
+
+
+@lru_cache(maxsize=4)
+def load_index(stop_times_path: str, key: tuple):
+    index_path = Path(os.path.dirname(stop_times_path), STOP_TIMES_INDEX_FILE_NAME)
+    if index_path.exists():
+        with np.load(index_path) as data:
+            if tuple(data['key']) == key:
+                index = {name: data[name] for name in ['trip_ids', 'starts', 'ends']}
+                index['header'] = data['header'].tobytes()
+                return get_ranges_by_trip_id(index)
+    index = build_index(Path(stop_times_path))
+    with common.safe_open_write(index_path, 'wb') as f:
+        np.savez(
+            f, key=np.array(key, dtype=np.int64), header=np.frombuffer(index['header'], dtype=np.uint8),
+            trip_ids=index['trip_ids'], starts=index['starts'], ends=index['ends'],
+        )
+    return get_ranges_by_trip_id(index)
+
+
+def get_ranges_by_trip_id(index):
+    ranges_by_trip_id = {}
+    for trip_id, start, end in zip(index['trip_ids'].tolist(), index['starts'].tolist(), index['ends'].tolist()):
+        ranges_by_trip_id.setdefault(trip_id, []).append((start, end))
+    return index['header'], ranges_by_trip_id
+
+
+def get_index(gtfs_path: Path):
+    """Returns (header, {trip_id: [(start, end), ...]}) of the feed's stop_times.txt, the index is stored
+    in the extracted feed directory and rebuilt if stop_times.txt changed"""
+    stop_times_path = os.path.abspath(Path(gtfs_path, 'stop_times.txt'))
+    return load_index(stop_times_path, tuple(get_index_key(stop_times_path).tolist()))
+
+
+def iterate_trips_bytes(gtfs_path: Path, trip_ids):
+    """Yields the header and then the lines of the given trips, read by seeking to their byte ranges
+    (in file order, adjacent ranges are read together). Trips which are not in the file are ignored."""
+    header, ranges_by_trip_id = get_index(gtfs_path)
+    yield header
+    ranges = sorted(trip_range for trip_id in trip_ids for trip_range in ranges_by_trip_id.get(trip_id, []))
+    merged_ranges = []
+    for start, end in ranges:
+        if merged_ranges and merged_ranges[-1][1] == start:
+            merged_ranges[-1][1] = end
+        else:
+            merged_ranges.append([start, end])
+    with open(Path(gtfs_path, 'stop_times.txt'), 'rb') as f:
+        for start, end in merged_ranges:
+            f.seek(start)
+            yield f.read(end - start)
+
+
+def get_route_trip_ids(gtfs_path: Path, route_ids) -> set:
+    trips = pd.read_csv(Path(gtfs_path, 'trips.txt'), usecols=['route_id', 'trip_id'], dtype=str)
+    return set(trips[trips['route_id'].isin({str(route_id) for route_id in route_ids})]['trip_id'])
+
+
+def main(date=None, trip_ids=None, route_ids=None, extracted_workdir=None):
+    """Builds the stop_times index of the date's extracted feed (if needed)
+    and prints the stop times of the given trips / routes"""
+    date = common.parse_date_str(date)
+    dated_workdir = extracted_workdir if extracted_workdir else common.get_dated_workdir(date)
+    gtfs_path = Path(dated_workdir, config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION)
+    with common.print_memory_usage('Loading stop_times index...'):
+        header, ranges_by_trip_id = get_index(gtfs_path)
+    print('{} trips in stop_times index'.format(len(ranges_by_trip_id)))
+    trip_ids = set(trip_ids or [])
+    if route_ids:
+        trip_ids |= get_route_trip_ids(gtfs_path, route_ids)
+    if trip_ids:
+        for lines in iterate_trips_bytes(gtfs_path, sorted(trip_ids)):
+            print(lines.decode('utf-8-sig'), end='')
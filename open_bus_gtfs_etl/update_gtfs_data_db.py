@@ -7,7 +7,7 @@ from textwrap import dedent
 from open_bus_stride_db.db import get_session
 from open_bus_stride_db.model import GtfsData
 
-from . import config, common, idempotent_process
+from . import config, common
 
 
 def s3api_list_objects(prefix, max_keys):
@@ -48,6 +48,7 @@ def validate_s3_date(year, month, day):
 
 
 def iterate_gtfs_s3_valid_dates(last_days=None, only_date=None):
+    from . import idempotent_process
     if only_date:
         valid_s3_date = validate_s3_date(only_date.year, only_date.month, only_date.day)
         if valid_s3_date:
@@ -71,6 +72,7 @@ def iterate_gtfs_s3_valid_dates(last_days=None, only_date=None):
 
 
 def iterate_last_dates(last_days, only_date=None):
+    from . import idempotent_process
     if last_days is None:
         last_days = idempotent_process.DEFAULT_LAST_DAYS
     for minus_days in range(last_days+1):
@@ -1,22 +1,105 @@
 import os
+import json
 import datetime
 import subprocess
 
 from . import common, config
 
 
-def upload_rename(local_filepath, date, basename, ext, force):
+BASENAMES = ['ClusterToLine', 'Tariff', 'TripIdToDate', 'israel-public-transportation']
+
+# streamed uploads are written to a temporary key with this suffix and renamed after the data was verified
+UPLOADING_SUFFIX = '.uploading'
+
+
+def get_aws_env():
     assert config.OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_ACCESS_KEY_ID and config.OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_SECRET_ACCESS_KEY
+    return {**os.environ,
+            'AWS_ACCESS_KEY_ID': config.OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_ACCESS_KEY_ID,
+            'AWS_SECRET_ACCESS_KEY': config.OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_SECRET_ACCESS_KEY}
+
+
+def s3_path_exists(s3_path):
+    return subprocess.call(['aws', 's3', 'ls', s3_path], env=get_aws_env()) == 0
+
+
+def abort_multipart_uploads(s3_path):
+    """Aborts the incomplete multipart uploads of the given key, so that their uploaded parts are not kept in the bucket"""
+    bucket, key = s3_path[len('s3://'):].split('/', 1)
+    output = subprocess.check_output(
+        ['aws', 's3api', 'list-multipart-uploads', '--bucket', bucket, '--prefix', key, '--output', 'json'],
+        env=get_aws_env()
+    )
+    uploads = json.loads(output or b'{}').get('Uploads') or []
+    for upload in uploads:
+        if upload['Key'] == key:
+            print(f'aborting multipart upload {upload["UploadId"]} of {s3_path}')
+            subprocess.check_call(
+                ['aws', 's3api', 'abort-multipart-upload', '--bucket', bucket, '--key', key, '--upload-id', upload['UploadId']],
+                env=get_aws_env()
+            )
+
+
+class StreamUpload:
+    """Uploads the bytes written to it to S3 while they are written, by piping them to aws s3 cp stdin"""
+
+    def __init__(self, target_s3_path):
+        self.target_s3_path = target_s3_path
+        self.process = subprocess.Popen(['aws', 's3', 'cp', '-', target_s3_path], stdin=subprocess.PIPE, env=get_aws_env())
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.process.args)
+
+    def abort(self):
+        """Stops the upload and deletes what was uploaded - the incomplete multipart upload and the target key
+        (if the upload completed before it was stopped). Failures are printed, so they don't hide the original error."""
+        self.process.kill()
+        self.process.wait()
+        try:
+            abort_multipart_uploads(self.target_s3_path)
+            if s3_path_exists(self.target_s3_path):
+                subprocess.check_call(['aws', 's3', 'rm', self.target_s3_path], env=get_aws_env())
+        except Exception as e:
+            print(f'WARNING! failed to clean up aborted upload {self.target_s3_path}: {e}')
+
+
+def start_stream_upload(date, basename, ext):
+    target_s3_path = common.get_s3_dated_path(date, f'{basename}.{ext}{UPLOADING_SUFFIX}')
+    print(f'streaming upload to target_s3_path: {target_s3_path}')
+    return StreamUpload(target_s3_path)
+
+
+def finish_stream_upload(date, basename, ext, force):
+    """Renames a streamed upload to its final key, should be called only after the data was verified"""
+    uploading_s3_path = common.get_s3_dated_path(date, f'{basename}.{ext}{UPLOADING_SUFFIX}')
     target_s3_path = common.get_s3_dated_path(date, f'{basename}.{ext}')
     print(f'target_s3_path: {target_s3_path}')
-    if subprocess.call(
-            [
-                'aws', 's3', 'ls', target_s3_path
-            ],
-            env={**os.environ,
-                 'AWS_ACCESS_KEY_ID': config.OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_ACCESS_KEY_ID,
-                 'AWS_SECRET_ACCESS_KEY': config.OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_SECRET_ACCESS_KEY}
-    ) == 0 and not force:
+    if s3_path_exists(target_s3_path) and not force:
+        print(f"File already exists in S3, will not overwrite")
+        subprocess.check_call(['aws', 's3', 'rm', uploading_s3_path], env=get_aws_env())
+    else:
+        subprocess.check_call(['aws', 's3', 'mv', uploading_s3_path, target_s3_path], env=get_aws_env())
+
+
+def main_abort_stream_upload(date):
+    """Deletes the streamed uploads of the date which were not finished (e.g. the files failed verification)"""
+    for basename in BASENAMES:
+        uploading_s3_path = common.get_s3_dated_path(date, f'{basename}.zip{UPLOADING_SUFFIX}')
+        if s3_path_exists(uploading_s3_path):
+            print(f'deleting unfinished streamed upload: {uploading_s3_path}')
+            subprocess.check_call(['aws', 's3', 'rm', uploading_s3_path], env=get_aws_env())
+
+
+def upload_rename(local_filepath, date, basename, ext, force):
+    target_s3_path = common.get_s3_dated_path(date, f'{basename}.{ext}')
+    print(f'target_s3_path: {target_s3_path}')
+    if s3_path_exists(target_s3_path) and not force:
         print(f"File already exists in S3, will not overwrite")
     else:
         subprocess.check_call(
@@ -24,12 +107,31 @@ def upload_rename(local_filepath, date, basename, ext, force):
                 'aws', 's3', 'cp',
                 local_filepath, target_s3_path
             ],
-            env={**os.environ,
-                 'AWS_ACCESS_KEY_ID': config.OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_ACCESS_KEY_ID,
-                 'AWS_SECRET_ACCESS_KEY': config.OPEN_BUS_STRIDE_PUBLIC_S3_WRITE_SECRET_ACCESS_KEY}
+            env=get_aws_env()
         )
 
 
+def upload_sync_dir(local_dirpath, date, dirname, force):
+    """Uploads a local directory (e.g. a partitioned parquet dataset) to the date's path, files under the target path
+    which don't exist locally are deleted, so that stale partitions of a previous upload are not kept"""
+    target_s3_path = common.get_s3_dated_path(date, dirname) + '/'
+    print(f'target_s3_path: {target_s3_path}')
+    if s3_path_exists(target_s3_path) and not force:
+        print(f"Path already exists in S3, will not overwrite")
+    else:
+        subprocess.check_call(['aws', 's3', 'sync', '--delete', local_dirpath, target_s3_path], env=get_aws_env())
+
+
+def main_finish_stream_upload(date, archive_folder, force=False):
+    """Renames the streamed uploads of the files which exist in the local archive folder to their final keys"""
+    print(f"Finishing streamed upload of '{archive_folder}' to s3 path '{common.get_s3_dated_path(date)}'")
+    for basename in BASENAMES:
+        if os.path.exists(os.path.join(archive_folder, f'{basename}.zip')):
+            finish_stream_upload(date, basename, 'zip', force)
+        else:
+            print(f"WARNING! missing file: {basename}.zip")
+
+
 def main_upload_all(force=False):
     for i in range(9999):
         date = (datetime.datetime.now() - datetime.timedelta(days=i))
@@ -49,8 +151,7 @@ def main(date=None, force=False, upload_all=False, archive_folder=None):
         else:
             base_path = common.get_dated_path(date)
         print(f"Uploading from local path '{base_path}' to s3 path '{common.get_s3_dated_path(date)}'")
-        basenames = ['ClusterToLine', 'Tariff', 'TripIdToDate', 'israel-public-transportation']
-        for basename in basenames:
+        for basename in BASENAMES:
             file_path = os.path.join(base_path, f'{basename}.zip')
             if os.path.exists(file_path):
                 upload_rename(file_path, date, basename, 'zip', force)
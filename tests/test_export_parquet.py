@@ -0,0 +1,25 @@
+import pandas as pd
+import pyarrow.dataset as ds
+
+from open_bus_gtfs_etl import export_parquet
+
+
+def test_write_parquet_partitioned(tmp_path):
+    rides = pd.DataFrame({'journey_ref': ['10_1', '20_1', '30_1'], 'operator_ref': pd.array([3, 5, None], dtype='Int64')})
+    ride_stops = pd.DataFrame({
+        'journey_ref': pd.Categorical(['10_1', '10_1', '20_1', '30_1', '40_1', '10_1']),
+        'stop_sequence': [1, 2, 1, 1, 1, 3],
+    })
+    operator_refs = export_parquet.get_operator_refs(ride_stops['journey_ref'], rides)
+    assert [None if pd.isna(operator_ref) else operator_ref for operator_ref in operator_refs] == [3, 3, 5, None, None, 3]
+    path = tmp_path / 'ride_stops'
+    assert export_parquet.write_parquet_partitioned(ride_stops, path, operator_refs) == 3
+    assert sorted(p.name for p in path.iterdir()) == ['operator_ref=3', 'operator_ref=5', 'operator_ref=__HIVE_DEFAULT_PARTITION__']
+    assert pd.read_parquet(path / 'operator_ref=3' / 'part-0.parquet')['stop_sequence'].tolist() == [1, 2, 3]
+    dataset = ds.dataset(path, partitioning='hive').to_table().to_pandas()
+    assert len(dataset) == len(ride_stops)
+    assert sorted(dataset[dataset['operator_ref'] == 5]['journey_ref'].astype(str)) == ['20_1']
+    # the partition column is only in the partition path
+    rides_path = tmp_path / 'rides'
+    export_parquet.write_parquet_partitioned(rides, rides_path, export_parquet.get_operator_refs(rides['journey_ref'], rides))
+    assert pd.read_parquet(rides_path / 'operator_ref=5' / 'part-0.parquet').columns.tolist() == ['journey_ref']
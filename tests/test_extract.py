@@ -0,0 +1,48 @@
+import zipfile
+
+import pytest
+
+from open_bus_gtfs_etl import extract, config
+
+
+def write_zip(path, content=b'trip_id,stop_id\n1,2\n', corrupt=False):
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as zip_file:
+        zip_file.writestr('stop_times.txt', content)
+    if corrupt:
+        data = bytearray(path.read_bytes())
+        offset = data.index(content)
+        data[offset] = ord('X')
+        path.write_bytes(bytes(data))
+
+
+def write_archive(archive_folder, corrupt_names=()):
+    archive_folder.mkdir()
+    for name in ['israel-public-transportation', 'Tariff', 'ClusterToLine', 'TripIdToDate']:
+        write_zip(archive_folder / f'{name}.zip', corrupt=name in corrupt_names)
+
+
+def test_extract(tmp_path):
+    write_archive(tmp_path / 'archive')
+    extracted_workdir = tmp_path / 'extracted'
+    extract.main('2022-06-06', silent=True, archive_folder=str(tmp_path / 'archive'), extracted_workdir=str(extracted_workdir))
+    gtfs_path = extracted_workdir / config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION
+    assert gtfs_path.joinpath('stop_times.txt').read_bytes() == b'trip_id,stop_id\n1,2\n'
+    assert sorted(p.name for p in extracted_workdir.iterdir()) == sorted([
+        config.WORKDIR_ISRAEL_PUBLIC_TRANSPORTATION, config.WORKDIR_TARIFF, config.WORKDIR_CLUSTER_TO_LINE, config.WORKDIR_TRIP_ID_TO_DATE
+    ])
+
+
+def test_extract_bad_crc(tmp_path):
+    write_archive(tmp_path / 'archive', corrupt_names=['Tariff', 'TripIdToDate'])
+    extracted_workdir = tmp_path / 'extracted'
+    tariff_path = extracted_workdir / config.WORKDIR_TARIFF
+    tariff_path.mkdir(parents=True)
+    tariff_path.joinpath('previous.txt').write_text('previous')
+    with pytest.raises(extract.ExtractUnzipException) as e:
+        extract.main('2022-06-06', silent=True, archive_folder=str(tmp_path / 'archive'), extracted_workdir=str(extracted_workdir))
+    assert sorted(e.value.zip_file_names) == [str(tmp_path / 'archive' / 'Tariff.zip'), str(tmp_path / 'archive' / 'TripIdToDate.zip')]
+    assert e.value.member == 'stop_times.txt'
+    # a corrupted archive doesn't replace the previously extracted files and leaves no partial extraction
+    assert [p.name for p in tariff_path.iterdir()] == ['previous.txt']
+    assert not extracted_workdir.joinpath(config.WORKDIR_TRIP_ID_TO_DATE).exists()
+    assert not list(extracted_workdir.glob('*.extracting'))
@@ -0,0 +1,39 @@
+import io
+import subprocess
+
+import pytest
+
+pytest.importorskip('pydantic')
+
+from open_bus_gtfs_etl import gtfs_extractor  # noqa: E402
+
+
+class StreamUpload:
+
+    def __init__(self, close_returncode=0):
+        self.close_returncode = close_returncode
+        self.data = b''
+        self.closed = self.aborted = False
+
+    def write(self, data):
+        self.data += data
+
+    def close(self):
+        self.closed = True
+        if self.close_returncode != 0:
+            raise subprocess.CalledProcessError(self.close_returncode, ['aws', 's3', 'cp'])
+
+    def abort(self):
+        self.aborted = True
+
+
+def test_download_stream_upload(tmp_path, monkeypatch):
+    monkeypatch.setattr(gtfs_extractor.request, 'urlopen', lambda url, context: io.BytesIO(b'zip data'))
+    stream_upload = StreamUpload()
+    gtfs_extractor.GtfsRetriever.download_file_from_ftp('https://example.com/a.zip', tmp_path / 'a.zip', stream_upload)
+    assert stream_upload.data == b'zip data' and stream_upload.closed and not stream_upload.aborted
+    # the upload failed when it was closed, so it's aborted
+    stream_upload = StreamUpload(close_returncode=1)
+    with pytest.raises(subprocess.CalledProcessError):
+        gtfs_extractor.GtfsRetriever.download_file_from_ftp('https://example.com/a.zip', tmp_path / 'a.zip', stream_upload)
+    assert stream_upload.aborted
@@ -0,0 +1,27 @@
+import pytest
+
+pytest.importorskip('open_bus_stride_db')
+
+from open_bus_gtfs_etl import load_mot_datasets_to_db  # noqa: E402
+
+
+def test_read_mot_dataset(tmp_path):
+    source_path = tmp_path / 'TripIdToDate.txt'
+    source_path.write_text(
+        'OfficeLineId,Direction,LineAlternative,FromDate,ToDate,TripId,DayInWeek,DepartureTime,NewColumn,\n'
+        '10001,1,0,01/06/2022 00:00:00,30/06/2022 00:00:00,1234,1,25:10,x,\n',
+        encoding='utf-8-sig'
+    )
+    stats = {'unknown source columns ignored': 0}
+    df = load_mot_datasets_to_db.read_mot_dataset(source_path, load_mot_datasets_to_db.MOT_DATASETS_SOURCE_COLUMNS['trip_id_to_date'], stats)
+    assert ['date', *df.columns] == list(load_mot_datasets_to_db.get_table_columns('trip_id_to_date'))
+    assert df['departure_time'].tolist() == [25 * 3600 + 600]
+    assert str(df['from_date'][0]) == '2022-06-01'
+    assert stats['unknown source columns ignored'] == 1
+
+
+def test_read_mot_dataset_missing_columns(tmp_path):
+    source_path = tmp_path / 'Tariff.txt'
+    source_path.write_text('ShareCode,ShareCodeDesc\n1,a\n')
+    with pytest.raises(load_mot_datasets_to_db.MotDatasetSchemaException, match='missing the columns: ZoneCodes'):
+        load_mot_datasets_to_db.read_mot_dataset(source_path, load_mot_datasets_to_db.MOT_DATASETS_SOURCE_COLUMNS['tariff'], {'rows in source data': 0})
@@ -0,0 +1,53 @@
+import gc
+import weakref
+
+import pytest
+
+from open_bus_gtfs_etl import loaders_dag
+
+
+class Feed:
+    pass
+
+
+def test_feed_released_before_stop_times(monkeypatch):
+    feeds = []
+    loaders_feeds = {}
+
+    def preload_feed(date, extracted_workdir=None, silent=False):
+        feed = Feed()
+        feeds.append(weakref.ref(feed))
+        return feed
+
+    def run_loader(loader, date, extracted_workdir=None, feed=None, resume=False):
+        gc.collect()
+        loaders_feeds[loader] = (feed is not None, feeds[0]() is not None)
+        return {'rows updated in DB': 0, 'rows inserted to DB': 0, 'stop mot id rows inserted to DB': 0}
+
+    monkeypatch.setattr(loaders_dag, 'preload_feed', preload_feed)
+    monkeypatch.setattr(loaders_dag, 'run_loader', run_loader)
+    loaders_dag.main('2022-06-06', loaders=['stops', 'routes', 'trips', 'stop_times'], max_workers=1, silent=True)
+    assert len(feeds) == 1
+    assert loaders_feeds['stops'] == loaders_feeds['routes'] == loaders_feeds['trips'] == (True, True)
+    assert loaders_feeds['stop_times'] == (False, False)
+
+
+def test_single_loader_not_preloaded(monkeypatch):
+    monkeypatch.setattr(loaders_dag, 'preload_feed', lambda *args, **kwargs: 1 / 0)
+    monkeypatch.setattr(loaders_dag, 'run_loader', lambda loader, date, extracted_workdir, feed, resume: {'rows inserted to DB': 0})
+    assert loaders_dag.main('2022-06-06', loaders=['tariff'], silent=True)['tariff rows inserted to DB'] == 0
+
+
+def test_optional_loader_failure(monkeypatch):
+    def run_loader(loader, date, extracted_workdir=None, feed=None, resume=False):
+        if loader == 'tariff':
+            raise Exception('invalid tariff')
+        return {'rows inserted to DB': 1}
+
+    monkeypatch.setattr(loaders_dag, 'run_loader', run_loader)
+    loaders = ['trip_id_to_date', 'cluster_to_line', 'tariff']
+    stats = loaders_dag.main('2022-06-06', loaders=loaders, silent=True, optional_loaders=loaders_dag.MOT_DATASETS_LOADERS)
+    assert stats['tariff loader errors'] == 1
+    assert stats['trip_id_to_date rows inserted to DB'] == stats['cluster_to_line rows inserted to DB'] == 1
+    with pytest.raises(Exception, match='invalid tariff'):
+        loaders_dag.main('2022-06-06', loaders=loaders, silent=True)
@@ -0,0 +1,28 @@
+from open_bus_gtfs_etl import partridge_helper
+
+
+def get_prefiltered_lines(path, data, trip_ids, chunk_bytes=16):
+    path.write_bytes(data)
+    return b''.join(partridge_helper.iterate_prefiltered_stop_times_chunks(path, trip_ids, chunk_bytes=chunk_bytes)).splitlines()
+
+
+def test_prefilter_trip_id_first_column(tmp_path):
+    data = b'trip_id,stop_id,stop_sequence\n1,10,1\n2,11,1\n1,12,2\n'
+    assert get_prefiltered_lines(tmp_path / 'stop_times.txt', data, {'1'}) == [b'trip_id,stop_id,stop_sequence', b'1,10,1', b'1,12,2']
+
+
+def test_prefilter_trip_id_last_column(tmp_path):
+    for line_ending in [b'\n', b'\r\n']:
+        data = line_ending.join([b'\xef\xbb\xbfstop_id,stop_sequence,trip_id', b'10,1,1', b'11,1,2', b'12,2,1', b'13,1,3'])
+        for chunk_bytes in [5, 16, 1024]:
+            # last line has no trailing newline
+            assert get_prefiltered_lines(tmp_path / 'stop_times.txt', data, {'1', '3'}, chunk_bytes) == [
+                b'\xef\xbb\xbfstop_id,stop_sequence,trip_id', b'10,1,1', b'12,2,1', b'13,1,3'
+            ]
+
+
+def test_prefilter_quoted_fields(tmp_path):
+    data = b'"stop_id","trip_id","stop_headsign"\n10,"1","a, b"\n11,"2",c\n12,1,"d"\n'
+    assert get_prefiltered_lines(tmp_path / 'stop_times.txt', data, {'1'}) == [
+        b'"stop_id","trip_id","stop_headsign"', b'10,"1","a, b"', b'12,1,"d"'
+    ]
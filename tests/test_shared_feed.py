@@ -0,0 +1,54 @@
+import datetime
+
+import pytest
+
+from open_bus_gtfs_etl import shared_feed, partridge_helper
+
+
+DATE = datetime.date(2022, 6, 6)
+
+
+def write_feed(gtfs_path, stop_times_lines):
+    gtfs_path.joinpath('calendar.txt').write_text(
+        'service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n'
+        '1,1,0,0,0,0,0,0,20220601,20220630\n'
+        '2,0,1,0,0,0,0,0,20220601,20220630\n'
+    )
+    gtfs_path.joinpath('trips.txt').write_text('route_id,service_id,trip_id\n1,1,10_1\n1,2,20_1\n2,1,30_1\n')
+    gtfs_path.joinpath('stop_times.txt').write_text(
+        'trip_id,arrival_time,departure_time,stop_id,stop_sequence,pickup_type,drop_off_type,shape_dist_traveled\n'
+        + ''.join(line + '\n' for line in stop_times_lines)
+    )
+
+
+STOP_TIMES_LINES = [
+    '10_1,08:00:00,08:00:00,1,1,0,1,0',
+    '10_1,08:05:00,08:05:00,2,2,0,0,1200',
+    '20_1,09:00:00,09:00:00,3,1,0,0,',
+    '30_1,25:10:00,25:10:00,4,1,,,',
+]
+
+
+def test_get_stop_times(tmp_path, monkeypatch):
+    write_feed(tmp_path, STOP_TIMES_LINES)
+    expected = partridge_helper.read_stop_times_typed(tmp_path, trip_ids={'10_1', '30_1'}, silent=True)
+    stop_times = shared_feed.get_stop_times(tmp_path, DATE, silent=True)
+    assert shared_feed.get_stop_times_path(tmp_path, DATE).exists()
+    assert stop_times.equals(expected)
+    # numeric columns without nulls are views of the memory mapped file
+    assert not stop_times['stop_id'].to_numpy().flags.writeable
+
+    def read_stop_times_typed(*args, **kwargs):
+        raise Exception('stop times should not be parsed again')
+
+    with monkeypatch.context() as m:
+        m.setattr(partridge_helper, 'read_stop_times_typed', read_stop_times_typed)
+        assert shared_feed.get_stop_times(tmp_path, DATE, silent=True).equals(expected)
+        trips_stop_times = shared_feed.get_trips_stop_times(tmp_path, DATE, {'30_1'}, silent=True)
+        assert trips_stop_times['stop_id'].tolist() == [4]
+        assert trips_stop_times['arrival_time'].tolist() == [25 * 3600 + 600]
+        with pytest.raises(Exception, match='should not be parsed again'):
+            # the stored stop times are of a different stop_times.txt
+            write_feed(tmp_path, STOP_TIMES_LINES[1:])
+            shared_feed.get_stop_times(tmp_path, DATE, silent=True)
+    assert shared_feed.get_stop_times(tmp_path, DATE, silent=True)['stop_id'].tolist() == [2, 4]
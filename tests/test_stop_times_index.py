@@ -0,0 +1,46 @@
+from open_bus_gtfs_etl import stop_times_index
+
+
+HEADER = b'trip_id,arrival_time,departure_time,stop_id,stop_sequence\n'
+
+
+def write_stop_times(path, lines, trailing_newline=True):
+    data = HEADER + b'\n'.join(lines)
+    if trailing_newline:
+        data += b'\n'
+    path.joinpath('stop_times.txt').write_bytes(data)
+    return data
+
+
+def get_trips_lines(gtfs_path, trip_ids):
+    data = b''.join(stop_times_index.iterate_trips_bytes(gtfs_path, trip_ids))
+    return data[len(HEADER):].splitlines()
+
+
+def assert_index(gtfs_path, lines, chunk_bytes):
+    index = stop_times_index.build_index(gtfs_path.joinpath('stop_times.txt'), chunk_bytes=chunk_bytes)
+    assert index['header'] == HEADER
+    assert index['trip_ids'].tolist() == sorted(set(line.split(b',')[0].decode() for line in lines))
+    for trip_id in index['trip_ids'].tolist():
+        assert get_trips_lines(gtfs_path, [trip_id]) == [line for line in lines if line.startswith(trip_id.encode() + b',')]
+
+
+def test_build_index(tmp_path):
+    lines = [b'1,08:00:00,08:00:00,10,1', b'1,08:05:00,08:05:00,11,2', b'2,09:00:00,09:00:00,12,1', b'3,10:00:00,10:00:00,13,1']
+    write_stop_times(tmp_path, lines)
+    for chunk_bytes in [7, 30, 1024]:
+        assert_index(tmp_path, lines, chunk_bytes)
+
+
+def test_build_index_without_trailing_newline(tmp_path):
+    lines = [b'1,08:00:00,08:00:00,10,1', b'2,09:00:00,09:00:00,12,1', b'3,10:00:00,10:00:00,13,1']
+    write_stop_times(tmp_path, lines, trailing_newline=False)
+    for chunk_bytes in [7, 25, 30, 1024]:
+        assert_index(tmp_path, lines, chunk_bytes)
+    assert get_trips_lines(tmp_path, ['1', '3']) == [lines[0], lines[2]]
+
+
+def test_build_index_line_longer_than_chunk_bytes(tmp_path):
+    lines = [b'1,08:00:00,08:00:00,10,1', b'2' * 100 + b',09:00:00,09:00:00,12,1', b'3,10:00:00,10:00:00,13,1']
+    write_stop_times(tmp_path, lines)
+    assert_index(tmp_path, lines, 16)